@@ -0,0 +1,358 @@
+"""
+Calmora Backend - Mood and habit analytics from incrementally maintained rollups
+
+Two rollup tables are kept up to date as entry rows change (see
+``record_changes``), so analytics requests read a handful of buckets
+instead of scanning the whole history:
+
+``mood_rollups``  count/sum/min/max of numeric mood values per user and
+                  day, ISO week (keyed by its Monday) and month
+``habit_runs``    each habit's check-ins as maximal runs of consecutive
+                  days, from which current/best streaks and totals follow
+
+Days are taken from the stored timestamps, i.e. UTC, matching the
+``toISOString()`` dates the frontend writes.
+"""
+
+import datetime
+import json
+
+GRANULARITIES = ('day', 'week', 'month')
+
+MOODS = 'moods'
+HABIT_CHECKINS = 'habit_checkins'
+
+
+def parse_day(value):
+    """``datetime.date`` for an ISO date/timestamp string, or None."""
+    if not isinstance(value, str):
+        return None
+    try:
+        return datetime.date.fromisoformat(value[:10])
+    except ValueError:
+        return None
+
+
+def mood_value(entry):
+    value = entry.get('mood') if isinstance(entry, dict) else None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return value
+
+
+def bucket_range(granularity, day):
+    """``(bucket, first_day, last_day)`` of the bucket containing ``day``."""
+    if granularity == 'day':
+        return day.isoformat(), day, day
+    if granularity == 'week':
+        start = day - datetime.timedelta(days=day.weekday())
+        return start.isoformat(), start, start + datetime.timedelta(days=6)
+    start = day.replace(day=1)
+    end = (start + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+    return start.strftime('%Y-%m'), start, end
+
+
+def _shift(day, days):
+    return (day + datetime.timedelta(days=days)).isoformat()
+
+
+# ============== SCHEMA ==============
+
+def create_schema(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS mood_rollups (
+            user_id INTEGER NOT NULL,
+            granularity TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            total REAL NOT NULL,
+            min_mood REAL,
+            max_mood REAL,
+            PRIMARY KEY (user_id, granularity, bucket)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS habit_runs (
+            user_id INTEGER NOT NULL,
+            habit_id TEXT NOT NULL,
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL,
+            PRIMARY KEY (user_id, habit_id, start_date)
+        )
+    ''')
+
+
+# ============== INCREMENTAL UPDATES ==============
+
+def record_changes(c, user_id, stored_type, removed, added):
+    """Fold entry rows that were just deleted/inserted into the rollups.
+
+    ``stored_type`` is the ``user_entries.data_type`` of the rows and
+    ``removed``/``added`` hold ``(entry_key, created_at, payload)`` tuples.
+    Must run in the same transaction as the row changes, after them.
+    """
+    if stored_type == MOODS:
+        _record_moods(c, user_id, removed, added)
+    elif stored_type == HABIT_CHECKINS:
+        _record_checkins(c, user_id, removed, added)
+
+
+def _record_moods(c, user_id, removed, added):
+    if removed:
+        # Min/max can't be un-merged, so rebuild the touched days from their rows
+        days = {parse_day(created_at) for _, created_at, _ in removed + added}
+        _recompute_mood_days(c, user_id, sorted(day for day in days if day))
+        return
+
+    for _, created_at, payload in added:
+        day = parse_day(created_at)
+        value = mood_value(payload)
+        if day is None or value is None:
+            continue
+        for granularity in GRANULARITIES:
+            bucket = bucket_range(granularity, day)[0]
+            c.execute('''
+                INSERT INTO mood_rollups (user_id, granularity, bucket, count, total, min_mood, max_mood)
+                VALUES (?, ?, ?, 1, ?, ?, ?)
+                ON CONFLICT (user_id, granularity, bucket) DO UPDATE SET
+                    count = count + 1,
+                    total = total + excluded.total,
+                    min_mood = MIN(min_mood, excluded.min_mood),
+                    max_mood = MAX(max_mood, excluded.max_mood)
+            ''', (user_id, granularity, bucket, value, value, value))
+
+
+def _recompute_mood_days(c, user_id, days):
+    for day in days:
+        c.execute('''
+            SELECT COUNT(v), SUM(v), MIN(v), MAX(v) FROM (
+                SELECT json_extract(data, '$.mood') AS v FROM user_entries
+                WHERE user_id = ? AND data_type = ? AND created_at >= ? AND created_at < ?
+                  AND json_type(data, '$.mood') IN ('integer', 'real')
+            )
+        ''', (user_id, MOODS, day.isoformat(), _shift(day, 1)))
+        _store_mood_bucket(c, user_id, 'day', day.isoformat(), c.fetchone())
+
+    # Weeks and months are sums of their (at most 31) day buckets
+    for granularity in ('week', 'month'):
+        for bucket, start, end in sorted({bucket_range(granularity, day) for day in days}):
+            c.execute('''
+                SELECT SUM(count), SUM(total), MIN(min_mood), MAX(max_mood) FROM mood_rollups
+                WHERE user_id = ? AND granularity = 'day' AND bucket >= ? AND bucket <= ?
+            ''', (user_id, start.isoformat(), end.isoformat()))
+            _store_mood_bucket(c, user_id, granularity, bucket, c.fetchone())
+
+
+def _store_mood_bucket(c, user_id, granularity, bucket, stats):
+    count, total, low, high = stats
+    if not count:
+        c.execute('DELETE FROM mood_rollups WHERE user_id = ? AND granularity = ? AND bucket = ?',
+                  (user_id, granularity, bucket))
+        return
+    c.execute('''
+        INSERT OR REPLACE INTO mood_rollups (user_id, granularity, bucket, count, total, min_mood, max_mood)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (user_id, granularity, bucket, count, total, low, high))
+
+
+def _record_checkins(c, user_id, removed, added):
+    touched = {(key, parse_day(created_at)) for key, created_at, _ in removed + added}
+    for habit_id, day in sorted((key, day) for key, day in touched if key is not None and day is not None):
+        # Rows may repeat a day; the run set only cares whether any is left
+        c.execute('''
+            SELECT 1 FROM user_entries
+            WHERE user_id = ? AND data_type = ? AND created_at >= ? AND created_at < ? AND entry_key = ?
+            LIMIT 1
+        ''', (user_id, HABIT_CHECKINS, day.isoformat(), _shift(day, 1), habit_id))
+        if c.fetchone():
+            _add_day(c, user_id, habit_id, day)
+        else:
+            _remove_day(c, user_id, habit_id, day)
+
+
+def _run_containing(c, user_id, habit_id, day):
+    c.execute('''
+        SELECT start_date, end_date FROM habit_runs
+        WHERE user_id = ? AND habit_id = ? AND start_date <= ? AND end_date >= ?
+    ''', (user_id, habit_id, day, day))
+    return c.fetchone()
+
+
+def _add_day(c, user_id, habit_id, day):
+    if _run_containing(c, user_id, habit_id, day.isoformat()):
+        return
+    c.execute('SELECT start_date FROM habit_runs WHERE user_id = ? AND habit_id = ? AND end_date = ?',
+              (user_id, habit_id, _shift(day, -1)))
+    before = c.fetchone()
+    c.execute('SELECT end_date FROM habit_runs WHERE user_id = ? AND habit_id = ? AND start_date = ?',
+              (user_id, habit_id, _shift(day, 1)))
+    after = c.fetchone()
+
+    start = before[0] if before else day.isoformat()
+    end = after[0] if after else day.isoformat()
+    if after:
+        c.execute('DELETE FROM habit_runs WHERE user_id = ? AND habit_id = ? AND start_date = ?',
+                  (user_id, habit_id, _shift(day, 1)))
+    c.execute('INSERT OR REPLACE INTO habit_runs (user_id, habit_id, start_date, end_date) VALUES (?, ?, ?, ?)',
+              (user_id, habit_id, start, end))
+
+
+def _remove_day(c, user_id, habit_id, day):
+    run = _run_containing(c, user_id, habit_id, day.isoformat())
+    if not run:
+        return
+    start, end = run
+    c.execute('DELETE FROM habit_runs WHERE user_id = ? AND habit_id = ? AND start_date = ?',
+              (user_id, habit_id, start))
+    pieces = []
+    if start < day.isoformat():
+        pieces.append((start, _shift(day, -1)))
+    if end > day.isoformat():
+        pieces.append((_shift(day, 1), end))
+    c.executemany('INSERT INTO habit_runs (user_id, habit_id, start_date, end_date) VALUES (?, ?, ?, ?)',
+                  [(user_id, habit_id, s, e) for s, e in pieces])
+
+
+# ============== FULL REBUILD ==============
+
+def rebuild(conn, user_id=None):
+    """Recompute the rollups from ``user_entries`` for one user or everyone.
+
+    Used to backfill databases that predate the rollup tables; normal
+    writes never need it.
+    """
+    c = conn.cursor()
+    create_schema(c)
+    where, params = ('WHERE user_id = ?', (user_id,)) if user_id is not None else ('', ())
+    c.execute(f'DELETE FROM mood_rollups {where}', params)
+    c.execute(f'DELETE FROM habit_runs {where}', params)
+
+    user_clause = 'AND user_id = ?' if user_id is not None else ''
+    c.execute(f'SELECT user_id, data_type, entry_key, created_at, data FROM user_entries '
+              f'WHERE data_type IN (?, ?) {user_clause} ORDER BY user_id, created_at',
+              (MOODS, HABIT_CHECKINS) + params)
+    moods = {}
+    checkins = {}
+    for uid, stored_type, key, created_at, raw in c.fetchall():
+        day = parse_day(created_at)
+        if day is None:
+            continue
+        if stored_type == HABIT_CHECKINS:
+            if key is not None:
+                checkins.setdefault((uid, key), set()).add(day)
+        elif (value := mood_value(json.loads(raw))) is not None:
+            for granularity in GRANULARITIES:
+                bucket = (uid, granularity, bucket_range(granularity, day)[0])
+                count, total, low, high = moods.get(bucket, (0, 0, value, value))
+                moods[bucket] = (count + 1, total + value, min(low, value), max(high, value))
+
+    c.executemany('INSERT INTO mood_rollups (user_id, granularity, bucket, count, total, min_mood, max_mood) '
+                  'VALUES (?, ?, ?, ?, ?, ?, ?)', [key + stats for key, stats in moods.items()])
+    runs = []
+    for (uid, habit_id), days in checkins.items():
+        start = previous = None
+        for day in sorted(days):
+            if previous is None or (day - previous).days > 1:
+                if start is not None:
+                    runs.append((uid, habit_id, start.isoformat(), previous.isoformat()))
+                start = day
+            previous = day
+        runs.append((uid, habit_id, start.isoformat(), previous.isoformat()))
+    c.executemany('INSERT INTO habit_runs (user_id, habit_id, start_date, end_date) VALUES (?, ?, ?, ?)', runs)
+    conn.commit()
+
+
+def backfill(conn):
+    """Build the rollups once for a database whose entries predate them. Returns True if it did."""
+    c = conn.cursor()
+    create_schema(c)
+    c.execute('SELECT (SELECT COUNT(*) FROM mood_rollups) + (SELECT COUNT(*) FROM habit_runs)')
+    if c.fetchone()[0]:
+        return False
+    c.execute('SELECT 1 FROM user_entries WHERE data_type IN (?, ?) LIMIT 1', (MOODS, HABIT_CHECKINS))
+    if not c.fetchone():
+        return False
+    rebuild(conn)
+    return True
+
+
+# ============== QUERIES ==============
+
+def parse_granularity(args):
+    """Granularity from query args (default ``day``); raises ValueError if unknown."""
+    granularity = args.get('granularity', 'day')
+    if granularity not in GRANULARITIES:
+        raise ValueError(f'granularity must be one of {", ".join(GRANULARITIES)}')
+    return granularity
+
+
+def mood_trend(c, user_id, granularity, start=None, end=None):
+    """Mood buckets of one granularity, oldest first.
+
+    ``start``/``end`` are inclusive dates (``YYYY-MM-DD``) matched against
+    each bucket's key, which is its first day (``YYYY-MM`` for months).
+    """
+    clauses = ['user_id = ?', 'granularity = ?']
+    params = [user_id, granularity]
+    if start:
+        clauses.append('bucket >= ?')
+        params.append(start[:7] if granularity == 'month' else start[:10])
+    if end:
+        clauses.append('bucket <= ?')
+        params.append(end[:7] if granularity == 'month' else end[:10])
+    c.execute(f'SELECT bucket, count, total, min_mood, max_mood FROM mood_rollups '
+              f'WHERE {" AND ".join(clauses)} ORDER BY bucket', params)
+    return [{
+        'bucket': bucket,
+        'count': count,
+        'average': round(total / count, 2),
+        'min': low,
+        'max': high,
+    } for bucket, count, total, low, high in c.fetchall()]
+
+
+def habit_streaks(c, user_id, habits, today=None):
+    """Streak summary per habit.
+
+    ``habits`` is the user's habit list (for names and ids). The current
+    streak counts back from today, or from yesterday if today isn't done
+    yet, like the habit tracker page does.
+    """
+    today = today or datetime.datetime.utcnow().date()
+    window_start = today - datetime.timedelta(days=29)
+    c.execute('SELECT habit_id, start_date, end_date FROM habit_runs WHERE user_id = ? ORDER BY start_date',
+              (user_id,))
+    runs = {}
+    for habit_id, start, end in c.fetchall():
+        runs.setdefault(habit_id, []).append((datetime.date.fromisoformat(start), datetime.date.fromisoformat(end)))
+
+    result = []
+    for habit in habits:
+        if not isinstance(habit, dict) or habit.get('id') is None:
+            continue
+        habit_runs = runs.get(str(habit['id']), [])
+        current = 0
+        for start, end in habit_runs:
+            if start <= today and (today - end).days <= 1:
+                current = (min(end, today) - start).days + 1
+        last = habit_runs[-1] if habit_runs else None
+        recent = sum((min(end, today) - max(start, window_start)).days + 1
+                     for start, end in habit_runs if end >= window_start and start <= today)
+        result.append({
+            'habit_id': habit['id'],
+            'name': habit.get('name'),
+            'current_streak': current,
+            'best_streak': max(((end - start).days + 1 for start, end in habit_runs), default=0),
+            'total_days': sum((end - start).days + 1 for start, end in habit_runs),
+            'last_completed': last[1].isoformat() if last else None,
+            'completion_rate_30d': round(recent / 30, 4),
+        })
+    return result
+
+
+def load_habits(c, user_id):
+    """The user's habit list without check-ins (they come from ``habit_runs``)."""
+    c.execute('SELECT data FROM user_data WHERE user_id = ? AND data_type = ?', (user_id, 'habits'))
+    row = c.fetchone()
+    doc = json.loads(row[0]) if row and row[0] else {}
+    return doc.get('habits') or [] if isinstance(doc, dict) else []
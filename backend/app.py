@@ -1,28 +1,101 @@
 import os
 import sys
+import time
+import traceback
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_jwt_extended import (JWTManager, create_access_token, jwt_required, get_jwt_identity, get_jwt,
+                                current_user)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.wsgi import wrap_file
 from dotenv import load_dotenv
 
+import analytics
+import batch
+import changefeed
+import compress
+import dbpool
+import doccache
+import entries
+import metrics
+import migrations
+import passwords
+import patches
+import petmodel
+import reminders
+import search
+import static
+import tokencache
+import transfer
+
 load_dotenv()
 
-app = Flask(__name__, static_folder='../dist', static_url_path='')
+# The frontend build is served by the routes under STATIC FILES (see static.py)
+app = Flask(__name__, static_folder=None)
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dist')
 
 # Configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///calmora.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.getenv('CALMORA_DB_PATH', 'calmora.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {**dbpool.CONNECT_ARGS, 'factory': dbpool.TimedConnection}}
+# EventSource can't set headers; /api/changes/stream also reads ?access_token=
+app.config['JWT_QUERY_STRING_NAME'] = 'access_token'
 app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY', 'calmora-secret-key-change-in-production')
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(days=7)
 
+# Same WAL/busy-timeout/mmap settings as server.py (see dbpool.py)
+@event.listens_for(Engine, 'connect')
+def configure_sqlite(dbapi_connection, connection_record):
+    dbpool.configure_connection(dbapi_connection)
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Counts encoding and decoding towards the request's json stage (see metrics.py)"""
+    
+    def dumps(self, obj, **kwargs):
+        with metrics.stage('json'):
+            return super().dumps(obj, **kwargs)
+    
+    def loads(self, s, **kwargs):
+        with metrics.stage('json'):
+            return super().loads(s, **kwargs)
+
+app.json = TimedJSONProvider(app)
+
 # Initialize
 db = SQLAlchemy(app)
-CORS(app)
+CORS(app, expose_headers=['ETag'])
 jwt = JWTManager(app)
 
+# Accept gzip request bodies; imports are decompressed as they are read (see compress.py)
+app.wsgi_app = compress.DecompressRequests(app.wsgi_app, streamed_paths=('/api/data/import',))
+
+# Per-route timings for /metrics, outermost so they include decompression and writing
+app.wsgi_app = metrics.WSGIMetrics(app.wsgi_app)
+
+# Parsed documents and encoded responses, keyed by document version (see doccache.py)
+doc_cache = doccache.DocumentCache()
+
+# Manifest of the frontend build, scanned once at start-up (see static.py)
+static_files = static.StaticFiles(STATIC_DIR)
+
+# Tokens that passed the revocation check recently (see tokencache.py)
+token_cache = tokencache.TokenCache()
+
+def connect_background():
+    """Standalone connection for the change feed and reminder threads"""
+    with app.app_context():
+        return dbpool.connect(db.engine.url.database)
+
+# Pushes document changes to /api/changes/stream clients (see changefeed.py)
+change_feed = changefeed.ChangeFeed(connect_background)
+
+# Fires due reminders, started with the first request (see reminders.py)
+reminder_scheduler = reminders.Scheduler(connect_background)
+
 # ============== MODELS ==============
 
 class User(db.Model):
@@ -38,11 +111,24 @@ class User(db.Model):
     # User data (stored as JSON for flexibility)
     profile_data = db.Column(db.JSON, default=dict)
     
+    # Bumped on password change to revoke every token issued before it
+    token_version = db.Column(db.Integer, nullable=False, default=0)
+    
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        """Hashed in the password pool (see passwords.py); may raise passwords.Overloaded"""
+        self.password_hash = passwords.hash_password(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """Also accepts server.py's legacy SHA-256 hashes, upgrading them once they match"""
+        if not passwords.verify_password(password, self.password_hash):
+            return False
+        if passwords.needs_rehash(self.password_hash):
+            try:
+                self.set_password(password)
+            except passwords.Overloaded:
+                return True
+            db.session.commit()
+        return True
     
     def to_dict(self):
         return {
@@ -55,11 +141,16 @@ class User(db.Model):
 
 class UserData(db.Model):
     __tablename__ = 'user_data'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'data_type'),
+        db.Index('idx_user_data_user_version', 'user_id', 'version'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     data_type = db.Column(db.String(50), nullable=False)  # pet, habits, moods, journal, etc.
     data = db.Column(db.JSON, default=dict)
+    version = db.Column(db.Integer, nullable=False, default=0)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     user = db.relationship('User', backref=db.backref('data', lazy=True))
@@ -70,9 +161,310 @@ class UserData(db.Model):
             'user_id': self.user_id,
             'data_type': self.data_type,
             'data': self.data,
+            'version': self.version,
             'updated_at': self.updated_at.isoformat()
         }
 
+class RevokedToken(db.Model):
+    """A logged-out token, kept until it would have expired anyway"""
+    __tablename__ = 'revoked_tokens'
+    __table_args__ = (
+        db.Index('idx_revoked_tokens_expires', 'expires_at'),
+    )
+    
+    jti = db.Column(db.String(64), primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    expires_at = db.Column(db.Float, nullable=False)
+
+class UserEntry(db.Model):
+    """One mood, journal entry or habit check-in (see entries.py)"""
+    __tablename__ = 'user_entries'
+    __table_args__ = (
+        db.Index('idx_user_entries_user_created', 'user_id', 'data_type', 'created_at'),
+        db.Index('idx_user_entries_user_key', 'user_id', 'data_type', 'entry_key'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    data_type = db.Column(db.String(50), nullable=False)  # moods, journal, habit_checkins
+    entry_key = db.Column(db.String(64))
+    created_at = db.Column(db.String(40), nullable=False)
+    data = db.Column(db.JSON, nullable=False)
+
+# ============== TOKENS ==============
+
+def issue_token(user):
+    return create_access_token(identity=user.id, additional_claims={'tv': user.token_version})
+
+@jwt.token_in_blocklist_loader
+def token_revoked(jwt_header, jwt_payload):
+    """Runs on every @jwt_required request; a dict lookup once the token is cached"""
+    with metrics.stage('auth'):
+        jti = jwt_payload['jti']
+        user_id = jwt_payload['sub']
+        if token_cache.get(jti) is not None:
+            return False
+        
+        token_version = db.session.query(User.token_version).filter_by(id=user_id).scalar()
+        if token_version is None or token_version != jwt_payload.get('tv', 0):
+            return True
+        if db.session.get(RevokedToken, jti):
+            return True
+        token_cache.put(jti, user_id, jwt_payload['exp'])
+        return False
+
+@jwt.user_lookup_loader
+def load_current_user(jwt_header, jwt_payload):
+    """User behind the request's token, loaded at most once per request via current_user"""
+    return db.session.get(User, jwt_payload['sub'])
+
+# ============== DOCUMENT STORAGE ==============
+
+def load_entries(user_id, data_type, start=None, end=None):
+    query = UserEntry.query.filter_by(user_id=user_id, data_type=entries.entry_type(data_type))
+    if start:
+        query = query.filter(UserEntry.created_at >= start)
+    if end:
+        query = query.filter(UserEntry.created_at <= end)
+    if data_type == entries.HABITS:
+        query = query.order_by(UserEntry.id)
+    else:
+        query = query.order_by(UserEntry.created_at.desc(), UserEntry.id.desc())
+    return [entry.data for entry in query.all()]
+
+def query_entries(user_id, data_type, page):
+    """One page of mood/journal entries, newest first, plus paging info"""
+    query = UserEntry.query.filter_by(user_id=user_id, data_type=data_type)
+    if page['from']:
+        query = query.filter(UserEntry.created_at >= page['from'])
+    if page['to']:
+        query = query.filter(UserEntry.created_at <= page['to'])
+    if page['before']:
+        created_at, row_id = page['before']
+        query = query.filter(db.or_(
+            UserEntry.created_at < created_at,
+            db.and_(UserEntry.created_at == created_at, UserEntry.id < row_id)
+        ))
+    if page['after']:
+        created_at, row_id = page['after']
+        query = query.filter(db.or_(
+            UserEntry.created_at > created_at,
+            db.and_(UserEntry.created_at == created_at, UserEntry.id > row_id)
+        ))
+    
+    ascending = page['after'] is not None and page['before'] is None
+    if ascending:
+        query = query.order_by(UserEntry.created_at.asc(), UserEntry.id.asc())
+    else:
+        query = query.order_by(UserEntry.created_at.desc(), UserEntry.id.desc())
+    if page['limit']:
+        query = query.limit(page['limit'] + 1)
+    
+    rows = [(entry.id, entry.created_at, entry.data) for entry in query.all()]
+    return entries.paginate_rows(rows, page, ascending)
+
+def query_document(user_data, page):
+    """Document for a UserData row with only one page of its entries"""
+    data_type = user_data.data_type
+    if data_type in entries.ENTRY_TYPES:
+        items, paging = query_entries(user_data.user_id, data_type, page)
+        return entries.assemble_document(data_type, user_data.data, items), paging
+    if data_type == entries.HABITS:
+        # Date filters apply to check-ins, cursors to the habit list itself
+        checkins = load_entries(user_data.user_id, data_type, page['from'], page['to'])
+        doc = entries.assemble_document(data_type, user_data.data, checkins)
+        doc['habits'], paging = entries.paginate_list(doc['habits'], page)
+        return doc, paging
+    return user_data.data, None
+
+def page_args():
+    """Pagination query args of the current request, or None if absent"""
+    return entries.parse_page_args(request.args)
+
+def load_document(user_data):
+    """Full document for a UserData row, with its entry rows merged back in"""
+    if user_data.data_type not in entries.ROW_BACKED_TYPES:
+        return user_data.data
+    return entries.assemble_document(
+        user_data.data_type, user_data.data, load_entries(user_data.user_id, user_data.data_type))
+
+def raw_cursor():
+    """DB-API cursor in the session's transaction, for SQL helpers shared with server.py"""
+    db.session.flush()
+    return db.session.connection().connection.cursor()
+
+def begin_write():
+    """Take the write lock before reading what a write depends on, as server.py's run_write does
+
+    pysqlite only begins a transaction at the first write, so a version
+    checked or a document read before then may be stale by the commit.
+    """
+    conn = db.session.connection().connection.driver_connection
+    if not conn.in_transaction:
+        conn.execute('BEGIN IMMEDIATE')
+    # Rows loaded earlier in the session (say by a batch's GETs) may predate the lock
+    db.session.expire_all()
+
+def store_document(user_id, data_type, doc):
+    """Replace a whole document, writing its entries as rows. Caller commits."""
+    base, rows = entries.split_document(data_type, doc)
+    
+    data = UserData.query.filter_by(user_id=user_id, data_type=data_type).first()
+    if data:
+        data.data = base
+    else:
+        data = UserData(user_id=user_id, data_type=data_type, data=base)
+        db.session.add(data)
+    bump_version(data)
+    
+    if data_type in entries.ROW_BACKED_TYPES:
+        # Only touch the entry rows that actually changed
+        stored_type = entries.entry_type(data_type)
+        existing = UserEntry.query.filter_by(user_id=user_id, data_type=stored_type).all()
+        delete_ids, inserts = entries.diff_rows(
+            [(e.id, e.entry_key, e.created_at, e.data) for e in existing], rows)
+        if delete_ids:
+            UserEntry.query.filter(UserEntry.id.in_(delete_ids)).delete(synchronize_session='evaluate')
+        db.session.add_all([
+            UserEntry(user_id=user_id, data_type=stored_type, entry_key=key, created_at=created_at, data=payload)
+            for key, created_at, payload in inserts
+        ])
+        deleted = set(delete_ids)
+        removed = [(e.entry_key, e.created_at, e.data) for e in existing if e.id in deleted]
+        analytics.record_changes(raw_cursor(), user_id, stored_type, removed, inserts)
+    
+    return data
+
+# ============== VERSIONS ==============
+
+def bump_version(data):
+    """Give a UserData row the next version in its user's sequence (see entries.py)"""
+    data.version = db.select(
+        db.func.coalesce(db.func.max(UserData.version), 0) + 1
+    ).where(UserData.user_id == data.user_id).scalar_subquery()
+
+def document_version(user_id, data_type):
+    """Version of one document without loading it, or None if it doesn't exist"""
+    return db.session.query(UserData.version).filter_by(user_id=user_id, data_type=data_type).scalar()
+
+def user_version(user_id):
+    """Highest document version of a user; changes whenever any document does"""
+    version = db.session.query(db.func.max(UserData.version)).filter_by(user_id=user_id).scalar()
+    return version or 0
+
+def versioned(response, version):
+    if version is not None:
+        response.set_etag(str(version))
+    return response
+
+def not_modified(version):
+    """True if the request's If-None-Match already names this version"""
+    return version is not None and request.if_none_match.contains_weak(str(version))
+
+def version_conflict(version):
+    """409 response if If-Match names a stale version, otherwise None"""
+    if not request.if_match or (version is not None and request.if_match.contains(str(version))):
+        return None
+    return versioned(jsonify({'error': 'Version conflict', 'version': version}), version), 409
+
+# ============== RESPONSE CACHE ==============
+
+def cached_response(user_id, data_type, version, view, build):
+    """Response for a document version, reusing the body cached for it if any
+
+    Compressed bodies are cached too, once per version and encoding.
+    """
+    cached = doc_cache.get(user_id, data_type, version, view)
+    cacheable = True
+    if cached is not None:
+        body = cached[1]
+    else:
+        payload = build()
+        body = app.json.dumps(payload).encode()
+        # Reads here aren't one snapshot; only cache if no write landed meanwhile
+        current = user_version(user_id) if data_type == doccache.ALL_TYPES else document_version(user_id, data_type)
+        cacheable = current == version
+        if cacheable:
+            doc_cache.put(user_id, data_type, version, view, payload, body)
+    
+    encoding = compress.negotiate(request.headers.get('Accept-Encoding'), len(body))
+    if encoding:
+        encoded_view = f'{view}:{encoding}'
+        cached = doc_cache.get(user_id, data_type, version, encoded_view)
+        if cached is not None:
+            body = cached[1]
+        else:
+            body = compress.compress(body, encoding)
+            if cacheable:
+                doc_cache.put(user_id, data_type, version, encoded_view, None, body)
+    response = app.response_class(body, mimetype=app.json.mimetype)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return versioned(response, version)
+
+@app.before_request
+def record_route():
+    """Label the request's metrics with its route rule, not its path"""
+    request.environ['calmora.route'] = request.url_rule.rule if request.url_rule else None
+
+@app.before_request
+def start_reminders():
+    """Start the reminder thread in whichever process ends up serving (a no-op once running)"""
+    if reminders.ENABLED:
+        reminder_scheduler.start()
+
+@app.after_request
+def compress_response(response):
+    """Compress other large JSON responses the client accepts compressed"""
+    if (response.is_streamed or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or response.mimetype != app.json.mimetype or response.status_code in (204, 304)):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    encoding = compress.negotiate(request.headers.get('Accept-Encoding'), len(body))
+    if encoding:
+        response.set_data(compress.compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+def document_changed(user_id, data_type=None):
+    """Call after a write commits: drops stale cached responses and wakes change streams"""
+    doc_cache.invalidate(user_id, data_type)
+    change_feed.notify(user_id)
+
+def cached_document(user_data):
+    """Full document for a UserData row, from the cache when this version is in it"""
+    cached = doc_cache.get(user_data.user_id, user_data.data_type, user_data.version, 'data')
+    return cached[0]['data'] if cached else load_document(user_data)
+
+# ============== HEALTH ==============
+
+@app.route('/api/health', methods=['GET'])
+def health():
+    return jsonify({
+        'status': 'ok',
+        'message': 'Calmora API is running',
+        'cache': doc_cache.snapshot(),
+        'tokens': token_cache.snapshot(),
+        'changes': change_feed.snapshot(),
+        'static': static_files.snapshot(),
+        'passwords': passwords.hasher.snapshot(),
+        'reminders': reminder_scheduler.snapshot()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics of this process (see metrics.py)"""
+    if not metrics.authorized(request.headers.get('Authorization')):
+        return jsonify({'error': 'Unauthorized'}), 401
+    extra = metrics.snapshot_families('calmora_doc_cache', 'Document cache', doc_cache.snapshot())
+    extra += metrics.snapshot_families('calmora_token_cache', 'Token cache', token_cache.snapshot())
+    extra += metrics.snapshot_families('calmora_change_feed', 'Change feed', change_feed.snapshot())
+    extra += metrics.snapshot_families('calmora_password_hashing', 'Password hashing', passwords.hasher.snapshot())
+    extra += metrics.snapshot_families('calmora_reminders', 'Reminders', reminder_scheduler.snapshot())
+    return app.response_class(metrics.registry.render(extra), content_type=metrics.CONTENT_TYPE)
+
 # ============== AUTH ROUTES ==============
 
 @app.route('/api/auth/register', methods=['POST'])
@@ -116,7 +508,7 @@ def register():
     db.session.commit()
     
     # Generate token
-    access_token = create_access_token(identity=user.id)
+    access_token = issue_token(user)
     
     return jsonify({
         'message': 'User registered successfully',
@@ -139,7 +531,7 @@ def login():
     if not user or not user.check_password(password):
         return jsonify({'error': 'Invalid username or password'}), 401
     
-    access_token = create_access_token(identity=user.id)
+    access_token = issue_token(user)
     
     return jsonify({
         'message': 'Login successful',
@@ -150,8 +542,7 @@ def login():
 @app.route('/api/auth/me', methods=['GET'])
 @jwt_required()
 def get_current_user():
-    user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+    user = current_user
     
     if not user:
         return jsonify({'error': 'User not found'}), 404
@@ -161,8 +552,7 @@ def get_current_user():
 @app.route('/api/auth/update-profile', methods=['PUT'])
 @jwt_required()
 def update_profile():
-    user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+    user = current_user
     
     if not user:
         return jsonify({'error': 'User not found'}), 404
@@ -180,6 +570,42 @@ def update_profile():
     
     return jsonify({'user': user.to_dict()}), 200
 
+@app.route('/api/auth/change-password', methods=['PUT'])
+@jwt_required()
+def change_password():
+    user = current_user
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+    
+    data = request.get_json()
+    new_password = data.get('new_password', '')
+    if len(new_password) < 6:
+        return jsonify({'error': 'Password must be at least 6 characters'}), 400
+    if not user.check_password(data.get('current_password', '')):
+        return jsonify({'error': 'Current password is incorrect'}), 401
+    
+    user.set_password(new_password)
+    # Every token issued before now stops working
+    user.token_version += 1
+    db.session.commit()
+    token_cache.forget_user(user.id)
+    
+    return jsonify({
+        'message': 'Password changed successfully',
+        'access_token': issue_token(user)
+    }), 200
+
+@app.route('/api/auth/logout', methods=['POST'])
+@jwt_required()
+def logout():
+    token = get_jwt()
+    RevokedToken.query.filter(RevokedToken.expires_at < datetime.now().timestamp()).delete()
+    db.session.add(RevokedToken(jti=token['jti'], user_id=token['sub'], expires_at=token['exp']))
+    db.session.commit()
+    token_cache.forget(token['jti'])
+    
+    return jsonify({'message': 'Logged out successfully'}), 200
+
 # ============== DATA SYNC ROUTES ==============
 
 @app.route('/api/data/<data_type>', methods=['GET'])
@@ -187,12 +613,30 @@ def update_profile():
 def get_data(data_type):
     user_id = get_jwt_identity()
     
-    data = UserData.query.filter_by(user_id=user_id, data_type=data_type).first()
+    try:
+        page = page_args()
+    except ValueError:
+        return jsonify({'error': 'Invalid pagination parameters'}), 400
     
-    if not data:
+    version = document_version(user_id, data_type)
+    
+    if version is None:
         return jsonify({'error': 'Data type not found'}), 404
     
-    return jsonify({'data': data.data}), 200
+    if not_modified(version):
+        return versioned(app.response_class(status=304), version)
+    
+    if page:
+        data = UserData.query.filter_by(user_id=user_id, data_type=data_type).first()
+        doc, paging = query_document(data, page)
+        if paging:
+            return versioned(jsonify({'data': doc, 'paging': paging}), data.version), 200
+        return versioned(jsonify({'data': doc}), data.version), 200
+    
+    def build():
+        data = UserData.query.filter_by(user_id=user_id, data_type=data_type).first()
+        return {'data': load_document(data) if data else None}
+    return cached_response(user_id, data_type, version, 'data', build), 200
 
 @app.route('/api/data/<data_type>', methods=['PUT'])
 @jwt_required()
@@ -200,19 +644,54 @@ def update_data(data_type):
     user_id = get_jwt_identity()
     incoming_data = request.get_json()
     
-    data = UserData.query.filter_by(user_id=user_id, data_type=data_type).first()
+    begin_write()
+    existing = UserData.query.filter_by(user_id=user_id, data_type=data_type).first()
+    conflict = version_conflict(existing.version if existing else None)
+    if conflict:
+        return conflict
     
-    if not data:
-        # Create new data entry
-        data = UserData(user_id=user_id, data_type=data_type, data=incoming_data)
-        db.session.add(data)
-    else:
-        # Update existing data
-        data.data = incoming_data
+    data = store_document(user_id, data_type, incoming_data)
+    db.session.commit()
+    document_changed(user_id, data_type)
+    
+    return versioned(jsonify({
+        'data': incoming_data,
+        'updated_at': data.updated_at.isoformat(),
+        'version': data.version
+    }), data.version), 200
+
+@app.route('/api/data/<data_type>', methods=['PATCH'])
+@jwt_required()
+def patch_data(data_type):
+    """Apply a JSON Patch or merge patch to one document"""
+    user_id = get_jwt_identity()
+    body = request.get_json(force=True, silent=True)
+    if body is None:
+        return jsonify({'error': 'Invalid JSON'}), 400
+    
+    # Read, patch and write in one transaction so concurrent patches can't interleave
+    begin_write()
+    existing = UserData.query.filter_by(user_id=user_id, data_type=data_type).first()
+    conflict = version_conflict(existing.version if existing else None)
+    if conflict:
+        return conflict
+    
+    doc = cached_document(existing) if existing else {}
+    try:
+        patched = patches.apply_patch(doc, body, request.content_type)
+    except patches.PatchError as e:
+        return jsonify({'error': str(e)}), 422
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
+    data = store_document(user_id, data_type, patched)
     db.session.commit()
+    document_changed(user_id, data_type)
     
-    return jsonify({'data': data.data, 'updated_at': data.updated_at.isoformat()}), 200
+    if entries.wants_minimal_response(request.headers, request.args):
+        return versioned(jsonify({'version': data.version}), data.version), 200
+    
+    return versioned(jsonify({'data': patched, 'version': data.version}), data.version), 200
 
 @app.route('/api/data/<data_type>/merge', methods=['POST'])
 @jwt_required()
@@ -221,34 +700,50 @@ def merge_data(data_type):
     user_id = get_jwt_identity()
     incoming_data = request.get_json()
     
+    begin_write()
     data = UserData.query.filter_by(user_id=user_id, data_type=data_type).first()
     
     if not data:
-        data = UserData(user_id=user_id, data_type=data_type, data=incoming_data)
-        db.session.add(data)
+        merged = incoming_data
     else:
         # Simple merge: incoming data takes precedence
         # Can be customized per data type
-        existing = data.data
+        existing = cached_document(data)
         merged = {**existing, **incoming_data}
-        data.data = merged
     
+    data = store_document(user_id, data_type, merged)
     db.session.commit()
+    document_changed(user_id, data_type)
     
-    return jsonify({'data': data.data}), 200
+    return versioned(jsonify({'data': merged, 'version': data.version}), data.version), 200
 
 @app.route('/api/data/bulk', methods=['GET'])
 @jwt_required()
 def get_all_data():
     user_id = get_jwt_identity()
     
-    all_data = UserData.query.filter_by(user_id=user_id).all()
+    version = user_version(user_id)
+    if not_modified(version):
+        return versioned(app.response_class(status=304), version)
+    
+    since = request.args.get('since')
+    if since is not None and not since.isdigit():
+        return jsonify({'error': 'Invalid since version'}), 400
     
-    result = {}
-    for item in all_data:
-        result[item.data_type] = item.data
+    def build():
+        query = UserData.query.filter_by(user_id=user_id)
+        if since:
+            # Delta sync: only documents changed after the client's last version
+            query = query.filter(UserData.version > int(since))
+        
+        result = {}
+        for item in query.all():
+            result[item.data_type] = load_document(item)
+        return {'data': result, 'version': version}
     
-    return jsonify({'data': result}), 200
+    if since:
+        return versioned(jsonify(build()), version), 200
+    return cached_response(user_id, doccache.ALL_TYPES, version, 'bulk', build), 200
 
 @app.route('/api/data/bulk', methods=['PUT'])
 @jwt_required()
@@ -256,18 +751,75 @@ def update_all_data():
     user_id = get_jwt_identity()
     incoming_data = request.get_json()
     
+    begin_write()
+    conflict = version_conflict(user_version(user_id))
+    if conflict:
+        return conflict
+    
     for data_type, data in incoming_data.items():
-        existing = UserData.query.filter_by(user_id=user_id, data_type=data_type).first()
-        
-        if existing:
-            existing.data = data
-        else:
-            new_data = UserData(user_id=user_id, data_type=data_type, data=data)
-            db.session.add(new_data)
+        store_document(user_id, data_type, data)
     
     db.session.commit()
+    document_changed(user_id)
+    
+    version = user_version(user_id)
+    return versioned(jsonify({'message': 'All data updated successfully', 'version': version}), version), 200
+
+@app.route('/api/data/export', methods=['GET'])
+@jwt_required()
+def export_data():
+    """Stream all of the user's data as NDJSON (see transfer.py)"""
+    user_id = get_jwt_identity()
+    chunks = transfer.export_chunks(raw_cursor(), user_id)
+    response = app.response_class(stream_with_context(chunks), mimetype=transfer.NDJSON)
+    response.headers['Content-Disposition'] = f'attachment; filename="{transfer.export_filename()}"'
+    return response
+
+@app.route('/api/data/import', methods=['POST'])
+@jwt_required()
+def import_data():
+    """Write an NDJSON import a batch at a time, streaming progress back (see transfer.py)"""
+    user_id = get_jwt_identity()
+    
+    def write_batch(records):
+        try:
+            touched = transfer.apply_batch(raw_cursor(), user_id, records)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        for data_type in touched:
+            document_changed(user_id, data_type)
+    
+    progress = transfer.import_records(transfer.read_lines(request.stream), write_batch)
+    return app.response_class(stream_with_context(transfer.progress_lines(progress)), mimetype=transfer.NDJSON)
+
+@app.route('/api/batch', methods=['POST'])
+@jwt_required()
+def run_batch():
+    """Run several GET/PUT/PATCH requests in one round trip (see batch.py)"""
+    try:
+        operations = batch.parse_batch(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    return jsonify({'message': 'All data updated successfully'}), 200
+    authorization = request.headers.get('Authorization')
+    responses = []
+    for op_id, method, path, headers, body in operations:
+        path, _, query = path.partition('?')
+        # Nested in this request's app context, so every sub-request shares its DB session
+        with app.test_request_context(path, method=method, query_string=query, json=body,
+                                      headers={'Authorization': authorization, **headers}):
+            try:
+                response = app.full_dispatch_request()
+            except Exception:
+                # As server.py's map_errors: the traceback goes to the log, not the client
+                traceback.print_exc()
+                db.session.rollback()
+                response = jsonify({'error': 'Internal server error'})
+                response.status_code = 500
+        responses.append(batch.encode_response(op_id, response.status_code, response.headers, response.get_data()))
+    return app.response_class(batch.encode_batch(responses), mimetype='application/json')
 
 # ============== SPECIFIC DATA ROUTES ==============
 
@@ -275,35 +827,89 @@ def update_all_data():
 @app.route('/api/pet', methods=['GET'])
 @jwt_required()
 def get_pet():
+    """Evaluated as of now (see petmodel.py), so never answered with 304"""
     user_id = get_jwt_identity()
     data = UserData.query.filter_by(user_id=user_id, data_type='pet').first()
-    return jsonify({'pet': data.data if data else {}}), 200
+    version = data.version if data else None
+    pet = petmodel.evaluate(data.data if data else {}, time.time())
+    response = versioned(jsonify({'pet': pet, 'version': version}), version)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response, 200
 
 @app.route('/api/pet', methods=['PUT'])
 @jwt_required()
 def update_pet():
     user_id = get_jwt_identity()
     pet_data = request.get_json()
+    if isinstance(pet_data, dict):
+        # Decay restarts from the stats the client sent
+        pet_data = petmodel.stamp(pet_data, time.time())
     
-    data = UserData.query.filter_by(user_id=user_id, data_type='pet').first()
+    begin_write()
+    existing = UserData.query.filter_by(user_id=user_id, data_type='pet').first()
+    conflict = version_conflict(existing.version if existing else None)
+    if conflict:
+        return conflict
     
-    if data:
-        data.data = pet_data
-    else:
-        data = UserData(user_id=user_id, data_type='pet', data=pet_data)
-        db.session.add(data)
+    data = store_document(user_id, 'pet', pet_data)
+    db.session.commit()
+    document_changed(user_id, 'pet')
+    
+    return versioned(jsonify({'pet': data.data, 'version': data.version}), data.version), 200
+
+@app.route('/api/pet/actions', methods=['POST'])
+@jwt_required()
+def pet_action():
+    """Feed, play, rest, train or bathe the pet, applied to its state as of now"""
+    user_id = get_jwt_identity()
+    body = request.get_json(silent=True)
+    action = body.get('action') if isinstance(body, dict) else None
     
+    # Otherwise concurrent actions each start from the same pet and all but one are lost
+    begin_write()
+    existing = UserData.query.filter_by(user_id=user_id, data_type='pet').first()
+    conflict = version_conflict(existing.version if existing else None)
+    if conflict:
+        return conflict
+    try:
+        pet, message = petmodel.apply_action(existing.data if existing else {}, action, time.time())
+    except petmodel.PetActionError as e:
+        return jsonify({'error': str(e)}), 409
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    data = store_document(user_id, 'pet', pet)
     db.session.commit()
+    document_changed(user_id, 'pet')
     
-    return jsonify({'pet': data.data}), 200
+    return versioned(jsonify({'pet': data.data, 'message': message, 'version': data.version}), data.version), 200
 
 # Habits
 @app.route('/api/habits', methods=['GET'])
 @jwt_required()
 def get_habits():
     user_id = get_jwt_identity()
-    data = UserData.query.filter_by(user_id=user_id, data_type='habits').first()
-    return jsonify({'habits': data.data.get('habits', []) if data else []}), 200
+    try:
+        page = page_args()
+    except ValueError:
+        return jsonify({'error': 'Invalid pagination parameters'}), 400
+    
+    version = document_version(user_id, 'habits')
+    if not_modified(version):
+        return versioned(app.response_class(status=304), version)
+    
+    def load():
+        return UserData.query.filter_by(user_id=user_id, data_type='habits').first()
+    
+    if page:
+        data = load()
+        habits, paging = query_document(data, page) if data else ({}, None)
+        return versioned(jsonify({'habits': habits.get('habits', []), 'paging': paging}), version), 200
+    
+    def build():
+        data = load()
+        return {'habits': load_document(data).get('habits', []) if data else []}
+    return cached_response(user_id, 'habits', version, 'habits', build), 200
 
 @app.route('/api/habits', methods=['PUT'])
 @jwt_required()
@@ -311,25 +917,38 @@ def update_habits():
     user_id = get_jwt_identity()
     habits_data = request.get_json()
     
-    data = UserData.query.filter_by(user_id=user_id, data_type='habits').first()
-    
-    if data:
-        data.data = {'habits': habits_data}
-    else:
-        data = UserData(user_id=user_id, data_type='habits', data={'habits': habits_data})
-        db.session.add(data)
+    begin_write()
+    existing = UserData.query.filter_by(user_id=user_id, data_type='habits').first()
+    conflict = version_conflict(existing.version if existing else None)
+    if conflict:
+        return conflict
     
+    data = store_document(user_id, 'habits', {'habits': habits_data})
     db.session.commit()
+    document_changed(user_id, 'habits')
     
-    return jsonify({'habits': data.data['habits']}), 200
+    return versioned(jsonify({'habits': habits_data, 'version': data.version}), data.version), 200
 
 # Moods
 @app.route('/api/moods', methods=['GET'])
 @jwt_required()
 def get_moods():
     user_id = get_jwt_identity()
-    data = UserData.query.filter_by(user_id=user_id, data_type='moods').first()
-    return jsonify({'moods': data.data.get('moods', []) if data else []}), 200
+    try:
+        page = page_args()
+    except ValueError:
+        return jsonify({'error': 'Invalid pagination parameters'}), 400
+    
+    version = document_version(user_id, 'moods')
+    if not_modified(version):
+        return versioned(app.response_class(status=304), version)
+    
+    if page:
+        moods, paging = query_entries(user_id, 'moods', page)
+        return versioned(jsonify({'moods': moods, 'paging': paging}), version), 200
+    
+    return cached_response(user_id, 'moods', version, 'moods',
+                           lambda: {'moods': load_entries(user_id, 'moods')}), 200
 
 @app.route('/api/moods', methods=['POST'])
 @jwt_required()
@@ -338,44 +957,241 @@ def add_mood():
     new_mood = request.get_json()
     
     data = UserData.query.filter_by(user_id=user_id, data_type='moods').first()
-    
-    if data:
-        moods = data.data.get('moods', [])
-        moods.insert(0, new_mood)
-        data.data['moods'] = moods
-    else:
-        data = UserData(user_id=user_id, data_type='moods', data={'moods': [new_mood]})
+    if not data:
+        data = UserData(user_id=user_id, data_type='moods', data={})
         db.session.add(data)
     
+    # One INSERT, independent of how many moods the user already has
+    entry = UserEntry(
+        user_id=user_id,
+        data_type='moods',
+        entry_key=entries.entry_key(new_mood),
+        created_at=entries.entry_created_at('moods', new_mood),
+        data=new_mood
+    )
+    db.session.add(entry)
+    analytics.record_changes(raw_cursor(), user_id, 'moods', [], [(entry.entry_key, entry.created_at, new_mood)])
+    bump_version(data)
+    db.session.commit()
+    document_changed(user_id, 'moods')
+    
+    if entries.wants_minimal_response(request.headers, request.args):
+        return versioned(jsonify({'mood': new_mood, 'version': data.version}), data.version), 201
+    
+    moods = load_entries(user_id, 'moods')
+    return versioned(jsonify({'mood': new_mood, 'moods': moods, 'version': data.version}), data.version), 201
+
+# ============== JOURNAL SEARCH ==============
+
+@app.route('/api/journal/search', methods=['GET'])
+@jwt_required()
+def search_journal():
+    """Full-text search over the user's journal, best matches first"""
+    user_id = get_jwt_identity()
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Missing search query'}), 400
+    try:
+        page = page_args()
+    except ValueError:
+        return jsonify({'error': 'Invalid pagination parameters'}), 400
+    
+    version = document_version(user_id, 'journal')
+    if not_modified(version):
+        return versioned(app.response_class(status=304), version)
+    
+    results, paging = search.search_journal(raw_cursor(), user_id, query, page)
+    return versioned(jsonify({'results': results, 'paging': paging}), version), 200
+
+# ============== ANALYTICS ==============
+
+@app.route('/api/analytics/moods', methods=['GET'])
+@jwt_required()
+def mood_analytics():
+    """Mood count/average/min/max per day, week or month"""
+    user_id = get_jwt_identity()
+    try:
+        granularity = analytics.parse_granularity(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    version = document_version(user_id, 'moods')
+    if not_modified(version):
+        return versioned(app.response_class(status=304), version)
+    
+    buckets = analytics.mood_trend(raw_cursor(), user_id, granularity, request.args.get('from'), request.args.get('to'))
+    return versioned(jsonify({'granularity': granularity, 'buckets': buckets}), version), 200
+
+@app.route('/api/analytics/habits/streaks', methods=['GET'])
+@jwt_required()
+def habit_streaks():
+    """Current/best streak, total days and 30-day completion rate per habit"""
+    user_id = get_jwt_identity()
+    today = request.args.get('today')
+    if today is not None and analytics.parse_day(today) is None:
+        return jsonify({'error': 'Invalid today date'}), 400
+    
+    data = UserData.query.filter_by(user_id=user_id, data_type='habits').first()
+    habits = (data.data or {}).get('habits') or [] if data else []
+    streaks = analytics.habit_streaks(raw_cursor(), user_id, habits, analytics.parse_day(today))
+    return jsonify({'habits': streaks}), 200
+
+# ============== REMINDERS ==============
+
+@app.route('/api/reminders', methods=['GET'])
+@jwt_required()
+def list_reminders():
+    """The user's reminders with their next firing times"""
+    return jsonify({'reminders': reminders.list_reminders(raw_cursor(), get_jwt_identity())}), 200
+
+@app.route('/api/reminders', methods=['POST'])
+@jwt_required()
+def create_reminder():
+    """Add a reminder: title, time (HH:MM), and optionally body, kind, timezone, days, enabled"""
+    user_id = get_jwt_identity()
+    try:
+        reminder, next_fire_at = reminders.create_reminder(raw_cursor(), user_id, request.get_json(silent=True),
+                                                           time.time())
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    db.session.commit()
+    reminder_scheduler.schedule(reminder['id'], next_fire_at)
+    return jsonify({'reminder': reminder}), 201
+
+@app.route('/api/reminders/<int:reminder_id>', methods=['PUT'])
+@jwt_required()
+def update_reminder(reminder_id):
+    """Change some of a reminder's fields; its next firing is worked out again"""
+    user_id = get_jwt_identity()
+    try:
+        updated = reminders.update_reminder(raw_cursor(), user_id, reminder_id, request.get_json(silent=True),
+                                            time.time())
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    if updated is None:
+        return jsonify({'error': 'Reminder not found'}), 404
+    db.session.commit()
+    reminder, next_fire_at = updated
+    reminder_scheduler.schedule(reminder['id'], next_fire_at)
+    return jsonify({'reminder': reminder}), 200
+
+@app.route('/api/reminders/<int:reminder_id>', methods=['DELETE'])
+@jwt_required()
+def delete_reminder(reminder_id):
+    user_id = get_jwt_identity()
+    if not reminders.delete_reminder(raw_cursor(), user_id, reminder_id):
+        return jsonify({'error': 'Reminder not found'}), 404
     db.session.commit()
+    return jsonify({'message': 'Reminder deleted'}), 200
+
+# ============== CHANGE STREAM ==============
+
+@app.route('/api/changes/stream', methods=['GET'])
+@jwt_required(locations=['headers', 'query_string'])
+def change_stream():
+    """Server-Sent Events naming each document as it changes (see changefeed.py)"""
+    user_id = get_jwt_identity()
+    try:
+        last_version = changefeed.parse_last_event_id(
+            request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not change_feed.has_capacity():
+        return jsonify({'error': 'Too many open change streams'}), 503
     
-    return jsonify({'mood': new_mood, 'moods': data.data['moods']}), 201
+    version = user_version(user_id)
+    sink = changefeed.QueueSink()
+    sink.send(changefeed.ready_event(version, last_version is not None))
+    change_feed.subscribe(user_id, version if last_version is None else min(last_version, version), sink)
+    return app.response_class(sink, headers=changefeed.EVENT_STREAM_HEADERS)
 
 # ============== STATIC FILES ==============
 
+def static_response(path):
+    """Response for a file of the frontend build, or index.html for app routes"""
+    entry = static_files.lookup(path)
+    if entry is None:
+        return jsonify({'error': 'Frontend not found. Please build first.'}), 404
+    variant = entry.variant(request.headers.get('Accept-Encoding'))
+    try:
+        entry, variant, f = static_files.open(entry, variant)
+    except FileNotFoundError:
+        return jsonify({'error': 'File not found'}), 404
+    
+    headers = entry.headers(variant)
+    if entry.not_modified(variant, request.headers.get('If-None-Match'), request.headers.get('If-Modified-Since')):
+        f.close()
+        return app.response_class(status=304, headers={
+            name: headers[name] for name in static.NOT_MODIFIED_HEADERS if name in headers
+        })
+    # wsgi.file_wrapper lets the WSGI server sendfile() it where supported
+    body = wrap_file(request.environ, f, static.SENDFILE_MIN)
+    response = app.response_class(body, headers=headers, direct_passthrough=True)
+    response.content_length = variant.size
+    return response
+
 @app.route('/')
 def serve():
-    return send_from_directory(app.static_folder, 'index.html')
+    return static_response('/')
 
 @app.route('/<path:path>')
 def serve_static(path):
-    if os.path.exists(os.path.join(app.static_folder, path)):
-        return send_from_directory(app.static_folder, path)
-    return send_from_directory(app.static_folder, 'index.html')
+    return static_response(path)
 
 # ============== ERROR HANDLERS ==============
 
+@app.errorhandler(passwords.Overloaded)
+def hashing_overloaded(e):
+    response = jsonify({'error': str(e)})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
 @app.errorhandler(404)
 def not_found(e):
-    return send_from_directory(app.static_folder, 'index.html')
+    return static_response('/')
 
 # ============== DATABASE INIT ==============
 
 def init_db():
+    """Create or upgrade the schema (see migrations.py)"""
     with app.app_context():
-        db.create_all()
+        conn = db.engine.raw_connection()
+        try:
+            applied = migrations.migrate(conn)
+        finally:
+            conn.close()
+        for version, name, note in applied:
+            print(f"Applied migration {version} {name}" + (f": {note}" if note else ""))
         print("Database initialized successfully!")
 
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index():
+    """Re-index all journal entries for /api/journal/search"""
+    init_db()
+    conn = db.engine.raw_connection()
+    try:
+        count = search.rebuild(conn)
+    finally:
+        conn.close()
+    print(f"Indexed {count} journal entries")
+
+@app.cli.command('check-query-plans')
+def check_query_plans():
+    """Exit non-zero if a hot query would scan a whole table (see migrations.py)"""
+    init_db()
+    conn = db.engine.raw_connection()
+    try:
+        problems = migrations.check_query_plans(conn)
+    finally:
+        conn.close()
+    for name, detail in problems:
+        print(f"{name}: {detail}")
+    print(f"{len(problems)} full table scans" if problems else "No full table scans")
+    sys.exit(1 if problems else 0)
+
 if __name__ == '__main__':
     init_db()
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=int(os.getenv('PORT', 5000)), debug=os.getenv('CALMORA_DEBUG', '1') == '1')
@@ -0,0 +1,84 @@
+"""
+Calmora Backend - Batched sub-requests
+
+At start-up the app reads the user, all data, the pet, habits and moods.
+``POST /api/batch`` runs such a list of GET/PUT/PATCH requests in one
+round trip, authenticating the token once. The request body looks like::
+
+    {"requests": [
+        {"id": "me", "method": "GET", "path": "/api/auth/me"},
+        {"id": "pet", "method": "PUT", "path": "/api/pet", "body": {...},
+         "headers": {"If-Match": "\\"4\\""}}
+    ]}
+
+Sub-requests run in order, each as if it had been sent on its own, and
+the response lists one ``{"id", "status", "headers", "body"}`` per
+request. A failing sub-request does not stop or undo the others.
+"""
+
+import json
+import os
+
+MAX_REQUESTS = int(os.getenv('CALMORA_BATCH_MAX', 20))
+
+METHODS = ('GET', 'PUT', 'PATCH')
+
+# Streamed responses can't be nested in a batch, and neither can batches
+EXCLUDED_PATHS = ('/api/batch', '/api/data/export', '/api/data/import', '/api/changes/stream')
+
+# Request headers a sub-request may set, and response headers passed back
+REQUEST_HEADERS = ('If-Match', 'If-None-Match', 'Content-Type', 'Prefer')
+RESPONSE_HEADERS = ('ETag',)
+
+
+def parse_batch(data):
+    """Validate a batch body; returns ``[(id, method, path, headers, body)]``.
+
+    Raises ValueError with a message for the client.
+    """
+    requests = data.get('requests') if isinstance(data, dict) else None
+    if not isinstance(requests, list) or not requests:
+        raise ValueError('Expected a non-empty "requests" list')
+    if len(requests) > MAX_REQUESTS:
+        raise ValueError(f'At most {MAX_REQUESTS} requests per batch')
+
+    operations = []
+    for index, item in enumerate(requests):
+        if not isinstance(item, dict):
+            raise ValueError(f'Request {index} must be an object')
+        method = str(item.get('method', 'GET')).upper()
+        path = item.get('path')
+        if method not in METHODS:
+            raise ValueError(f'Request {index}: method must be one of {", ".join(METHODS)}')
+        if not isinstance(path, str) or not path.startswith('/api/'):
+            raise ValueError(f'Request {index}: path must start with /api/')
+        if path.split('?', 1)[0] in EXCLUDED_PATHS:
+            raise ValueError(f'Request {index}: {path} cannot be batched')
+        headers = item.get('headers') or {}
+        if not isinstance(headers, dict):
+            raise ValueError(f'Request {index}: headers must be an object')
+        allowed = {name.lower(): name for name in REQUEST_HEADERS}
+        headers = {allowed[name.lower()]: str(value) for name, value in headers.items()
+                   if name.lower() in allowed}
+        operations.append((item.get('id', index), method, path, headers, item.get('body')))
+    return operations
+
+
+def encode_response(op_id, status, headers, body):
+    """One entry of the ``responses`` list, from a sub-request's encoded response."""
+    returned = {name.lower(): name for name in RESPONSE_HEADERS}
+    kept = {}
+    is_json = False
+    for name, value in headers.items():
+        if name.lower() in returned:
+            kept[returned[name.lower()]] = value
+        elif name.lower() == 'content-type':
+            is_json = 'json' in value
+    envelope = json.dumps({'id': op_id, 'status': status, 'headers': kept}).encode()
+    # Splice JSON bodies in as-is instead of decoding and re-encoding them
+    body = body.strip() if is_json else b''
+    return envelope[:-1] + b', "body": ' + (body or b'null') + b'}'
+
+
+def encode_batch(responses):
+    return b'{"responses": [' + b', '.join(responses) + b']}'
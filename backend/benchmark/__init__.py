@@ -0,0 +1,21 @@
+"""
+Calmora Backend - Load tests and benchmarks for either backend
+
+Boots ``server.py`` or ``app.py`` in a subprocess against a fresh SQLite
+file in a temporary directory, seeds it through the API with synthetic
+users, then replays a weighted mix of client scenarios from a pool of
+threads and reports throughput and p50/p95/p99 latency per route as JSON.
+
+Run from ``backend/``:
+
+    python -m benchmark run --backend server --users 20 --history 1000 -o before.json
+    python -m benchmark run --backend server --users 20 --history 1000 --baseline before.json
+    python -m benchmark compare before.json after.json
+
+The same ``--seed`` gives the same synthetic data and the same sequence
+of scenarios per client thread, so two runs differ only in timing. A
+comparison flags routes whose latency rose or whose throughput fell by
+more than ``--threshold``, and exits with status 1 if there are any.
+Results are only comparable between runs on the same machine with the
+same options; ``meta`` in the output records them.
+"""
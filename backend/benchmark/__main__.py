@@ -0,0 +1,124 @@
+"""
+Calmora Backend - ``python -m benchmark`` (see __init__.py)
+"""
+
+import argparse
+import json
+import shlex
+import sys
+
+from benchmark import report, runner, scenarios
+
+
+def write_json(data, path):
+    text = json.dumps(data, indent=2) + '\n'
+    if path and path != '-':
+        with open(path, 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+
+def load_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def print_comparison(comparison):
+    if comparison['mismatched_options']:
+        print(f"warning: the runs differ in {', '.join(comparison['mismatched_options'])}; "
+              f"their numbers may not be comparable", file=sys.stderr)
+    for kind in ('regressions', 'improvements'):
+        for item in comparison[kind]:
+            change = f"{item['change']:+.1%}" if item.get('change') is not None else ''
+            print(f"{kind[:-1]}: {item['route']} {item['metric']} {item['baseline']} -> {item['current']} {change}",
+                  file=sys.stderr)
+    if not comparison['regressions']:
+        print(f"No regressions over {comparison['threshold']:.0%}", file=sys.stderr)
+
+
+def parse_env(items):
+    env = {}
+    for item in items:
+        name, sep, value = item.partition('=')
+        if not sep:
+            raise argparse.ArgumentTypeError(f'Expected NAME=VALUE, got {item}')
+        env[name] = value
+    return env
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmark', description='Calmora API benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='benchmark a backend on a fresh database')
+    run.add_argument('--backend', choices=['server', 'app'], default='server')
+    run.add_argument('--server-args', default='',
+                     help="extra server.py arguments, e.g. '--mode threaded --workers 8'")
+    run.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                     help='environment variable for the backend (repeatable)')
+    run.add_argument('--users', type=int, default=10, help='synthetic users to seed')
+    run.add_argument('--history', type=int, default=1000, help='moods per seeded user')
+    run.add_argument('--concurrency', type=int, default=8, help='client threads')
+    run.add_argument('--duration', type=float, default=10.0, help='seconds to measure')
+    run.add_argument('--warmup', type=float, default=2.0, help='seconds of load before measuring')
+    run.add_argument('--mix', type=scenarios.parse_mix,
+                     help='scenario weights, e.g. poll=10,bulk_sync=3 (default: %s)'
+                          % ','.join(f'{k}={v}' for k, v in scenarios.DEFAULT_MIX.items()))
+    run.add_argument('--seed', type=int, default=1)
+    run.add_argument('--keep', action='store_true', help='keep the temporary database and backend log')
+    run.add_argument('-o', '--output', help='write the report here instead of stdout')
+    run.add_argument('--baseline', help='compare against this earlier report')
+    run.add_argument('--threshold', type=float, default=0.10, help='relative change that counts (default 0.10)')
+
+    comp = commands.add_parser('compare', help='compare two reports')
+    comp.add_argument('baseline')
+    comp.add_argument('current')
+    comp.add_argument('--threshold', type=float, default=0.10)
+    comp.add_argument('-o', '--output', help='write the comparison here instead of stdout')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        comparison = report.compare(load_json(args.baseline), load_json(args.current), args.threshold)
+        write_json(comparison, args.output)
+        print_comparison(comparison)
+        return 1 if comparison['regressions'] else 0
+
+    try:
+        env = parse_env(args.env)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    result = runner.run(
+        backend=args.backend,
+        server_args=shlex.split(args.server_args),
+        env=env,
+        users=args.users,
+        history=args.history,
+        concurrency=args.concurrency,
+        duration=args.duration,
+        warmup=args.warmup,
+        mix=args.mix,
+        seed_value=args.seed,
+        keep=args.keep,
+        log=lambda message: print(message, file=sys.stderr),
+    )
+    total = result['total']
+    print(f"{total['requests']} requests, {total['throughput_rps']} req/s, "
+          f"p50 {total['p50_ms']} ms, p95 {total['p95_ms']} ms, p99 {total['p99_ms']} ms, "
+          f"{total['errors']} errors", file=sys.stderr)
+
+    if not args.baseline:
+        write_json(result, args.output)
+        return 0
+    comparison = report.compare(load_json(args.baseline), result, args.threshold)
+    if args.output:
+        write_json(result, args.output)
+    else:
+        write_json({'result': result, 'comparison': comparison}, None)
+    print_comparison(comparison)
+    return 1 if comparison['regressions'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
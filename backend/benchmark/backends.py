@@ -0,0 +1,112 @@
+"""
+Calmora Backend - Starting a backend for a benchmark run
+"""
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPTS = {
+    'server': 'server.py',
+    'app': 'app.py',
+}
+
+STARTUP_TIMEOUT = 30
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Backend:
+    """One backend process serving a throwaway database; use as a context manager.
+
+    ``args`` are passed on the command line (``server.py`` only, e.g.
+    ``--mode threaded --workers 8``) and ``env`` adds environment
+    variables such as ``CALMORA_GROUP_COMMIT``.
+    """
+
+    def __init__(self, name, args=(), env=None, keep=False):
+        if name not in SCRIPTS:
+            raise ValueError(f'Unknown backend {name}')
+        if args and name != 'server':
+            raise ValueError('Only server.py takes command-line arguments')
+        self.name = name
+        self.args = list(args)
+        self.env = dict(env or {})
+        self.keep = keep
+        self.port = None
+        self.workdir = None
+        self.process = None
+        self.log = None
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    @property
+    def db_path(self):
+        return os.path.join(self.workdir, 'calmora.db')
+
+    def start(self):
+        self.workdir = tempfile.mkdtemp(prefix='calmora-bench-')
+        self.port = free_port()
+        env = {
+            **os.environ,
+            'CALMORA_DB_PATH': self.db_path,
+            'PORT': str(self.port),
+            'CALMORA_DEBUG': '0',
+            'PYTHONUNBUFFERED': '1',
+            **self.env,
+        }
+        command = [sys.executable, os.path.join(BACKEND_DIR, SCRIPTS[self.name])]
+        if self.name == 'server':
+            command += ['--port', str(self.port)] + self.args
+        self.log = open(os.path.join(self.workdir, 'backend.log'), 'wb')
+        self.process = subprocess.Popen(command, cwd=self.workdir, env=env, stdout=self.log,
+                                        stderr=subprocess.STDOUT)
+        self._wait_ready()
+        return self
+
+    def _wait_ready(self):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'{SCRIPTS[self.name]} exited with {self.process.returncode}; '
+                                   f'see {self.log.name}')
+            try:
+                with urllib.request.urlopen(self.base_url + '/api/health', timeout=1):
+                    return
+            except (urllib.error.URLError, OSError):
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError(f'{SCRIPTS[self.name]} did not start within {STARTUP_TIMEOUT}s')
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if self.log is not None:
+            self.log.close()
+        if self.workdir and not self.keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,106 @@
+"""
+Calmora Backend - HTTP client that times every request of a benchmark
+"""
+
+import gzip
+import http.client
+import json
+import threading
+import time
+import urllib.parse
+
+
+class Recorder:
+    """Latencies and statuses per route, shared by every client thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.recording = False
+        self.routes = {}  # route -> {'latencies': [...], 'statuses': {status: count}, 'errors': n}
+
+    def record(self, route, status, seconds, error):
+        if not self.recording:
+            return
+        with self.lock:
+            stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = {'latencies': [], 'statuses': {}, 'errors': 0}
+            stats['latencies'].append(seconds)
+            stats['statuses'][str(status)] = stats['statuses'].get(str(status), 0) + 1
+            if error:
+                stats['errors'] += 1
+
+
+class Session:
+    """One simulated client: a user's token, the ETags it has seen and a connection.
+
+    The connection is reused while the server keeps it open and
+    reopened when it doesn't, the way a browser would.
+    """
+
+    def __init__(self, base_url, recorder, token=None, timeout=30):
+        parsed = urllib.parse.urlsplit(base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.recorder = recorder
+        self.token = token
+        self.timeout = timeout
+        self.etags = {}
+        self.conn = None
+
+    def request(self, route, method, path, body=None, conditional=False, expect=(200, 201, 204, 304)):
+        """Send one request, timing it under ``route``; returns ``(status, decoded body or None)``.
+
+        With ``conditional`` the ETag from the last response on ``path`` is
+        sent back as If-None-Match, as the frontend's cache does.
+        """
+        headers = {'Accept-Encoding': 'gzip'}
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        if conditional and path in self.etags:
+            headers['If-None-Match'] = self.etags[path]
+
+        started = time.perf_counter()
+        try:
+            status, response_headers, raw = self._send(method, path, body, headers)
+        except (OSError, http.client.HTTPException):
+            self.close()
+            self.recorder.record(route, 'error', time.perf_counter() - started, True)
+            return None, None
+        elapsed = time.perf_counter() - started
+        self.recorder.record(route, status, elapsed, status not in expect)
+
+        etag = response_headers.get('ETag')
+        if etag:
+            self.etags[path] = etag
+        if status == 304 or not raw or response_headers.get('Content-Type', '').split(';')[0] != 'application/json':
+            return status, None
+        if response_headers.get('Content-Encoding') == 'gzip':
+            raw = gzip.decompress(raw)
+        return status, json.loads(raw)
+
+    def _send(self, method, path, body, headers):
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                raw = response.read()
+            except (ConnectionResetError, BrokenPipeError, http.client.RemoteDisconnected):
+                # A kept-alive connection the server had already closed
+                self.close()
+                if attempt:
+                    raise
+                continue
+            if response.will_close:
+                self.close()
+            return response.status, response.headers, raw
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
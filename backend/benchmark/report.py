@@ -0,0 +1,116 @@
+"""
+Calmora Backend - Benchmark results and comparison against a baseline
+"""
+
+import math
+
+PERCENTILES = (50, 95, 99)
+
+# Latency changes smaller than this are noise whatever the ratio
+MIN_LATENCY_DELTA_MS = 1.0
+
+# Options two runs must share for their numbers to be comparable
+COMPARABLE_OPTIONS = ('backend', 'server_args', 'env', 'users', 'history', 'concurrency', 'mix', 'seed', 'cpus')
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies, statuses, errors, elapsed):
+    latencies = sorted(latencies)
+    summary = {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'mean_ms': round(1000 * sum(latencies) / len(latencies), 3) if latencies else 0.0,
+    }
+    for p in PERCENTILES:
+        summary[f'p{p}_ms'] = round(1000 * percentile(latencies, p), 3)
+    summary['max_ms'] = round(1000 * latencies[-1], 3) if latencies else 0.0
+    summary['statuses'] = dict(sorted(statuses.items()))
+    return summary
+
+
+def build_report(recorder, elapsed, meta):
+    """Results of a run: ``meta``, a ``total`` summary and one per route."""
+    routes = {}
+    all_latencies, all_statuses, all_errors = [], {}, 0
+    for route, stats in sorted(recorder.routes.items()):
+        routes[route] = summarize(stats['latencies'], stats['statuses'], stats['errors'], elapsed)
+        all_latencies += stats['latencies']
+        all_errors += stats['errors']
+        for status, count in stats['statuses'].items():
+            all_statuses[status] = all_statuses.get(status, 0) + count
+    return {
+        'meta': {**meta, 'elapsed_s': round(elapsed, 3)},
+        'total': summarize(all_latencies, all_statuses, all_errors, elapsed),
+        'routes': routes,
+    }
+
+
+def _change(before, after):
+    if not before:
+        return None
+    return round((after - before) / before, 4)
+
+
+def compare(baseline, current, threshold=0.10):
+    """Per-route changes from ``baseline`` to ``current`` and the ones past ``threshold``.
+
+    A route regressed if a latency percentile rose by more than
+    ``threshold`` (and by at least ``MIN_LATENCY_DELTA_MS``), its
+    throughput fell by more than ``threshold``, or it failed more often.
+    """
+    routes = {}
+    regressions = []
+    improvements = []
+    names = sorted(set(baseline['routes']) | set(current['routes']))
+    for route in ['total'] + names:
+        before = baseline['total'] if route == 'total' else baseline['routes'].get(route)
+        after = current['total'] if route == 'total' else current['routes'].get(route)
+        if before is None or after is None:
+            routes[route] = {'missing_from': 'baseline' if before is None else 'current'}
+            continue
+
+        changes = {}
+        for p in PERCENTILES:
+            key = f'p{p}_ms'
+            change = _change(before[key], after[key])
+            changes[key] = {'baseline': before[key], 'current': after[key], 'change': change}
+            if change is None or abs(after[key] - before[key]) < MIN_LATENCY_DELTA_MS:
+                continue
+            if change > threshold:
+                regressions.append({'route': route, 'metric': key, **changes[key]})
+            elif change < -threshold:
+                improvements.append({'route': route, 'metric': key, **changes[key]})
+
+        change = _change(before['throughput_rps'], after['throughput_rps'])
+        changes['throughput_rps'] = {'baseline': before['throughput_rps'], 'current': after['throughput_rps'],
+                                     'change': change}
+        if change is not None and change < -threshold:
+            regressions.append({'route': route, 'metric': 'throughput_rps', **changes['throughput_rps']})
+        elif change is not None and change > threshold:
+            improvements.append({'route': route, 'metric': 'throughput_rps', **changes['throughput_rps']})
+
+        error_rate_before = before['errors'] / before['requests'] if before['requests'] else 0.0
+        error_rate_after = after['errors'] / after['requests'] if after['requests'] else 0.0
+        changes['error_rate'] = {'baseline': round(error_rate_before, 4), 'current': round(error_rate_after, 4)}
+        if error_rate_after > error_rate_before:
+            regressions.append({'route': route, 'metric': 'error_rate', **changes['error_rate']})
+        routes[route] = changes
+
+    baseline_meta, current_meta = baseline.get('meta', {}), current.get('meta', {})
+    return {
+        'threshold': threshold,
+        'mismatched_options': [key for key in COMPARABLE_OPTIONS if baseline_meta.get(key) != current_meta.get(key)],
+        'baseline_meta': baseline_meta,
+        'current_meta': current_meta,
+        'regressions': regressions,
+        'improvements': improvements,
+        'routes': routes,
+    }
@@ -0,0 +1,85 @@
+"""
+Calmora Backend - Running a benchmark: seed, warm up, then measure
+"""
+
+import os
+import platform
+import random
+import subprocess
+import threading
+import time
+
+from benchmark import backends, report, scenarios, seed
+from benchmark.client import Recorder, Session
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=backends.BACKEND_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _client(base_url, recorder, users, mix, seed_value, index, stop):
+    rng = random.Random(f'{seed_value}:client:{index}')
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    sessions = {}
+    try:
+        while not stop.is_set():
+            user = rng.choice(users)
+            session = sessions.get(user.username)
+            if session is None:
+                session = sessions[user.username] = Session(base_url, recorder, user.token)
+            scenario = scenarios.SCENARIOS[rng.choices(names, weights)[0]]
+            scenario(session, user, rng)
+    finally:
+        for session in sessions.values():
+            session.close()
+
+
+def run(backend='server', server_args=(), env=None, users=10, history=1000, concurrency=8,
+        duration=10.0, warmup=2.0, mix=None, seed_value=1, keep=False, log=print):
+    """Benchmark one backend from scratch; returns the report (see report.py)."""
+    mix = mix or scenarios.DEFAULT_MIX
+    recorder = Recorder()
+    with backends.Backend(backend, server_args, env, keep=keep) as server:
+        log(f'Started {backends.SCRIPTS[backend]} on port {server.port} in {server.workdir}')
+        started = time.perf_counter()
+        seeded = seed.seed_users(lambda: Session(server.base_url, recorder), users, history, seed_value)
+        log(f'Seeded {users} users with {history} moods each in {time.perf_counter() - started:.1f}s')
+
+        stop = threading.Event()
+        threads = [threading.Thread(target=_client, daemon=True,
+                                    args=(server.base_url, recorder, seeded, mix, seed_value, i, stop))
+                   for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        time.sleep(warmup)
+        recorder.recording = True
+        started = time.perf_counter()
+        time.sleep(duration)
+        recorder.recording = False
+        elapsed = time.perf_counter() - started
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    meta = {
+        'backend': backend,
+        'server_args': list(server_args),
+        'env': dict(env or {}),
+        'users': users,
+        'history': history,
+        'concurrency': concurrency,
+        'duration_s': duration,
+        'warmup_s': warmup,
+        'mix': mix,
+        'seed': seed_value,
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+    return report.build_report(recorder, elapsed, meta)
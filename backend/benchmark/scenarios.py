@@ -0,0 +1,88 @@
+"""
+Calmora Backend - Client scenarios replayed by a benchmark
+
+A scenario is one thing a user's client does, as one or more requests
+made with a ``Session`` holding that user's token. Each request is timed
+under a route name, so a route's numbers stay comparable whichever
+scenario sent it.
+"""
+
+import itertools
+import threading
+
+from benchmark import seed
+
+_new_users = itertools.count()
+_new_users_lock = threading.Lock()
+
+
+def auth_storm(session, user, rng):
+    """A new user signs up and then logs in again, e.g. on a second device."""
+    with _new_users_lock:
+        index = next(_new_users)
+    username = f'storm{index}'
+    session.token = None
+    session.request('POST /api/auth/register', 'POST', '/api/auth/register',
+                    {'username': username, 'email': f'{username}@bench.test', 'password': seed.PASSWORD})
+    session.request('POST /api/auth/login', 'POST', '/api/auth/login',
+                    {'username': username, 'password': seed.PASSWORD})
+    session.token = user.token
+
+
+def mood_append(session, user, rng):
+    """Log a mood; the response carries the full mood list, as the frontend expects."""
+    session.request('POST /api/moods', 'POST', '/api/moods',
+                    seed.make_mood(rng, rng.randrange(10 ** 9, 10 ** 10), seed.START))
+
+
+def bulk_sync(session, user, rng):
+    """Sync everything on start-up, revalidating what the client already has."""
+    session.request('GET /api/data/bulk', 'GET', '/api/data/bulk', conditional=True)
+
+
+def poll(session, user, rng):
+    """The dashboard refreshing the pet and the habits."""
+    session.request('GET /api/pet', 'GET', '/api/pet', conditional=True)
+    session.request('GET /api/habits', 'GET', '/api/habits', conditional=True)
+
+
+def login(session, user, rng):
+    """An existing user logging in."""
+    session.request('POST /api/auth/login', 'POST', '/api/auth/login',
+                    {'username': user.username, 'password': seed.PASSWORD})
+
+
+SCENARIOS = {
+    'auth_storm': auth_storm,
+    'login': login,
+    'mood_append': mood_append,
+    'bulk_sync': bulk_sync,
+    'poll': poll,
+}
+
+# Relative weights of a typical day: mostly polling, some syncs and moods, few logins
+DEFAULT_MIX = {
+    'poll': 10,
+    'bulk_sync': 3,
+    'mood_append': 3,
+    'login': 1,
+    'auth_storm': 1,
+}
+
+
+def parse_mix(text):
+    """``poll=10,bulk_sync=3`` -> ``{'poll': 10, 'bulk_sync': 3}``."""
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.strip().partition('=')
+        if name not in SCENARIOS:
+            raise ValueError(f'Unknown scenario {name}; choose from {", ".join(SCENARIOS)}')
+        try:
+            mix[name] = float(weight) if weight else 1.0
+        except ValueError:
+            raise ValueError(f'Invalid weight for {name}: {weight}')
+        if mix[name] < 0:
+            raise ValueError(f'Invalid weight for {name}: {weight}')
+    if not any(mix.values()):
+        raise ValueError('The scenario mix is empty')
+    return mix
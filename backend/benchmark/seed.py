@@ -0,0 +1,89 @@
+"""
+Calmora Backend - Synthetic users for benchmarks
+
+Users are created through the API, so both backends store them exactly
+as they would a real client's data. ``history`` is the number of moods
+per user; journal entries and habit check-ins scale with it.
+"""
+
+import datetime
+import random
+
+PASSWORD = 'benchmark-password'
+
+MOOD_NOTES = ['', 'slept well', 'busy day', 'long walk', 'tired', 'saw friends', 'rainy']
+JOURNAL_WORDS = ['calm', 'work', 'family', 'walk', 'coffee', 'sleep', 'garden', 'music', 'anxious', 'grateful']
+HABIT_NAMES = ['Meditate', 'Run', 'Read', 'Drink water', 'Stretch', 'Journal', 'Sleep early']
+
+START = datetime.datetime(2024, 1, 1, 8, 0, tzinfo=datetime.timezone.utc)
+
+
+class SeedUser:
+    def __init__(self, username, token):
+        self.username = username
+        self.token = token
+
+
+def timestamp(moment):
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.') + f'{moment.microsecond // 1000:03d}Z'
+
+
+def make_mood(rng, entry_id, moment):
+    return {
+        'id': entry_id,
+        'mood': rng.randint(1, 5),
+        'note': rng.choice(MOOD_NOTES),
+        'timestamp': timestamp(moment),
+    }
+
+
+def make_moods(rng, count):
+    # A few moods a day, oldest first, ending up to ~now for large histories
+    step = datetime.timedelta(hours=7)
+    return [make_mood(rng, i + 1, START + i * step) for i in range(count)]
+
+
+def make_journal(rng, count):
+    entries = []
+    for i in range(count):
+        day = START + datetime.timedelta(days=i)
+        words = ' '.join(rng.choice(JOURNAL_WORDS) for _ in range(rng.randint(20, 80)))
+        entries.append({'id': i + 1, 'title': f'Day {i + 1}', 'content': words, 'date': day.strftime('%Y-%m-%d')})
+    return entries
+
+
+def make_habits(rng, days):
+    habits = []
+    for i, name in enumerate(HABIT_NAMES[:5]):
+        completed = [(START + datetime.timedelta(days=d)).strftime('%Y-%m-%d')
+                     for d in range(days) if rng.random() < 0.6]
+        habits.append({'id': i + 1, 'name': name, 'completedDates': completed})
+    return habits
+
+
+def seed_users(session_factory, count, history, seed):
+    """Register ``count`` users and give each ``history`` moods; returns ``[SeedUser]``."""
+    users = []
+    for index in range(count):
+        rng = random.Random(f'{seed}:user:{index}')
+        username = f'bench{index}'
+        session = session_factory()
+        status, body = session.request('seed', 'POST', '/api/auth/register',
+                                       {'username': username, 'email': f'{username}@bench.test',
+                                        'password': PASSWORD})
+        if status != 201:
+            raise RuntimeError(f'Registering {username} failed with {status}')
+        session.token = body['access_token']
+        days = max(1, history // 3)
+        for route, method, path, payload in [
+            ('seed', 'PUT', '/api/data/moods', {'moods': make_moods(rng, history)}),
+            ('seed', 'PUT', '/api/data/journal', {'entries': make_journal(rng, max(1, history // 10))}),
+            ('seed', 'PUT', '/api/habits', make_habits(rng, min(days, 365))),
+            ('seed', 'PUT', '/api/pet', {'name': 'Mochi', 'type': 'cat', 'happiness': 80, 'hunger': 20}),
+        ]:
+            status, _ = session.request(route, method, path, payload)
+            if status != 200:
+                raise RuntimeError(f'Seeding {path} for {username} failed with {status}')
+        session.close()
+        users.append(SeedUser(username, session.token))
+    return users
@@ -0,0 +1,253 @@
+"""
+Calmora Backend - Change notifications over Server-Sent Events
+
+``GET /api/changes/stream`` tells a client which of its documents changed
+on another device, so it can refetch just those instead of polling
+``/api/data/bulk``. Each event names one document and its new version:
+
+    id: 42
+    event: change
+    data: {"data_type": "moods", "version": 42}
+
+Versions come from one per-user sequence (see entries.py), so the latest
+event id is all a client needs to resume: after a reconnect the browser
+sends it back as ``Last-Event-ID`` and gets every document changed since,
+straight from ``user_data``. No event log is kept.
+
+One ``ChangeFeed`` thread per process serves every open stream. Writes
+in the same process wake it right away through ``notify``; writes made by
+other worker processes are found by polling ``user_data`` every
+``POLL_INTERVAL`` seconds. Streams are handed to it as sinks that never
+block (see ``serving.detach``), so an idle stream doesn't hold a worker.
+A sink whose client stops reading is dropped once it has ``MAX_PENDING``
+bytes queued, and a comment line every ``HEARTBEAT`` seconds keeps
+proxies from timing the stream out and reveals dead connections.
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+
+POLL_INTERVAL = float(os.getenv('CALMORA_SSE_POLL', 1))
+HEARTBEAT = float(os.getenv('CALMORA_SSE_HEARTBEAT', 15))
+MAX_SUBSCRIBERS = int(os.getenv('CALMORA_SSE_MAX', 1000))
+MAX_PENDING = int(os.getenv('CALMORA_SSE_BUFFER', 64 * 1024))
+
+# Delay the browser waits before reconnecting, in milliseconds
+RETRY_MS = 3000
+
+HEARTBEAT_EVENT = b': heartbeat\n\n'
+
+EVENT_STREAM_HEADERS = {
+    'Content-Type': 'text/event-stream',
+    'Cache-Control': 'no-cache',
+    # Stop nginx from buffering the stream
+    'X-Accel-Buffering': 'no',
+}
+
+
+def parse_last_event_id(value):
+    """Version a client resumes from, or None to start from now."""
+    if value is None or value == '':
+        return None
+    if not value.isdigit():
+        raise ValueError('Invalid Last-Event-ID')
+    return int(value)
+
+
+def format_event(event, data, event_id=None):
+    lines = [f'id: {event_id}'] if event_id is not None else []
+    lines += [f'event: {event}', f'data: {json.dumps(data)}']
+    return ('\n'.join(lines) + '\n\n').encode()
+
+
+def ready_event(version, resuming):
+    """First event of a stream: the reconnect delay and the user's current version.
+
+    A fresh stream takes the current version as its event id, so the
+    browser resumes from there. A resumed stream must not, or changes
+    made while it was away would be skipped if it dropped again before
+    catching up.
+    """
+    return f'retry: {RETRY_MS}\n'.encode() + format_event(
+        'ready', {'version': version}, None if resuming else version)
+
+
+class QueueSink:
+    """Sink for a stream served from a generator (app.py); events wait in a bounded queue."""
+
+    def __init__(self, max_pending=MAX_PENDING):
+        self.max_pending = max_pending
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.closed = False
+
+    def send(self, data):
+        with self.lock:
+            if self.closed:
+                return False
+            if self.pending + len(data) > self.max_pending:
+                self._close()
+                return False
+            self.pending += len(data)
+        self.queue.put(data)
+        return True
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+
+    def __iter__(self):
+        try:
+            while True:
+                data = self.queue.get()
+                if data is None:
+                    return
+                with self.lock:
+                    self.pending -= len(data)
+                yield data
+        finally:
+            self.close()
+
+
+class _Subscriber:
+    def __init__(self, user_id, last_version, sink):
+        self.user_id = user_id
+        self.last_version = last_version
+        self.sink = sink
+
+
+class ChangeFeed:
+    """Fans document changes out to every open stream of a user.
+
+    ``connect`` opens the SQLite connection the feed thread polls with.
+    """
+
+    def __init__(self, connect, poll_interval=POLL_INTERVAL, heartbeat=HEARTBEAT,
+                 max_subscribers=MAX_SUBSCRIBERS):
+        self.connect = connect
+        self.poll_interval = poll_interval
+        self.heartbeat = heartbeat
+        self.max_subscribers = max_subscribers
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.subscribers = {}  # user_id -> [_Subscriber]
+        self.notified = set()
+        self.thread = None
+        self.events_sent = 0
+        self.closed_streams = 0
+
+    def has_capacity(self):
+        with self.lock:
+            return sum(len(subs) for subs in self.subscribers.values()) < self.max_subscribers
+
+    def subscribe(self, user_id, last_version, sink):
+        """Start sending a user's changes after ``last_version`` to ``sink``.
+
+        Returns False (and closes the sink) if the feed is full.
+        """
+        with self.lock:
+            if sum(len(subs) for subs in self.subscribers.values()) >= self.max_subscribers:
+                sink.close()
+                return False
+            self.subscribers.setdefault(user_id, []).append(_Subscriber(user_id, last_version, sink))
+            # Catch a resumed stream up straight away
+            self.notified.add(user_id)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='calmora-changefeed', daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+        return True
+
+    def notify(self, user_id):
+        """Call after a write for ``user_id`` commits; a no-op if nobody listens."""
+        with self.lock:
+            if user_id not in self.subscribers:
+                return
+            self.notified.add(user_id)
+        self.wakeup.set()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'streams': sum(len(subs) for subs in self.subscribers.values()),
+                'users': len(self.subscribers),
+                'max_streams': self.max_subscribers,
+                'events_sent': self.events_sent,
+                'closed': self.closed_streams,
+            }
+
+    def _run(self):
+        conn = self.connect()
+        c = conn.cursor()
+        now = time.monotonic()
+        next_poll = now + self.poll_interval
+        next_heartbeat = now + self.heartbeat
+        while True:
+            self.wakeup.wait(max(0.0, min(next_poll, next_heartbeat) - time.monotonic()))
+            self.wakeup.clear()
+            with self.lock:
+                notified, self.notified = self.notified, set()
+                subscribers = {user_id: list(subs) for user_id, subs in self.subscribers.items()}
+
+            now = time.monotonic()
+            if now >= next_poll:
+                notified |= self._changed_users(c, subscribers)
+                next_poll = now + self.poll_interval
+            for user_id in notified & set(subscribers):
+                self._deliver(c, subscribers[user_id])
+            if now >= next_heartbeat:
+                for subs in subscribers.values():
+                    for sub in subs:
+                        sub.sink.send(HEARTBEAT_EVENT)
+                next_heartbeat = now + self.heartbeat
+            self._prune()
+
+    def _changed_users(self, c, subscribers):
+        """Users with a document newer than one of their streams has seen."""
+        behind = {user_id: min(sub.last_version for sub in subs) for user_id, subs in subscribers.items()}
+        user_ids = list(behind)
+        changed = set()
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            placeholders = ', '.join('?' for _ in chunk)
+            c.execute(f'SELECT user_id, MAX(version) FROM user_data WHERE user_id IN ({placeholders}) '
+                      f'GROUP BY user_id', chunk)
+            changed.update(user_id for user_id, version in c.fetchall() if version > behind[user_id])
+        return changed
+
+    def _deliver(self, c, subs):
+        since = min(sub.last_version for sub in subs)
+        c.execute('SELECT data_type, version FROM user_data WHERE user_id = ? AND version > ? ORDER BY version',
+                  (subs[0].user_id, since))
+        changes = c.fetchall()
+        sent = 0
+        for sub in subs:
+            for data_type, version in changes:
+                if version > sub.last_version:
+                    event = format_event('change', {'data_type': data_type, 'version': version}, version)
+                    if not sub.sink.send(event):
+                        break
+                    sub.last_version = version
+                    sent += 1
+        with self.lock:
+            self.events_sent += sent
+
+    def _prune(self):
+        with self.lock:
+            for user_id in list(self.subscribers):
+                subs = self.subscribers[user_id]
+                alive = [sub for sub in subs if not sub.sink.closed]
+                self.closed_streams += len(subs) - len(alive)
+                if alive:
+                    self.subscribers[user_id] = alive
+                else:
+                    del self.subscribers[user_id]
@@ -0,0 +1,206 @@
+"""
+Calmora Backend - HTTP compression of responses and request bodies
+
+Responses of at least ``MIN_SIZE`` bytes are compressed with the best
+encoding the client accepts: brotli or zstd when their modules are
+importable (``brotli``; ``compression.zstd`` from Python 3.14 or the
+``zstandard`` package), gzip otherwise. Both backends keep compressed
+bodies of cached documents in the document cache next to the plain
+ones, so a document is compressed once per version and encoding, not
+once per request.
+
+Request bodies sent with ``Content-Encoding: gzip`` are decompressed
+before parsing, up to ``MAX_REQUEST_BYTES``. An NDJSON import is
+decompressed as it is read instead (``decode_stream``), so its size is
+not limited, except in server.py's asyncio mode, which buffers whole
+requests and refuses any over ``MAX_REQUEST_BYTES`` as sent.
+"""
+
+import gzip
+import io
+import json
+import os
+import zlib
+
+import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+MIN_SIZE = int(os.getenv('CALMORA_COMPRESS_MIN', 1024))
+GZIP_LEVEL = int(os.getenv('CALMORA_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.getenv('CALMORA_BROTLI_QUALITY', 5))
+ZSTD_LEVEL = int(os.getenv('CALMORA_ZSTD_LEVEL', 3))
+MAX_REQUEST_BYTES = int(os.getenv('CALMORA_MAX_BODY_MB', 64)) * 1024 * 1024
+
+# Preferred first when the client rates several equally
+ENCODINGS = [name for name, module in (('br', brotli), ('zstd', zstd)) if module is not None] + ['gzip']
+
+
+class UnsupportedEncoding(ValueError):
+    """Request body in a Content-Encoding we can't decode (415)."""
+
+
+class BodyTooLarge(ValueError):
+    """Request body over MAX_REQUEST_BYTES once decompressed (413)."""
+
+
+def negotiate(accept_encoding, size):
+    """Encoding to compress a ``size``-byte response with, or None to send it as is."""
+    if not accept_encoding or size < MIN_SIZE:
+        return None
+    return preferred_encoding(accept_encoding, ENCODINGS)
+
+
+def preferred_encoding(accept_encoding, encodings):
+    """The first of ``encodings`` rated highest by an Accept-Encoding header, or None."""
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        weight = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name.strip().lower()] = weight
+
+    best, best_weight = None, 0.0
+    for name in encodings:
+        weight = weights.get(name, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = name, weight
+    return best
+
+
+def compress(body, encoding):
+    with metrics.stage('compress'):
+        if encoding == 'gzip':
+            return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+        if encoding == 'br':
+            return brotli.compress(body, quality=BROTLI_QUALITY)
+        if encoding == 'zstd':
+            return zstd.compress(body, level=ZSTD_LEVEL)
+    raise ValueError(f'Unknown encoding {encoding}')
+
+
+def decode_body(body, content_encoding, limit=MAX_REQUEST_BYTES):
+    """Request body with its Content-Encoding removed."""
+    encoding = (content_encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        return body
+    if encoding not in ('gzip', 'x-gzip'):
+        raise UnsupportedEncoding(f'Unsupported Content-Encoding: {content_encoding}')
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        with metrics.stage('compress'):
+            data = decoder.decompress(body, limit + 1)
+    except zlib.error:
+        raise ValueError('Invalid gzip body')
+    if len(data) > limit:
+        raise BodyTooLarge('Request body too large')
+    if not decoder.eof:
+        raise ValueError('Truncated gzip body')
+    return data
+
+
+class _LimitedReader(io.RawIOBase):
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+        if size <= 0:
+            return 0
+        data = self.stream.read(size)
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+
+class _GzipReader(gzip.GzipFile):
+    def readline(self, size=-1):
+        try:
+            return super().readline(size)
+        except (OSError, EOFError, zlib.error):
+            raise ValueError('Invalid gzip body')
+
+
+def decode_stream(stream, length, content_encoding):
+    """Read a ``length``-byte request body from ``stream`` with its Content-Encoding removed.
+
+    Returns ``(stream, length)``; the length is None once it is no longer
+    known up front. Only ``readline`` raises ValueError on a corrupt body.
+    """
+    encoding = (content_encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        return stream, length
+    if encoding not in ('gzip', 'x-gzip'):
+        raise UnsupportedEncoding(f'Unsupported Content-Encoding: {content_encoding}')
+    return _GzipReader(fileobj=io.BufferedReader(_LimitedReader(stream, length)), mode='rb'), None
+
+
+class DecompressRequests:
+    """WSGI middleware removing the Content-Encoding of request bodies (app.py).
+
+    Bodies are decoded up front with ``decode_body``, except on
+    ``streamed_paths``, which get a ``decode_stream`` to read from.
+    """
+
+    def __init__(self, app, streamed_paths=()):
+        self.app = app
+        self.streamed_paths = streamed_paths
+
+    def __call__(self, environ, start_response):
+        content_encoding = environ.get('HTTP_CONTENT_ENCODING')
+        if not content_encoding:
+            return self.app(environ, start_response)
+
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        environ = dict(environ)
+        del environ['HTTP_CONTENT_ENCODING']
+        if environ.get('PATH_INFO') in self.streamed_paths:
+            try:
+                environ['wsgi.input'], _ = decode_stream(environ['wsgi.input'], length, content_encoding)
+            except UnsupportedEncoding as e:
+                return self._error(start_response, '415 Unsupported Media Type', str(e))
+            # The decoded length is unknown; the gzip stream ends itself
+            environ.pop('CONTENT_LENGTH', None)
+            environ['wsgi.input_terminated'] = True
+            return self.app(environ, start_response)
+
+        try:
+            body = decode_body(environ['wsgi.input'].read(length), content_encoding)
+        except UnsupportedEncoding as e:
+            return self._error(start_response, '415 Unsupported Media Type', str(e))
+        except BodyTooLarge as e:
+            return self._error(start_response, '413 Request Entity Too Large', str(e))
+        except ValueError as e:
+            return self._error(start_response, '400 Bad Request', str(e))
+
+        environ['wsgi.input'] = io.BytesIO(body)
+        environ['CONTENT_LENGTH'] = str(len(body))
+        return self.app(environ, start_response)
+
+    def _error(self, start_response, status, message):
+        body = json.dumps({'error': message}).encode()
+        start_response(status, [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+        return [body]
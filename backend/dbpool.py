@@ -0,0 +1,150 @@
+"""
+Calmora Backend - Shared SQLite connection setup and per-thread pool
+
+Both backends open SQLite through here so every connection gets the same
+tuning: WAL journaling (readers no longer block behind a writer),
+synchronous=NORMAL, a busy timeout instead of immediate "database is
+locked" errors, memory-mapped reads and a larger statement cache.
+
+server.py keeps one connection per worker thread (and per process after
+fork) instead of connecting on every request. app.py applies the same
+settings to SQLAlchemy's own pool via ``configure_connection``, and
+both use ``TimedConnection`` so queries show up in the request metrics.
+"""
+
+import os
+import sqlite3
+import threading
+
+import metrics
+
+BUSY_TIMEOUT_MS = int(os.getenv('CALMORA_DB_BUSY_TIMEOUT', 5000))
+MMAP_SIZE = int(os.getenv('CALMORA_DB_MMAP_SIZE', 256 * 1024 * 1024))
+CACHE_SIZE_KB = int(os.getenv('CALMORA_DB_CACHE_KB', 16 * 1024))
+
+# Prepared statements kept per connection (sqlite3's default is 128)
+CACHED_STATEMENTS = 512
+
+CONNECT_ARGS = {
+    'timeout': BUSY_TIMEOUT_MS / 1000,
+    'cached_statements': CACHED_STATEMENTS,
+}
+
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}',
+    f'PRAGMA mmap_size={MMAP_SIZE}',
+    f'PRAGMA cache_size=-{CACHE_SIZE_KB}',
+    'PRAGMA temp_store=MEMORY',
+)
+
+
+def configure_connection(conn):
+    """Apply the shared PRAGMAs to a freshly opened sqlite3 connection."""
+    cursor = conn.cursor()
+    for pragma in PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that counts its statements and time towards the current request (see metrics.py)."""
+
+    def execute(self, *args):
+        metrics.count_query()
+        with metrics.stage('db'):
+            return super().execute(*args)
+
+    def executemany(self, *args):
+        metrics.count_query()
+        with metrics.stage('db'):
+            return super().executemany(*args)
+
+    def executescript(self, *args):
+        metrics.count_query()
+        with metrics.stage('db'):
+            return super().executescript(*args)
+
+    def fetchone(self):
+        with metrics.stage('db'):
+            return super().fetchone()
+
+    def fetchmany(self, *args):
+        with metrics.stage('db'):
+            return super().fetchmany(*args)
+
+    def fetchall(self):
+        with metrics.stage('db'):
+            return super().fetchall()
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors are ``TimedCursor``s; commits are timed too."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        with metrics.stage('db'):
+            super().commit()
+
+
+def connect(path, row_factory=None, factory=TimedConnection):
+    """Open and configure a standalone connection."""
+    conn = sqlite3.connect(path, factory=factory, **CONNECT_ARGS)
+    if row_factory is not None:
+        conn.row_factory = row_factory
+    configure_connection(conn)
+    return conn
+
+
+class PooledConnection(TimedConnection):
+    """Connection whose ``close()`` hands it back to the pool.
+
+    Any transaction left open (e.g. by a request that raised halfway)
+    is rolled back so the next user starts clean.
+    """
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+
+
+class ConnectionPool:
+    """One long-lived connection per thread, re-created after fork."""
+
+    def __init__(self, path, row_factory=None):
+        self.path = path
+        self.row_factory = row_factory
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and self.local.pid == os.getpid():
+            if conn.in_transaction:
+                conn.rollback()
+            return conn
+
+        # First use on this thread, or a connection inherited across fork,
+        # which SQLite forbids reusing; open a fresh one
+        conn = connect(self.path, self.row_factory, factory=PooledConnection)
+        self.local.conn = conn
+        self.local.pid = os.getpid()
+        with self.lock:
+            self.connections.append(conn)
+        return conn
+
+    def close_all(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            sqlite3.Connection.close(conn)
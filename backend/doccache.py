@@ -0,0 +1,119 @@
+"""
+Calmora Backend - In-process LRU cache for per-user documents
+
+Caches parsed documents together with their already-encoded JSON
+responses, keyed by ``(user_id, data_type, version, view)``. ``view``
+names the response shape (``'pet'``, ``'data'``, ``'bulk'``...), since the
+same document is wrapped differently by different routes.
+
+Readers look up the document's current version (one indexed SELECT)
+and use it in the key, so an entry can never be served after a write,
+even one made by another worker process. Writes in this process also
+invalidate the user's entries eagerly so memory is not wasted on dead
+versions. Entries are evicted least-recently-used once the cache holds
+``max_bytes`` of encoded JSON, and expire after ``ttl`` seconds.
+"""
+
+import collections
+import os
+import threading
+import time
+
+MAX_BYTES = int(float(os.getenv('CALMORA_CACHE_MB', 64)) * 1024 * 1024)
+TTL = float(os.getenv('CALMORA_CACHE_TTL', 300))
+
+# data_type used for entries that cover all of a user's documents
+ALL_TYPES = '*'
+
+
+class DocumentCache:
+    """Thread-safe, size-bounded LRU of ``(doc, encoded_body)`` pairs."""
+
+    def __init__(self, max_bytes=MAX_BYTES, ttl=TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key -> (doc, body, expires_at)
+        self.by_user = {}  # user_id -> set of keys
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, user_id, data_type, version, view):
+        """Cached ``(doc, body)`` for this exact version, or None.
+
+        The returned document is shared; callers must not mutate it.
+        """
+        if version is None or self.max_bytes <= 0:
+            return None
+        key = (user_id, data_type, version, view)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[2] < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, user_id, data_type, version, view, doc, body):
+        if version is None or len(body) > self.max_bytes:
+            return
+        key = (user_id, data_type, version, view)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (doc, body, time.monotonic() + self.ttl)
+            self.by_user.setdefault(user_id, set()).add(key)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, user_id, data_type=None):
+        """Drop a user's entries for one document type (or all of them).
+
+        Entries covering all of the user's documents go too, since any
+        single write changes them.
+        """
+        with self.lock:
+            for key in list(self.by_user.get(user_id, ())):
+                if data_type is None or key[1] in (data_type, ALL_TYPES):
+                    self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.by_user.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        doc, body, _ = self.entries.pop(key)
+        self.size -= len(body)
+        keys = self.by_user.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_user[key[0]]
+
+    def snapshot(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
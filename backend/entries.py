@@ -0,0 +1,551 @@
+"""
+Calmora Backend - Row-per-entry storage for append-heavy data types
+
+Moods, journal entries and habit check-ins used to live inside a single
+JSON document per user in ``user_data``. They are now stored one row per
+entry in ``user_entries`` so adding an entry is a single INSERT no matter
+how long the history is. The rest of each document (habit definitions,
+any extra keys) stays in ``user_data`` and the full document is
+reassembled on read, so API responses keep their old shape.
+"""
+
+import json
+import base64
+import datetime
+
+import analytics
+
+# data_type -> (list key inside the document, field holding the entry time)
+ENTRY_TYPES = {
+    'moods': ('moods', 'timestamp'),
+    'journal': ('entries', 'date'),
+}
+
+# Habit check-ins are nested in each habit's ``completedDates`` list
+HABITS = 'habits'
+HABIT_CHECKINS = 'habit_checkins'
+
+# Document types whose data is (partly) kept in user_entries
+ROW_BACKED_TYPES = set(ENTRY_TYPES) | {HABITS}
+
+
+def utc_now_iso():
+    """Current UTC time formatted like JavaScript's ``toISOString()``."""
+    return datetime.datetime.utcnow().isoformat(timespec='milliseconds') + 'Z'
+
+
+def entry_type(data_type):
+    """The ``user_entries.data_type`` rows of a document type are stored under."""
+    return HABIT_CHECKINS if data_type == HABITS else data_type
+
+
+def entry_created_at(data_type, entry):
+    field = ENTRY_TYPES[data_type][1]
+    value = entry.get(field) if isinstance(entry, dict) else None
+    return value if isinstance(value, str) and value else utc_now_iso()
+
+
+def entry_key(entry):
+    if isinstance(entry, dict) and entry.get('id') is not None:
+        return str(entry['id'])
+    return None
+
+
+def split_document(data_type, doc):
+    """Split a full document into its base part and entry rows.
+
+    Rows are ``(entry_key, created_at, payload)`` tuples, oldest first, so
+    inserting them in order keeps row ids increasing with entry age.
+    """
+    if not isinstance(doc, dict):
+        return doc, []
+
+    if data_type in ENTRY_TYPES:
+        list_key = ENTRY_TYPES[data_type][0]
+        base = {k: v for k, v in doc.items() if k != list_key}
+        items = doc.get(list_key) or []
+        rows = [(entry_key(e), entry_created_at(data_type, e), e) for e in reversed(items)]
+        return base, rows
+
+    if data_type == HABITS:
+        base = dict(doc)
+        habits = []
+        rows = []
+        for habit in doc.get('habits') or []:
+            if isinstance(habit, dict) and 'completedDates' in habit:
+                key = entry_key(habit)
+                for date in habit.get('completedDates') or []:
+                    rows.append((key, date, {'habit_id': habit.get('id'), 'date': date}))
+                habit = {k: v for k, v in habit.items() if k != 'completedDates'}
+            habits.append(habit)
+        base['habits'] = habits
+        return base, rows
+
+    return doc, []
+
+
+def assemble_document(data_type, base, entries):
+    """Rebuild a full document from its base part and stored entries.
+
+    ``entries`` are payloads newest first for mood/journal types and
+    check-in payloads in insertion order for habits.
+    """
+    doc = dict(base) if isinstance(base, dict) else {}
+
+    if data_type in ENTRY_TYPES:
+        doc[ENTRY_TYPES[data_type][0]] = list(entries)
+        return doc
+
+    if data_type == HABITS:
+        dates = {}
+        for checkin in entries:
+            dates.setdefault(str(checkin.get('habit_id')), []).append(checkin.get('date'))
+        habits = []
+        for habit in doc.get('habits') or []:
+            if isinstance(habit, dict):
+                habit = {**habit, 'completedDates': dates.get(str(habit.get('id')), [])}
+            habits.append(habit)
+        doc['habits'] = habits
+        return doc
+
+    return doc
+
+
+def diff_rows(existing, rows):
+    """Work out the smallest change from stored entry rows to ``rows``.
+
+    ``existing`` holds ``(row_id, entry_key, created_at, payload)`` tuples.
+    Returns the row ids to delete and the rows to insert, so re-saving a
+    document with one changed entry touches one or two rows instead of the
+    whole history. Rows are matched on key and payload; ``created_at`` is
+    derived from the payload, except for entries without a time field,
+    whose stored time is kept.
+    """
+    stored = {}
+    for row_id, key, _, payload in existing:
+        stored.setdefault((key, json.dumps(payload, sort_keys=True)), []).append(row_id)
+
+    inserts = []
+    for row in rows:
+        ids = stored.get((row[0], json.dumps(row[2], sort_keys=True)))
+        if ids:
+            ids.pop()
+        else:
+            inserts.append(row)
+
+    delete_ids = [row_id for ids in stored.values() for row_id in ids]
+    return delete_ids, inserts
+
+
+# ============== SQLITE ACCESS ==============
+
+def create_schema(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS user_entries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            data_type TEXT NOT NULL,
+            entry_key TEXT,
+            created_at TEXT NOT NULL,
+            data TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_user_entries_user_created
+        ON user_entries (user_id, data_type, created_at)
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_user_entries_user_key
+        ON user_entries (user_id, data_type, entry_key)
+    ''')
+
+
+def _insert_rows(c, user_id, data_type, rows):
+    c.executemany(
+        'INSERT INTO user_entries (user_id, data_type, entry_key, created_at, data) VALUES (?, ?, ?, ?, ?)',
+        [(user_id, data_type, key, created_at, json.dumps(payload)) for key, created_at, payload in rows])
+
+
+def load_entries(c, user_id, data_type, start=None, end=None):
+    """Entries of a document type, in the order ``assemble_document`` expects.
+
+    ``start``/``end`` optionally restrict ``created_at`` (see ``parse_page_args``).
+    """
+    clauses = ['user_id = ?', 'data_type = ?']
+    params = [user_id, entry_type(data_type)]
+    if start:
+        clauses.append('created_at >= ?')
+        params.append(start)
+    if end:
+        clauses.append('created_at <= ?')
+        params.append(end)
+    order = 'id' if data_type == HABITS else 'created_at DESC, id DESC'
+    c.execute(f'SELECT data FROM user_entries WHERE {" AND ".join(clauses)} ORDER BY {order}', params)
+    return [json.loads(row[0]) for row in c.fetchall()]
+
+
+def query_entries(c, user_id, data_type, page):
+    """One page of mood/journal entries, newest first, plus paging info."""
+    clauses = ['user_id = ?', 'data_type = ?']
+    params = [user_id, data_type]
+    if page['from']:
+        clauses.append('created_at >= ?')
+        params.append(page['from'])
+    if page['to']:
+        clauses.append('created_at <= ?')
+        params.append(page['to'])
+    if page['before']:
+        created_at, row_id = page['before']
+        clauses.append('(created_at < ? OR (created_at = ? AND id < ?))')
+        params += [created_at, created_at, row_id]
+    if page['after']:
+        created_at, row_id = page['after']
+        clauses.append('(created_at > ? OR (created_at = ? AND id > ?))')
+        params += [created_at, created_at, row_id]
+
+    # Walking forward from an ``after`` cursor reads the oldest matches first
+    ascending = page['after'] is not None and page['before'] is None
+    order = 'created_at ASC, id ASC' if ascending else 'created_at DESC, id DESC'
+    sql = f'SELECT id, created_at, data FROM user_entries WHERE {" AND ".join(clauses)} ORDER BY {order}'
+    if page['limit']:
+        sql += ' LIMIT ?'
+        params.append(page['limit'] + 1)
+    c.execute(sql, params)
+    rows = [(row[0], row[1], row[2]) for row in c.fetchall()]
+
+    return paginate_rows(rows, page, ascending)
+
+
+def load_document(c, user_id, data_type):
+    """Full document for a data type, or None if the user has none."""
+    c.execute('SELECT data FROM user_data WHERE user_id = ? AND data_type = ?', (user_id, data_type))
+    row = c.fetchone()
+    if not row:
+        return None
+    base = json.loads(row[0]) if row[0] else {}
+    if data_type not in ROW_BACKED_TYPES:
+        return base
+    return assemble_document(data_type, base, load_entries(c, user_id, data_type))
+
+
+def query_document(c, user_id, data_type, page):
+    """A document with only one page of its entries, plus paging info.
+
+    Returns ``(None, None)`` if the user has no such document. Types that
+    are not row-backed come back whole with no paging info.
+    """
+    c.execute('SELECT data FROM user_data WHERE user_id = ? AND data_type = ?', (user_id, data_type))
+    row = c.fetchone()
+    if not row:
+        return None, None
+    doc = json.loads(row[0]) if row[0] else {}
+
+    if data_type in ENTRY_TYPES:
+        items, paging = query_entries(c, user_id, data_type, page)
+        return assemble_document(data_type, doc, items), paging
+
+    if data_type == HABITS:
+        # Date filters apply to check-ins, cursors to the habit list itself
+        checkins = load_entries(c, user_id, HABITS, page['from'], page['to'])
+        doc = assemble_document(HABITS, doc, checkins)
+        doc['habits'], paging = paginate_list(doc['habits'], page)
+        return doc, paging
+
+    return doc, None
+
+
+def load_all_documents(c, user_id, since=None):
+    """All documents of a user, or only those changed after version ``since``."""
+    if since is None:
+        c.execute('SELECT data_type, data FROM user_data WHERE user_id = ? ORDER BY data_type', (user_id,))
+    else:
+        c.execute('SELECT data_type, data FROM user_data WHERE user_id = ? AND version > ? ORDER BY data_type',
+                  (user_id, since))
+    docs = {row[0]: json.loads(row[1]) if row[1] else {} for row in c.fetchall()}
+    for data_type in ROW_BACKED_TYPES & set(docs):
+        docs[data_type] = assemble_document(data_type, docs[data_type], load_entries(c, user_id, data_type))
+    return docs
+
+
+def ensure_document(c, user_id, data_type):
+    c.execute('SELECT id FROM user_data WHERE user_id = ? AND data_type = ?', (user_id, data_type))
+    if not c.fetchone():
+        c.execute('INSERT INTO user_data (user_id, data_type, data) VALUES (?, ?, ?)',
+                  (user_id, data_type, '{}'))
+
+
+def store_base(c, user_id, data_type, base):
+    """Write the ``user_data`` part of a document; entry rows are left alone."""
+    c.execute('SELECT id FROM user_data WHERE user_id = ? AND data_type = ?', (user_id, data_type))
+    if c.fetchone():
+        c.execute('UPDATE user_data SET data = ? WHERE user_id = ? AND data_type = ?',
+                  (json.dumps(base), user_id, data_type))
+    else:
+        c.execute('INSERT INTO user_data (user_id, data_type, data) VALUES (?, ?, ?)',
+                  (user_id, data_type, json.dumps(base)))
+
+
+def save_document(c, user_id, data_type, doc):
+    """Replace a whole document, writing its entries as rows. Returns the new version."""
+    base, rows = split_document(data_type, doc)
+    store_base(c, user_id, data_type, base)
+
+    if data_type in ROW_BACKED_TYPES:
+        c.execute('SELECT id, entry_key, created_at, data FROM user_entries WHERE user_id = ? AND data_type = ?',
+                  (user_id, entry_type(data_type)))
+        existing = [(row[0], row[1], row[2], json.loads(row[3])) for row in c.fetchall()]
+        delete_ids, inserts = diff_rows(existing, rows)
+        c.executemany('DELETE FROM user_entries WHERE id = ?', [(row_id,) for row_id in delete_ids])
+        _insert_rows(c, user_id, entry_type(data_type), inserts)
+        deleted = set(delete_ids)
+        removed = [(key, created_at, payload) for row_id, key, created_at, payload in existing if row_id in deleted]
+        analytics.record_changes(c, user_id, entry_type(data_type), removed, inserts)
+
+    return bump_version(c, user_id, data_type)
+
+
+def append_entry(c, user_id, data_type, entry):
+    """Add one mood/journal entry and return the document's new version.
+
+    Costs one INSERT regardless of history size.
+    """
+    ensure_document(c, user_id, data_type)
+    row = (entry_key(entry), entry_created_at(data_type, entry), entry)
+    _insert_rows(c, user_id, data_type, [row])
+    analytics.record_changes(c, user_id, data_type, [], [row])
+    return bump_version(c, user_id, data_type)
+
+
+def upsert_entries(c, user_id, data_type, rows):
+    """Store entry rows, replacing stored rows that have the same key.
+
+    Check-ins are matched on habit and date. Rows without a key are always
+    inserted. Unlike ``save_document`` the rest of the history is left
+    alone, so a large import can be written a batch at a time. The caller
+    bumps the document version.
+    """
+    stored = entry_type(data_type)
+    # A key repeated within ``rows`` keeps its last occurrence
+    unique = {}
+    for i, row in enumerate(rows):
+        match = (row[0], row[1] if data_type == HABITS else None) if row[0] is not None else i
+        unique[match] = row
+    rows = list(unique.values())
+
+    delete_ids = []
+    removed = []
+    for key, created_at, _ in rows:
+        if key is None:
+            continue
+        if data_type == HABITS:
+            c.execute('SELECT id, created_at, data FROM user_entries '
+                      'WHERE user_id = ? AND data_type = ? AND entry_key = ? AND created_at = ?',
+                      (user_id, stored, key, created_at))
+        else:
+            c.execute('SELECT id, created_at, data FROM user_entries '
+                      'WHERE user_id = ? AND data_type = ? AND entry_key = ?',
+                      (user_id, stored, key))
+        for row_id, old_created_at, payload in c.fetchall():
+            delete_ids.append(row_id)
+            removed.append((key, old_created_at, json.loads(payload)))
+    c.executemany('DELETE FROM user_entries WHERE id = ?', [(row_id,) for row_id in delete_ids])
+    _insert_rows(c, user_id, stored, rows)
+    analytics.record_changes(c, user_id, stored, removed, rows)
+
+
+def migrate_blobs(conn):
+    """Move entries still embedded in ``user_data`` documents into rows.
+
+    Safe to run repeatedly: documents that were already split have no
+    embedded entries left and are skipped.
+    """
+    c = conn.cursor()
+    create_schema(c)
+    analytics.create_schema(c)
+    placeholders = ', '.join('?' for _ in ROW_BACKED_TYPES)
+    c.execute(f'SELECT user_id, data_type, data FROM user_data WHERE data_type IN ({placeholders})',
+              tuple(ROW_BACKED_TYPES))
+    migrated = 0
+    for user_id, data_type, raw in c.fetchall():
+        try:
+            doc = json.loads(raw) if raw else {}
+        except (TypeError, ValueError):
+            continue
+        base, rows = split_document(data_type, doc)
+        if base == doc:
+            continue
+        _insert_rows(c, user_id, entry_type(data_type), rows)
+        analytics.record_changes(c, user_id, entry_type(data_type), [], rows)
+        c.execute('UPDATE user_data SET data = ? WHERE user_id = ? AND data_type = ?',
+                  (json.dumps(base), user_id, data_type))
+        migrated += 1
+    conn.commit()
+    return migrated
+
+
+# ============== VERSIONS ==============
+
+def document_version(c, user_id, data_type):
+    """Current version of one document, or None if it does not exist."""
+    c.execute('SELECT version FROM user_data WHERE user_id = ? AND data_type = ?', (user_id, data_type))
+    row = c.fetchone()
+    return row[0] if row else None
+
+
+def user_version(c, user_id):
+    """Highest document version of a user; changes whenever any document does."""
+    c.execute('SELECT COALESCE(MAX(version), 0) FROM user_data WHERE user_id = ?', (user_id,))
+    return c.fetchone()[0]
+
+
+def bump_version(c, user_id, data_type):
+    """Give a document the next version in the user's sequence and return it.
+
+    Versions come from one per-user sequence, so ``version > since``
+    finds every document changed after a client's last sync.
+    """
+    c.execute('''
+        UPDATE user_data
+        SET version = (SELECT COALESCE(MAX(version), 0) + 1 FROM user_data WHERE user_id = ?),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE user_id = ? AND data_type = ?
+    ''', (user_id, user_id, data_type))
+    return document_version(c, user_id, data_type)
+
+
+def add_version_column(conn):
+    """Add ``user_data.version`` to databases created before it existed."""
+    c = conn.cursor()
+    c.execute('PRAGMA table_info(user_data)')
+    if 'version' not in [row[1] for row in c.fetchall()]:
+        c.execute('ALTER TABLE user_data ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+        conn.commit()
+
+
+# ============== PAGINATION ==============
+
+MAX_PAGE_SIZE = 500
+
+PAGE_ARGS = ('limit', 'cursor', 'before', 'after', 'from', 'to')
+
+
+def encode_cursor(direction, created_at, row_id):
+    """Opaque cursor for paging ``direction`` (``'before'`` or ``'after'``) of a row"""
+    raw = f'{direction}|{created_at}|{row_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def read_cursor(cursor):
+    """``(direction, (created_at, row_id))`` of a cursor; direction is None for old cursors"""
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+    parts = raw.split('|')
+    if len(parts) == 3 and parts[0] in ('before', 'after'):
+        direction, created_at, row_id = parts
+    else:
+        direction = None
+        created_at, row_id = raw.rsplit('|', 1)
+    return direction, (created_at, int(row_id))
+
+
+def decode_cursor(cursor):
+    return read_cursor(cursor)[1]
+
+
+def parse_page_args(args):
+    """Read ``limit``, ``cursor``, ``before``, ``after``, ``from`` and ``to`` from query args.
+
+    ``cursor`` takes a ``next_cursor`` or ``prev_cursor`` from any listing
+    and pages the way it points; ``before`` and ``after`` take a cursor's
+    row as given. Returns None when none are given so callers keep the
+    full-list behaviour. Raises ValueError on malformed values.
+    """
+    if not any(args.get(name) for name in PAGE_ARGS):
+        return None
+
+    limit = args.get('limit')
+    if limit:
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+        limit = min(limit, MAX_PAGE_SIZE)
+
+    end = args.get('to') or None
+    if end and len(end) == 10:
+        # A bare date includes the whole day
+        end += '\uffff'
+
+    page = {
+        'limit': limit or None,
+        'before': decode_cursor(args['before']) if args.get('before') else None,
+        'after': decode_cursor(args['after']) if args.get('after') else None,
+        'from': args.get('from') or None,
+        'to': end,
+    }
+    if args.get('cursor'):
+        direction, position = read_cursor(args['cursor'])
+        if direction is None:
+            raise ValueError('cursor must be a next_cursor or prev_cursor')
+        page[direction] = position
+    return page
+
+
+def paginate_rows(rows, page, ascending=False):
+    """Trim ``(id, created_at, data)`` rows to a page and build its paging info.
+
+    ``next_cursor`` continues towards older entries and ``prev_cursor``
+    towards newer ones; pass either back as ``cursor``. The first page
+    has no ``prev_cursor``.
+    """
+    has_more = bool(page['limit']) and len(rows) > page['limit']
+    if has_more:
+        rows = rows[:page['limit']]
+    if ascending:
+        rows.reverse()
+
+    items = [json.loads(data) if isinstance(data, str) else data for _, _, data in rows]
+    paging = {'limit': page['limit'], 'next_cursor': None, 'prev_cursor': None}
+    if rows:
+        if has_more or ascending:
+            paging['next_cursor'] = encode_cursor('before', rows[-1][1], rows[-1][0])
+        # Going newer from an ``after`` cursor only finds more if it was cut short
+        if has_more if ascending else page['before']:
+            paging['prev_cursor'] = encode_cursor('after', rows[0][1], rows[0][0])
+    return items, paging
+
+
+def paginate_list(items, page):
+    """Positional paging for short lists kept inside a document (habit definitions).
+
+    Pass ``next_cursor`` or ``prev_cursor`` back as ``cursor``, as with
+    ``paginate_rows``.
+    """
+    start, stop = 0, len(items)
+    if page['after']:
+        start = page['after'][1] + 1
+    if page['before']:
+        stop = min(stop, page['before'][1])
+    if page['limit']:
+        if page['before'] and not page['after']:
+            start = max(start, stop - page['limit'])
+        else:
+            stop = min(stop, start + page['limit'])
+    start = max(start, 0)
+
+    paging = {'limit': page['limit'], 'next_cursor': None, 'prev_cursor': None}
+    if stop < len(items):
+        paging['next_cursor'] = encode_cursor('after', '', stop - 1)
+    if start > 0:
+        paging['prev_cursor'] = encode_cursor('before', '', start)
+    return items[start:stop], paging
+
+
+def wants_minimal_response(headers, args):
+    """True if a write's response may omit the echoed full list.
+
+    Clients opt in with ``Prefer: return=minimal`` or ``?echo=false``.
+    """
+    prefer = headers.get('Prefer') or ''
+    if 'return=minimal' in prefer.replace(' ', ''):
+        return True
+    return (args.get('echo') or '').lower() in ('0', 'false', 'no')
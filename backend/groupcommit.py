@@ -0,0 +1,128 @@
+"""
+Calmora Backend - Group commit for small, frequent writes
+
+Without it every mood, pet update or habit toggle pays for its own
+COMMIT. With it, requests hand their write to one writer thread, which
+runs all writes that arrive within a short window in a single
+transaction and commits once. Each write runs inside its own SAVEPOINT,
+so one failing write is rolled back without affecting the others.
+
+Durability is unchanged from the caller's point of view: ``submit()``
+only returns after the transaction containing the write has committed.
+"""
+
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class GroupCommitter:
+    """Single writer thread that batches write functions into shared transactions."""
+
+    def __init__(self, connect, max_batch=128, max_delay=0.002):
+        self.connect = connect
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.batch_sizes = collections.deque(maxlen=1024)
+        self.flush_latencies = collections.deque(maxlen=1024)
+        self.batches = 0
+        self.writes = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self._run, name='calmora-group-commit', daemon=True)
+        self.thread.start()
+
+    def submit(self, fn):
+        """Run ``fn(cursor)`` in the next batch and return its result once committed.
+
+        Exceptions raised by ``fn`` (or by the commit) are re-raised here.
+        """
+        future = Future()
+        self.queue.put((fn, future))
+        return future.result()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.perf_counter() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        conn = self.connect()
+        c = conn.cursor()
+        while True:
+            first = self.queue.get()
+            if first is None:
+                conn.close()
+                return
+            batch = self._collect(first)
+
+            started = time.perf_counter()
+            results = []
+            try:
+                c.execute('BEGIN IMMEDIATE')
+                for fn, future in batch:
+                    c.execute('SAVEPOINT write')
+                    try:
+                        results.append((future, fn(c), None))
+                        c.execute('RELEASE write')
+                    except Exception as e:
+                        c.execute('ROLLBACK TO write')
+                        c.execute('RELEASE write')
+                        results.append((future, None, e))
+                conn.commit()
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                results = [(future, None, e) for _, future in batch]
+            latency = time.perf_counter() - started
+
+            self._record(len(batch), latency, sum(1 for _, _, error in results if error))
+            for future, result, error in results:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+    def _record(self, size, latency, failed):
+        with self.lock:
+            self.batches += 1
+            self.writes += size
+            self.failed += failed
+            self.batch_sizes.append(size)
+            self.flush_latencies.append(latency)
+
+    def snapshot(self):
+        with self.lock:
+            sizes = sorted(self.batch_sizes)
+            latencies = sorted(self.flush_latencies)
+            stats = {
+                'batches': self.batches,
+                'writes': self.writes,
+                'failed_writes': self.failed,
+                'pending': self.queue.qsize(),
+                'batch_size_avg': round(self.writes / self.batches, 2) if self.batches else 0.0,
+                'batch_size_max': sizes[-1] if sizes else 0,
+            }
+        for name, q in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99)):
+            value = latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else 0.0
+            stats[f'flush_latency_{name}_ms'] = round(1000 * value, 3)
+        return stats
@@ -0,0 +1,281 @@
+"""
+Calmora Backend - Request metrics in Prometheus text format, and sampled profiles
+
+Each request is timed from start to finish and split into stages:
+
+``auth``     verifying the token (app.py: the revocation check)
+``db``       SQLite statements, fetches and commits (see ``dbpool.TimedConnection``)
+``json``     encoding and decoding JSON
+``compress`` gzip/brotli/zstd in either direction (see compress.py)
+``write``    writing the response to the socket; in asyncio mode responses
+             up to ``serving.STREAM_CHUNK`` are sent by the loop afterwards
+             and not counted
+``app``      everything else
+
+Stages are exclusive: a query run while verifying a token counts as
+``db``, not ``auth``. ``GET /metrics`` exposes per-route histograms of
+total and per-stage time and of queries per request, request counts by
+status, requests in flight, and whatever the backend adds (cache and
+queue statistics). Each process keeps its own numbers, so with
+``--processes`` a scrape sees the worker that answered it. Setting
+``CALMORA_METRICS_TOKEN`` makes the endpoint require it as a bearer token.
+
+Setting ``CALMORA_PROFILE_RATE`` (e.g. ``0.01``) runs that fraction of
+requests under cProfile and writes each profile to ``CALMORA_PROFILE_DIR``
+as ``<time>-<method>-<route>-<pid>.prof``, for ``python -m pstats`` or
+snakeviz.
+"""
+
+import contextlib
+import cProfile
+import hmac
+import os
+import random
+import re
+import threading
+import time
+
+PROFILE_RATE = float(os.getenv('CALMORA_PROFILE_RATE', 0))
+PROFILE_DIR = os.getenv('CALMORA_PROFILE_DIR', 'profiles')
+# Bearer token a scraper must send to /metrics; unset, the endpoint is open
+METRICS_TOKEN = os.getenv('CALMORA_METRICS_TOKEN')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+STAGES = ('auth', 'db', 'json', 'compress', 'write', 'app')
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+
+# Route label of requests that matched no route, so unknown paths can't add series
+UNMATCHED = 'unmatched'
+
+# The request being handled on this thread
+_current = threading.local()
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+    def samples(self, name, label_names):
+        for labels, series in sorted(self.series.items()):
+            base = dict(zip(label_names, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield f'{name}_bucket', {**base, 'le': _format_value(bound)}, cumulative
+            yield f'{name}_bucket', {**base, 'le': '+Inf'}, series[-1]
+            yield f'{name}_sum', base, series[-2]
+            yield f'{name}_count', base, series[-1]
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(round(value, 9))
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _line(name, labels, value):
+    if labels:
+        label_text = ','.join(f'{key}="{_escape(val)}"' for key, val in labels.items())
+        return f'{name}{{{label_text}}} {_format_value(value)}'
+    return f'{name} {_format_value(value)}'
+
+
+class RequestTimer:
+    """Stage times and query count of one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.stack = []  # [stage, started, time spent in nested stages]
+        self.queries = 0
+        self.profile = None
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.requests = {}  # (method, route, status) -> count
+        self.duration = _Histogram(LATENCY_BUCKETS)
+        self.stage_duration = _Histogram(LATENCY_BUCKETS)
+        self.queries = _Histogram(QUERY_BUCKETS)
+        self.profiles = 0
+
+    def begin(self):
+        """Start timing a request on this thread."""
+        timer = RequestTimer()
+        if PROFILE_RATE and random.random() < PROFILE_RATE:
+            timer.profile = cProfile.Profile()
+            timer.profile.enable()
+        _current.timer = timer
+        with self.lock:
+            self.in_flight += 1
+        return timer
+
+    def end(self, timer, method, route, status):
+        """Record a request started with ``begin``."""
+        elapsed = time.perf_counter() - timer.started
+        _current.timer = None
+        if timer.profile is not None:
+            timer.profile.disable()
+            self._dump_profile(timer.profile, method, route)
+        timer.stages['app'] = max(0.0, elapsed - sum(timer.stages.values()))
+        route = route or UNMATCHED
+        with self.lock:
+            self.in_flight -= 1
+            key = (method or '', route, str(status or 0))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.duration.observe((method or '', route), elapsed)
+            for stage, seconds in timer.stages.items():
+                if seconds:
+                    self.stage_duration.observe((route, stage), seconds)
+            self.queries.observe((route,), timer.queries)
+
+    def _dump_profile(self, profile, method, route):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = re.sub(r'[^A-Za-z0-9]+', '_', route or UNMATCHED).strip('_') or 'root'
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        with self.lock:
+            self.profiles += 1
+            sequence = self.profiles
+        profile.dump_stats(os.path.join(PROFILE_DIR, f'{stamp}-{method}-{name}-{os.getpid()}-{sequence}.prof'))
+
+    def render(self, extra=()):
+        """Prometheus text exposition; ``extra`` adds ``(name, type, help, [(labels, value)])`` families."""
+        with self.lock:
+            families = [
+                ('calmora_requests_in_flight', 'gauge', 'Requests being handled', [({}, self.in_flight)]),
+                ('calmora_requests_total', 'counter', 'Requests handled, by route and status', [
+                    ({'method': method, 'route': route, 'status': status}, count)
+                    for (method, route, status), count in sorted(self.requests.items())
+                ]),
+                ('calmora_request_duration_seconds', 'histogram', 'Time to handle a request',
+                 list(self.duration.samples('calmora_request_duration_seconds', ('method', 'route')))),
+                ('calmora_request_stage_seconds', 'histogram', 'Time per request spent in each stage',
+                 list(self.stage_duration.samples('calmora_request_stage_seconds', ('route', 'stage')))),
+                ('calmora_request_db_queries', 'histogram', 'SQLite statements run per request',
+                 list(self.queries.samples('calmora_request_db_queries', ('route',)))),
+                ('calmora_profiles_written_total', 'counter', 'Sampled request profiles written',
+                 [({}, self.profiles)]),
+            ]
+        lines = []
+        for name, kind, help_text, samples in list(families) + list(extra):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for sample in samples:
+                if len(sample) == 3:
+                    lines.append(_line(*sample))
+                else:
+                    lines.append(_line(name, *sample))
+        return ('\n'.join(lines) + '\n').encode()
+
+
+registry = Registry()
+
+
+def current():
+    """Timer of the request being handled on this thread, or None."""
+    return getattr(_current, 'timer', None)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Count the time spent in the block towards ``name`` for the current request."""
+    timer = getattr(_current, 'timer', None)
+    if timer is None:
+        yield
+        return
+    frame = [name, time.perf_counter(), 0.0]
+    timer.stack.append(frame)
+    try:
+        yield
+    finally:
+        timer.stack.pop()
+        elapsed = time.perf_counter() - frame[1]
+        timer.stages[name] += elapsed - frame[2]
+        if timer.stack:
+            timer.stack[-1][2] += elapsed
+
+
+def count_query():
+    """Count one SQLite statement towards the current request."""
+    timer = getattr(_current, 'timer', None)
+    if timer is not None:
+        timer.queries += 1
+
+
+def snapshot_families(name, help_text, snapshot):
+    """Gauge families for the numbers in a ``snapshot()`` dict, e.g. a cache's."""
+    return [
+        (f'{name}_{key}', 'gauge', f'{help_text}: {key.replace("_", " ")}', [({}, value)])
+        for key, value in snapshot.items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    ]
+
+
+def authorized(authorization):
+    """True if a request may read /metrics: always, unless ``CALMORA_METRICS_TOKEN`` is set."""
+    if not METRICS_TOKEN:
+        return True
+    return hmac.compare_digest(authorization or '', f'Bearer {METRICS_TOKEN}')
+
+
+class WSGIMetrics:
+    """WSGI middleware timing each request of app.py, including writing the response.
+
+    The app stores its matched route in ``environ['calmora.route']``.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        timer = registry.begin()
+        status = []
+
+        def recording_start_response(status_line, headers, exc_info=None):
+            status[:] = [status_line.split(' ', 1)[0]]
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            iterable = self.app(environ, recording_start_response)
+        except BaseException:
+            registry.end(timer, environ.get('REQUEST_METHOD'), environ.get('calmora.route'), 500)
+            raise
+        return self._iterate(iterable, timer, environ, status)
+
+    def _iterate(self, iterable, timer, environ, status):
+        _current.timer = timer
+        try:
+            for chunk in iterable:
+                # The server writes the chunk before asking for the next one
+                started = time.perf_counter()
+                _current.timer = None
+                yield chunk
+                _current.timer = timer
+                timer.stages['write'] += time.perf_counter() - started
+        finally:
+            _current.timer = timer
+            if hasattr(iterable, 'close'):
+                iterable.close()
+            registry.end(timer, environ.get('REQUEST_METHOD'), environ.get('calmora.route'),
+                         status[0] if status else 500)
@@ -0,0 +1,261 @@
+"""
+Calmora Backend - Versioned schema migrations shared by both backends
+
+Both backends call ``migrate`` at start-up instead of creating tables
+themselves. Applied migrations are recorded in ``schema_migrations``, so
+each runs once per database; pending ones run in order before the server
+accepts requests, and take only the locks their statements need, so
+other processes on the same database keep serving meanwhile.
+
+Databases from before this module already hold some or all of the
+schema, so every migration must be idempotent: ``IF NOT EXISTS``,
+column checks before ``ALTER TABLE``, and data steps that skip work
+already done. Two processes starting at once may then both run a
+migration without harm.
+
+To change the schema, append a migration; never edit one that shipped.
+
+``check_query_plans`` runs ``EXPLAIN QUERY PLAN`` over the queries on
+the request path and reports any that would scan a whole table, for
+``python server.py --check-query-plans`` / ``flask check-query-plans``.
+"""
+
+import datetime
+import re
+
+import analytics
+import entries
+import reminders
+import search
+import tokencache
+
+
+def _columns(c, table):
+    c.execute(f'PRAGMA table_info({table})')
+    return [row[1] for row in c.fetchall()]
+
+
+def _has_unique_index(c, table, columns):
+    """True if some unique index on ``table`` covers exactly ``columns``."""
+    c.execute(f'PRAGMA index_list({table})')
+    for _, name, unique, _, partial in c.fetchall():
+        if unique and not partial:
+            c.execute(f'PRAGMA index_info({name})')
+            if [row[2] for row in c.fetchall()] == list(columns):
+                return True
+    return False
+
+
+# ============== MIGRATIONS ==============
+
+def _initial_schema(conn):
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            profile_data TEXT DEFAULT '{}',
+            token_version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS user_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            data_type TEXT NOT NULL,
+            data TEXT DEFAULT '{}',
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE (user_id, data_type)
+        )
+    ''')
+    entries.create_schema(c)
+    analytics.create_schema(c)
+    tokencache.create_schema(c)
+
+
+def _added_columns(conn):
+    """Columns added after the first release, and ``users.updated_at``, which only app.py created."""
+    entries.add_version_column(conn)
+    tokencache.add_token_version_column(conn)
+    c = conn.cursor()
+    if 'updated_at' not in _columns(c, 'users'):
+        # ALTER TABLE can't add a CURRENT_TIMESTAMP default
+        c.execute('ALTER TABLE users ADD COLUMN updated_at TIMESTAMP')
+
+
+def _unique_user_data(conn):
+    """One document per user and type; tables made by app.py's create_all had no constraint."""
+    c = conn.cursor()
+    if _has_unique_index(c, 'user_data', ('user_id', 'data_type')):
+        return None
+    # Keep the newest copy of any duplicated document
+    c.execute('''
+        DELETE FROM user_data WHERE id NOT IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (
+                    PARTITION BY user_id, data_type ORDER BY version DESC, id DESC
+                ) AS position
+                FROM user_data
+            ) WHERE position = 1
+        )
+    ''')
+    removed = c.rowcount
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_user_data_user_type ON user_data (user_id, data_type)')
+    return f'removed {removed} duplicate documents' if removed else None
+
+
+def _version_indexes(conn):
+    """Indexes for change lookups by version and for purging expired revoked tokens."""
+    c = conn.cursor()
+    c.execute('CREATE INDEX IF NOT EXISTS idx_user_data_user_version ON user_data (user_id, version)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_revoked_tokens_expires ON revoked_tokens (expires_at)')
+
+
+def _split_entry_blobs(conn):
+    migrated = entries.migrate_blobs(conn)
+    return f'split {migrated} data documents into entry rows' if migrated else None
+
+
+def _analytics_rollups(conn):
+    return 'built analytics rollups' if analytics.backfill(conn) else None
+
+
+def _journal_search(conn):
+    indexed = search.ensure_index(conn)
+    return f'indexed {indexed} journal entries for search' if indexed else None
+
+
+def _reminders(conn):
+    reminders.create_schema(conn.cursor())
+
+
+# (version, name, function(conn) -> optional note); append only
+MIGRATIONS = [
+    (1, 'initial_schema', _initial_schema),
+    (2, 'added_columns', _added_columns),
+    (3, 'unique_user_data', _unique_user_data),
+    (4, 'version_indexes', _version_indexes),
+    (5, 'split_entry_blobs', _split_entry_blobs),
+    (6, 'analytics_rollups', _analytics_rollups),
+    (7, 'journal_search', _journal_search),
+    (8, 'reminders', _reminders),
+]
+
+
+def _applied(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+    ''')
+    c.execute('SELECT version FROM schema_migrations')
+    return {row[0] for row in c.fetchall()}
+
+
+def schema_version(conn):
+    """Highest migration applied to this database (0 for none)."""
+    applied = _applied(conn.cursor())
+    return max(applied, default=0)
+
+
+def migrate(conn):
+    """Apply pending migrations in order; returns ``[(version, name, note)]`` for those applied."""
+    c = conn.cursor()
+    applied = _applied(c)
+    conn.commit()
+    done = []
+    for version, name, migration in MIGRATIONS:
+        if version in applied:
+            continue
+        note = migration(conn)
+        c.execute('INSERT OR IGNORE INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)',
+                  (version, name, datetime.datetime.utcnow().isoformat()))
+        conn.commit()
+        done.append((version, name, note))
+    return done
+
+
+# ============== QUERY PLANS ==============
+
+# Queries on the request path, as the modules issue them; parameters are placeholders
+HOT_QUERIES = [
+    ('document', 'SELECT data FROM user_data WHERE user_id = ? AND data_type = ?', (1, 'moods')),
+    ('document version', 'SELECT version FROM user_data WHERE user_id = ? AND data_type = ?', (1, 'moods')),
+    ('user version', 'SELECT COALESCE(MAX(version), 0) FROM user_data WHERE user_id = ?', (1,)),
+    ('documents', 'SELECT data_type, data FROM user_data WHERE user_id = ? ORDER BY data_type', (1,)),
+    ('documents since', 'SELECT data_type, data FROM user_data WHERE user_id = ? AND version > ? ORDER BY data_type',
+     (1, 0)),
+    ('bump version', '''
+        UPDATE user_data
+        SET version = (SELECT COALESCE(MAX(version), 0) + 1 FROM user_data WHERE user_id = ?),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE user_id = ? AND data_type = ?
+    ''', (1, 1, 'moods')),
+    ('change feed poll', 'SELECT user_id, MAX(version) FROM user_data WHERE user_id IN (?, ?) GROUP BY user_id',
+     (1, 2)),
+    ('change feed deliver',
+     'SELECT data_type, version FROM user_data WHERE user_id = ? AND version > ? ORDER BY version', (1, 0)),
+    ('entries', 'SELECT data FROM user_entries WHERE user_id = ? AND data_type = ? ORDER BY created_at DESC, id DESC',
+     (1, 'moods')),
+    ('entries page', 'SELECT id, created_at, data FROM user_entries WHERE user_id = ? AND data_type = ? '
+     'AND (created_at < ? OR (created_at = ? AND id < ?)) ORDER BY created_at DESC, id DESC LIMIT ?',
+     (1, 'moods', '2024', '2024', 1, 51)),
+    ('entries by key', 'SELECT id, created_at, data FROM user_entries '
+     'WHERE user_id = ? AND data_type = ? AND entry_key = ?', (1, 'moods', '1')),
+    ('export entries', 'SELECT data_type, data FROM user_entries WHERE user_id = ? '
+     'ORDER BY data_type, created_at, id', (1,)),
+    ('mood day', '''
+        SELECT COUNT(v), SUM(v), MIN(v), MAX(v) FROM (
+            SELECT json_extract(data, '$.mood') AS v FROM user_entries
+            WHERE user_id = ? AND data_type = ? AND created_at >= ? AND created_at < ?
+              AND json_type(data, '$.mood') IN ('integer', 'real')
+        )
+    ''', (1, 'moods', '2024-01-01', '2024-01-02')),
+    ('mood trend', 'SELECT bucket, count, total, min_mood, max_mood FROM mood_rollups '
+     'WHERE user_id = ? AND granularity = ? AND bucket >= ? ORDER BY bucket', (1, 'day', '2024-01-01')),
+    ('habit check-in day', '''
+        SELECT 1 FROM user_entries
+        WHERE user_id = ? AND data_type = ? AND created_at >= ? AND created_at < ? AND entry_key = ?
+        LIMIT 1
+    ''', (1, 'habit_checkins', '2024-01-01', '2024-01-02', '1')),
+    ('habit runs', 'SELECT habit_id, start_date, end_date FROM habit_runs WHERE user_id = ? ORDER BY start_date',
+     (1,)),
+    ('login', 'SELECT id, password_hash, token_version FROM users WHERE username = ?', ('a',)),
+    ('register check', 'SELECT id FROM users WHERE username = ? OR email = ?', ('a', 'a@x')),
+    ('token version', 'SELECT token_version FROM users WHERE id = ?', (1,)),
+    ('revoked token', 'SELECT 1 FROM revoked_tokens WHERE jti = ?', ('x',)),
+    ('purge revoked tokens', 'DELETE FROM revoked_tokens WHERE expires_at < ?', (0.0,)),
+    ('reminders', 'SELECT id FROM reminders WHERE user_id = ? ORDER BY id', (1,)),
+    ('reminder count', 'SELECT COUNT(*) FROM reminders WHERE user_id = ?', (1,)),
+    ('reminders overdue', 'SELECT next_fire_at, id FROM reminders WHERE enabled = 1 AND next_fire_at < ?', (0,)),
+    ('reminders window', 'SELECT next_fire_at, id FROM reminders WHERE enabled = 1 AND next_fire_at >= ? '
+     'AND next_fire_at < ?', (0, 3600)),
+    ('reminders due', 'SELECT id FROM reminders WHERE id IN (?, ?)', (1, 2)),
+]
+
+# "SCAN users" (3.36+) or "SCAN TABLE users" (older)
+_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+
+
+def check_query_plans(conn, queries=HOT_QUERIES):
+    """``[(name, plan step)]`` for every query that would scan a whole table."""
+    c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND sql NOT LIKE 'CREATE VIRTUAL TABLE%'")
+    tables = {row[0] for row in c.fetchall()}
+    problems = []
+    for name, sql, params in queries:
+        c.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        for row in c.fetchall():
+            detail = row[-1]
+            match = _SCAN.match(detail)
+            if match and match.group(1) in tables:
+                problems.append((name, detail))
+    return problems
@@ -0,0 +1,167 @@
+"""
+Calmora Backend - Password hashing off the request threads
+
+Hashing a password with a proper KDF (Werkzeug's ``generate_password_hash``,
+scrypt by default) takes tens of milliseconds of CPU on purpose. Done on
+the request threads, a burst of logins holds the GIL and every worker
+until it has passed, and data routes stall behind it. Both backends
+instead hand the work to a pool of ``WORKERS`` processes:
+
+* at most ``WORKERS`` hashes run at once, and up to ``MAX_WAITING``
+  more wait up to ``QUEUE_TIMEOUT`` seconds for a turn,
+* past that, ``Overloaded`` is raised and the request is answered with a
+  503 and ``Retry-After`` straight away, so a login storm slows logins
+  down instead of the whole server.
+
+Both backends store Werkzeug's format. Hashes written by older versions
+of server.py (unsalted SHA-256 hex digests) are still accepted, and
+``needs_rehash`` tells the login routes to replace them with the strong
+format once the password is known, so either backend can serve any user.
+
+``CALMORA_HASH_WORKERS=0`` hashes on the calling thread instead, still
+capped by the same limits.
+"""
+
+import concurrent.futures
+import hashlib
+import hmac
+import math
+import multiprocessing
+import os
+import re
+import threading
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+WORKERS = int(os.getenv('CALMORA_HASH_WORKERS', min(4, os.cpu_count() or 1)))
+MAX_WAITING = int(os.getenv('CALMORA_HASH_QUEUE', 32))
+QUEUE_TIMEOUT = float(os.getenv('CALMORA_HASH_TIMEOUT', 2))
+# Werkzeug's current default (scrypt) unless set, e.g. to pbkdf2:sha256:600000
+METHOD = os.getenv('CALMORA_HASH_METHOD') or None
+
+# Seconds a rejected client is told to wait
+RETRY_AFTER = max(1, math.ceil(QUEUE_TIMEOUT))
+
+# What server.py stored before this module: sha256(password).hexdigest()
+LEGACY_HASH = re.compile(r'^[0-9a-f]{64}$')
+
+
+class Overloaded(Exception):
+    """Too many passwords being hashed already (503)."""
+
+    retry_after = RETRY_AFTER
+
+
+def is_legacy(stored):
+    return bool(stored) and LEGACY_HASH.match(stored) is not None
+
+
+def needs_rehash(stored):
+    """True if a hash that just verified should be replaced with the current format."""
+    if is_legacy(stored):
+        return True
+    return METHOD is not None and not stored.startswith(METHOD + '$')
+
+
+def _hash(password, method):
+    if method is None:
+        return generate_password_hash(password)
+    return generate_password_hash(password, method)
+
+
+def _verify(password, stored):
+    if is_legacy(stored):
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+    return check_password_hash(stored, password)
+
+
+class PasswordHasher:
+    """Runs hashes in a process pool, ``workers`` at a time, rejecting what can't wait."""
+
+    def __init__(self, workers=WORKERS, max_waiting=MAX_WAITING, queue_timeout=QUEUE_TIMEOUT):
+        self.workers = workers
+        self.max_waiting = max_waiting
+        self.queue_timeout = queue_timeout
+        self.slots = threading.BoundedSemaphore(max(1, workers))
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.executor = None
+        self.executor_pid = None
+
+    def hash(self, password):
+        return self._run(_hash, password, METHOD)
+
+    def verify(self, password, stored):
+        if not stored:
+            return False
+        return self._run(_verify, password, stored)
+
+    def _run(self, fn, *args):
+        with self.lock:
+            if self.waiting >= self.max_waiting:
+                self.rejected += 1
+                raise Overloaded('Too many logins at once, try again shortly')
+            self.waiting += 1
+        try:
+            acquired = self.slots.acquire(timeout=self.queue_timeout)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+        if not acquired:
+            with self.lock:
+                self.rejected += 1
+            raise Overloaded('Too many logins at once, try again shortly')
+
+        with self.lock:
+            self.running += 1
+        try:
+            if self.workers <= 0:
+                return fn(*args)
+            try:
+                return self._executor().submit(fn, *args).result()
+            except concurrent.futures.BrokenExecutor:
+                # A worker died (e.g. killed for memory); start a fresh pool next time
+                with self.lock:
+                    self.executor = None
+                raise
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+            self.slots.release()
+
+    def _executor(self):
+        with self.lock:
+            # A pool inherited through fork (server.py --processes) has no workers in this process
+            if self.executor is None or self.executor_pid != os.getpid():
+                # Spawned, not forked: forking a process with running threads can copy held locks
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context('spawn'))
+                self.executor_pid = os.getpid()
+            return self.executor
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'running': self.running,
+                'waiting': self.waiting,
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
+
+
+hasher = PasswordHasher()
+
+
+def hash_password(password):
+    """Strong hash of ``password``; raises ``Overloaded`` when the pool is saturated."""
+    return hasher.hash(password)
+
+
+def verify_password(password, stored):
+    """True if ``password`` matches a stored hash of either format; may raise ``Overloaded``."""
+    return hasher.verify(password, stored)
@@ -0,0 +1,183 @@
+"""
+Calmora Backend - Partial document updates
+
+Implements RFC 6902 JSON Patch and RFC 7396 JSON Merge Patch so clients
+can change one field of a document (e.g. tick one habit) without sending
+the whole thing back.
+"""
+
+import copy
+
+JSON_PATCH = 'application/json-patch+json'
+MERGE_PATCH = 'application/merge-patch+json'
+
+
+class PatchError(ValueError):
+    """The patch is well-formed but cannot be applied to the document."""
+
+
+def apply_merge_patch(target, patch):
+    """RFC 7396: objects merge recursively, ``null`` removes a member."""
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = apply_merge_patch(result.get(key), value)
+    return result
+
+
+def _parse_pointer(pointer):
+    """Tokens of a JSON pointer; a malformed one makes the whole patch malformed."""
+    if pointer == '':
+        return []
+    if not isinstance(pointer, str) or not pointer.startswith('/'):
+        raise ValueError(f'Invalid JSON pointer: {pointer!r}')
+    return [part.replace('~1', '/').replace('~0', '~') for part in pointer[1:].split('/')]
+
+
+def _json_equal(a, b):
+    """RFC 6902 equality for ``test``: like ``==``, but ``true`` is not ``1`` and ``1`` is not ``"1"``.
+
+    Numbers still compare by value, so ``1`` equals ``1.0``.
+    """
+    if isinstance(a, bool) or isinstance(b, bool):
+        return type(a) is type(b) and a == b
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return a == b
+    if isinstance(a, dict):
+        return isinstance(b, dict) and a.keys() == b.keys() and all(_json_equal(a[k], b[k]) for k in a)
+    if isinstance(a, list):
+        return isinstance(b, list) and len(a) == len(b) and all(map(_json_equal, a, b))
+    return type(a) is type(b) and a == b
+
+
+def _array_index(container, token, allow_end=False):
+    if allow_end and token == '-':
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token[0] == '0'):
+        raise PatchError(f'Invalid array index: {token!r}')
+    index = int(token)
+    if index > len(container) or (index == len(container) and not allow_end):
+        raise PatchError(f'Array index out of range: {index}')
+    return index
+
+
+def _resolve(doc, parts):
+    """Walk to the parent container of the last pointer token."""
+    node = doc
+    for token in parts[:-1]:
+        if isinstance(node, dict):
+            if token not in node:
+                raise PatchError(f'Path not found: {token!r}')
+            node = node[token]
+        elif isinstance(node, list):
+            node = node[_array_index(node, token)]
+        else:
+            raise PatchError(f'Cannot traverse into {type(node).__name__}')
+    return node
+
+
+def _get(doc, parts):
+    if not parts:
+        return doc
+    parent = _resolve(doc, parts)
+    token = parts[-1]
+    if isinstance(parent, dict):
+        if token not in parent:
+            raise PatchError(f'Path not found: {token!r}')
+        return parent[token]
+    if isinstance(parent, list):
+        return parent[_array_index(parent, token)]
+    raise PatchError(f'Cannot read from {type(parent).__name__}')
+
+
+def _add(doc, parts, value):
+    if not parts:
+        return value
+    parent = _resolve(doc, parts)
+    token = parts[-1]
+    if isinstance(parent, dict):
+        parent[token] = value
+    elif isinstance(parent, list):
+        parent.insert(_array_index(parent, token, allow_end=True), value)
+    else:
+        raise PatchError(f'Cannot add to {type(parent).__name__}')
+    return doc
+
+
+def _remove(doc, parts):
+    if not parts:
+        raise PatchError('Cannot remove the whole document')
+    parent = _resolve(doc, parts)
+    token = parts[-1]
+    if isinstance(parent, dict):
+        if token not in parent:
+            raise PatchError(f'Path not found: {token!r}')
+        return parent.pop(token)
+    if isinstance(parent, list):
+        return parent.pop(_array_index(parent, token))
+    raise PatchError(f'Cannot remove from {type(parent).__name__}')
+
+
+def apply_json_patch(doc, operations):
+    """RFC 6902: apply all operations or none. Returns the patched copy.
+
+    Raises ValueError for a malformed patch and PatchError when an
+    operation does not apply to this document (including failed tests).
+    """
+    if not isinstance(operations, list):
+        raise ValueError('JSON Patch must be an array of operations')
+
+    doc = copy.deepcopy(doc)
+    for op in operations:
+        if not isinstance(op, dict) or 'op' not in op or 'path' not in op:
+            raise ValueError('Each operation needs "op" and "path"')
+        name = op['op']
+        parts = _parse_pointer(op['path'])
+
+        if name in ('add', 'replace', 'test') and 'value' not in op:
+            raise ValueError(f'"{name}" needs a "value"')
+        if name in ('move', 'copy') and 'from' not in op:
+            raise ValueError(f'"{name}" needs a "from"')
+
+        if name == 'add':
+            doc = _add(doc, parts, copy.deepcopy(op['value']))
+        elif name == 'remove':
+            _remove(doc, parts)
+        elif name == 'replace':
+            _get(doc, parts)
+            if not parts:
+                doc = copy.deepcopy(op['value'])
+            else:
+                _remove(doc, parts)
+                doc = _add(doc, parts, copy.deepcopy(op['value']))
+        elif name == 'move':
+            source = _parse_pointer(op['from'])
+            if parts[:len(source)] == source and parts != source:
+                raise PatchError('Cannot move a value into itself')
+            value = _remove(doc, source)
+            doc = _add(doc, parts, value)
+        elif name == 'copy':
+            value = copy.deepcopy(_get(doc, _parse_pointer(op['from'])))
+            doc = _add(doc, parts, value)
+        elif name == 'test':
+            if not _json_equal(_get(doc, parts), op['value']):
+                raise PatchError(f'Test failed at {op["path"]!r}')
+        else:
+            raise ValueError(f'Unknown operation: {name!r}')
+    return doc
+
+
+def apply_patch(doc, body, content_type):
+    """Apply a PATCH body according to its Content-Type.
+
+    Merge patch is used for ``application/merge-patch+json`` and for plain
+    JSON objects; arrays are treated as JSON Patch.
+    """
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type == MERGE_PATCH or (content_type != JSON_PATCH and isinstance(body, dict)):
+        return apply_merge_patch(doc, body)
+    return apply_json_patch(doc, body)
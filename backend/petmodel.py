@@ -0,0 +1,194 @@
+"""
+Calmora Backend - The virtual pet, simulated lazily from elapsed time
+
+The stored ``pet`` document holds the pet's stats as of ``simulatedAt``.
+Nothing ticks on the server or has to be written back periodically:
+``evaluate`` works out the stats at any later moment in closed form,
+so ``GET /api/pet`` returns the same pet on every device, and only
+actions (``POST /api/pet/actions``) and edits write.
+
+Stats change at the rates of VirtualPetPage's 3-second timer, expressed
+per second. Its 5% chance per tick of a dirty pet falling sick becomes a
+fixed delay: a pet stays below ``SICK_HYGIENE`` for ``SICK_DELAY``
+seconds (the expected wait) before it is sick, so evaluation is
+deterministic.
+
+A pet document without ``simulatedAt`` (written before this module)
+is taken as current when it is next read or acted on.
+"""
+
+import datetime
+
+STATS = ('hunger', 'energy', 'fun', 'hygiene', 'happiness', 'health')
+COUNTERS = ('level', 'xp', 'xpToNext', 'coins')
+
+# A new pet, as VirtualPetPage starts one
+DEFAULTS = {
+    'type': 'bear',
+    'name': 'Mochi',
+    'level': 1,
+    'xp': 0,
+    'xpToNext': 100,
+    'happiness': 80,
+    'hunger': 50,
+    'energy': 80,
+    'fun': 70,
+    'health': 100,
+    'hygiene': 100,
+    'coins': 500,
+    'isSick': False,
+    'isSleeping': False,
+}
+
+# Change per second
+HUNGER_RATE = 1 / 3
+ENERGY_RATE = -0.1
+SLEEP_ENERGY_RATE = 1 / 3
+FUN_RATE = -2 / 3
+HYGIENE_RATE = -1 / 6
+HAPPINESS_RATE = -1 / 6
+SICK_HAPPINESS_RATE = -1 / 3
+SICK_HEALTH_RATE = -1 / 3
+
+SICK_HYGIENE = 30
+SICK_DELAY = 60
+SICK_HEALTH_LOSS = 8
+
+# Applied by POST /api/pet/actions, as the page's buttons do
+ACTIONS = {
+    'feed': {'hunger': -30, 'happiness': 10, 'energy': -5, 'fun': 5, 'xp': 10, 'coins': 5},
+    'play': {'hunger': 10, 'happiness': 20, 'energy': -15, 'fun': 25, 'xp': 15, 'coins': 8},
+    'rest': {'hunger': 5, 'happiness': 5, 'energy': 30, 'fun': -10, 'xp': 5, 'coins': 2},
+    'train': {'hunger': 15, 'happiness': -5, 'energy': -20, 'fun': 10, 'xp': 25, 'coins': 10},
+    'bath': {'hygiene': 100, 'happiness': 10},
+}
+
+MESSAGES = {
+    'feed': 'Yum! +5 coins',
+    'play': 'Fun! +8 coins',
+    'rest': 'Rest! +2 coins',
+    'train': 'Train! +10 coins',
+    'bath': 'So clean! +10 happy!',
+}
+
+
+class PetActionError(ValueError):
+    """An action the pet can't do right now (409)."""
+
+
+def clamp(value):
+    return max(0.0, min(100.0, value))
+
+
+def format_time(moment):
+    return datetime.datetime.fromtimestamp(moment, datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+def parse_time(value):
+    """Epoch seconds of an ISO timestamp, or None if missing or invalid."""
+    if not isinstance(value, str):
+        return None
+    try:
+        moment = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return moment.timestamp()
+
+
+def _number(value, default):
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else default
+
+
+def evaluate(doc, now):
+    """The pet at epoch time ``now``: ``doc`` with its stats advanced and ``simulatedAt`` set to now."""
+    pet = {**DEFAULTS, **(doc or {})}
+    for stat in STATS:
+        pet[stat] = clamp(_number(pet[stat], DEFAULTS[stat]))
+    for counter in COUNTERS:
+        pet[counter] = _number(pet[counter], DEFAULTS[counter])
+    started = parse_time(pet.get('simulatedAt'))
+    elapsed = max(0.0, now - started) if started is not None else 0.0
+
+    hygiene = pet['hygiene']
+    pet['hunger'] = clamp(pet['hunger'] + HUNGER_RATE * elapsed)
+    pet['fun'] = clamp(pet['fun'] + FUN_RATE * elapsed)
+    pet['hygiene'] = clamp(hygiene + HYGIENE_RATE * elapsed)
+
+    if pet['isSleeping']:
+        # Sleeps until fully rested, then tires again
+        wakes = (100 - pet['energy']) / SLEEP_ENERGY_RATE
+        if elapsed < wakes:
+            pet['energy'] = clamp(pet['energy'] + SLEEP_ENERGY_RATE * elapsed)
+        else:
+            pet['energy'] = clamp(100 + ENERGY_RATE * (elapsed - wakes))
+            pet['isSleeping'] = False
+    else:
+        pet['energy'] = clamp(pet['energy'] + ENERGY_RATE * elapsed)
+
+    if pet['isSick']:
+        sick_for = elapsed
+    else:
+        dirty_at = max(0.0, (hygiene - SICK_HYGIENE) / -HYGIENE_RATE)
+        sick_for = max(0.0, elapsed - dirty_at - SICK_DELAY)
+        if elapsed >= dirty_at + SICK_DELAY:
+            pet['isSick'] = True
+            pet['health'] = clamp(pet['health'] - SICK_HEALTH_LOSS)
+    if pet['isSick']:
+        pet['health'] = clamp(pet['health'] + SICK_HEALTH_RATE * sick_for)
+    pet['happiness'] = clamp(pet['happiness'] + HAPPINESS_RATE * (elapsed - sick_for)
+                             + SICK_HAPPINESS_RATE * sick_for)
+
+    for stat in STATS:
+        pet[stat] = round(pet[stat], 2)
+    pet['simulatedAt'] = format_time(now)
+    return pet
+
+
+def stamp(doc, now):
+    """A pet written whole by a client, taken as current at ``now``."""
+    return {**doc, 'simulatedAt': format_time(now)}
+
+
+def apply_action(doc, action, now):
+    """The pet after ``action`` at ``now``; returns ``(pet, message)``.
+
+    Raises ValueError for an unknown action and PetActionError when the
+    pet is asleep, too tired or too sick for it.
+    """
+    if action not in ACTIONS:
+        raise ValueError(f'Unknown action: {action}')
+    pet = evaluate(doc, now)
+    if pet['isSleeping'] and action not in ('rest', 'bath'):
+        raise PetActionError(f"{pet['name']} is sleeping!")
+    if pet['energy'] < 10 and action not in ('rest', 'bath'):
+        raise PetActionError('Too tired! Rest first.')
+    if pet['health'] < 30 and action == 'play':
+        raise PetActionError('Too sick to play!')
+    if action == 'bath' and pet['hygiene'] >= 100:
+        raise PetActionError('Already clean!')
+
+    effect = ACTIONS[action]
+    was_sick, health = pet['isSick'], pet['health']
+    for stat, change in effect.items():
+        if stat == 'hygiene':
+            pet[stat] = clamp(change)
+        elif stat in STATS:
+            pet[stat] = round(clamp(pet[stat] + change), 2)
+        else:
+            pet[stat] += change
+    if action == 'rest' and was_sick:
+        pet['health'] = round(clamp(health + 5), 2)
+    if action != 'bath':
+        pet['isSick'] = was_sick and health < 50
+
+    message = MESSAGES[action]
+    while pet['xp'] >= pet['xpToNext'] > 0:
+        pet['level'] += 1
+        pet['xp'] -= pet['xpToNext']
+        pet['xpToNext'] = int(pet['xpToNext'] * 1.5)
+        pet['coins'] += 50
+        pet['health'] = 100.0
+        message = 'Level Up! +50 coins! Full heal!'
+    return pet, message
@@ -0,0 +1,125 @@
+"""
+Calmora Backend - Pre-fork process supervisor
+
+Runs N copies of the server in separate processes so JSON parsing and
+token hashing can use every core. Workers either share one listening
+socket created before fork, or (``reuse_port=True``) each bind their own
+with SO_REUSEPORT so the kernel balances connections between them.
+
+The supervisor restarts workers that die and, on SIGTERM/SIGINT, asks
+every worker to drain (SIGTERM) before killing stragglers.
+"""
+
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+# A worker that dies this soon after starting is crash-looping; back off
+MIN_WORKER_LIFETIME = 1.0
+RESTART_BACKOFF = 1.0
+
+
+def bind_socket(host, port, reuse_port=False, backlog=1024):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def reuse_port_supported():
+    return hasattr(socket, 'SO_REUSEPORT')
+
+
+class Supervisor:
+    """Forks ``processes`` workers running ``target(sock)`` and keeps them alive."""
+
+    def __init__(self, target, host, port, processes, reuse_port=False, drain_timeout=30):
+        self.target = target
+        self.host = host
+        self.port = port
+        self.processes = processes
+        self.reuse_port = reuse_port and reuse_port_supported()
+        self.drain_timeout = drain_timeout
+        self.sock = None
+        self.workers = {}  # pid -> (slot, started_at)
+        self.stopping = False
+
+    def log(self, message):
+        print(f"[supervisor {os.getpid()}] {message}", flush=True)
+
+    def run(self):
+        if not self.reuse_port:
+            # Bound once here; every forked worker accepts on the same socket
+            self.sock = bind_socket(self.host, self.port)
+
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+
+        for slot in range(self.processes):
+            self._spawn(slot)
+
+        deadline = None
+        while self.workers:
+            if self.stopping and deadline is None:
+                deadline = time.monotonic() + self.drain_timeout
+                self._signal_workers(signal.SIGTERM)
+            if deadline is not None and time.monotonic() > deadline:
+                self.log("Drain timeout reached, killing remaining workers")
+                self._signal_workers(signal.SIGKILL)
+                deadline = float('inf')
+
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                time.sleep(0.2)
+                continue
+
+            slot, started_at = self.workers.pop(pid)
+            if self.stopping:
+                continue
+
+            code = os.waitstatus_to_exitcode(status)
+            self.log(f"Worker {pid} (slot {slot}) exited with {code}, restarting")
+            if time.monotonic() - started_at < MIN_WORKER_LIFETIME:
+                time.sleep(RESTART_BACKOFF)
+            self._spawn(slot)
+
+        if self.sock is not None:
+            self.sock.close()
+        self.log("All workers stopped")
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def _signal_workers(self, signum):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _spawn(self, slot):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = (slot, time.monotonic())
+            return
+
+        # Worker: only the supervisor reacts to Ctrl+C; workers drain on SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        code = 0
+        try:
+            sock = self.sock if self.sock is not None else bind_socket(self.host, self.port, reuse_port=True)
+            self.target(sock)
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
@@ -0,0 +1,440 @@
+"""
+Calmora Backend - Server-side reminders
+
+The frontend's daily reminders (``scheduleDailyNotification``) are timers
+in an open tab. ``/api/reminders`` stores them on the server instead:
+each reminder fires at a local time of day (``"HH:MM"``) in the user's
+IANA timezone, on the weekdays it is set for, whether or not a tab is
+open.
+
+Each row keeps its next firing as epoch seconds in ``next_fire_at``,
+worked out whenever the reminder is saved or fires, with a partial index
+over enabled reminders. One ``Scheduler`` thread per process holds only
+the firings due in the next ``HORIZON`` seconds in a heap, topped up by
+an indexed range scan of that index as time moves on, so a tick costs
+O(due reminders) and memory stays flat however many schedules exist.
+After a restart the first scan is all the state it needs to rebuild:
+overdue reminders are in it too.
+
+A due reminder is claimed by moving its ``next_fire_at`` on with a
+compare-and-set update, and only then handed to the sink. Every worker
+process of ``server.py --processes`` runs a scheduler over the same
+table; the claim makes sure one of them delivers each firing. Delivery
+is at most once: a firing claimed by a process that dies before its sink
+runs is lost, and one missed by more than ``MISFIRE_GRACE`` (say the
+server was down overnight) is skipped rather than delivered late.
+
+Sinks are objects with ``deliver(reminder)``. ``LogSink`` prints to the
+log and ``QueueSink`` collects deliveries for tests; set
+``CALMORA_REMINDER_SINK=package.module:factory`` to plug in a real one
+(web push, email).
+"""
+
+import datetime
+import heapq
+import importlib
+import os
+import queue
+import re
+import threading
+import time
+import zoneinfo
+
+ENABLED = os.getenv('CALMORA_REMINDERS', '1') == '1'
+HORIZON = int(os.getenv('CALMORA_REMINDER_HORIZON', 3600))
+MISFIRE_GRACE = int(os.getenv('CALMORA_REMINDER_GRACE', 3600))
+SINK = os.getenv('CALMORA_REMINDER_SINK', 'log')
+MAX_PER_USER = int(os.getenv('CALMORA_REMINDER_MAX', 50))
+
+# Longest the thread sleeps without checking the heap, so clock jumps are noticed
+MAX_SLEEP = 60
+
+# Reminders read per query when firing
+CHUNK = 500
+
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+EVERY_DAY = 0b1111111
+
+KINDS = ('custom', 'mood', 'habit', 'journal', 'breathing', 'water', 'pet')
+
+_TIME = re.compile(r'^([01]\d|2[0-3]):([0-5]\d)$')
+
+_COLUMNS = ('id, user_id, kind, title, body, time_of_day, timezone, days, enabled, next_fire_at, last_fired_at, '
+            'created_at, updated_at')
+
+
+def create_schema(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL DEFAULT 'custom',
+            title TEXT NOT NULL,
+            body TEXT NOT NULL DEFAULT '',
+            time_of_day TEXT NOT NULL,
+            timezone TEXT NOT NULL DEFAULT 'UTC',
+            days INTEGER NOT NULL DEFAULT 127,
+            enabled INTEGER NOT NULL DEFAULT 1,
+            next_fire_at INTEGER,
+            last_fired_at INTEGER,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reminders_user ON reminders (user_id)')
+    # Only enabled reminders can fire, so only they are indexed by time
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reminders_next ON reminders (next_fire_at) WHERE enabled = 1')
+
+
+# ============== SCHEDULES ==============
+
+def next_fire(time_of_day, timezone, days, after):
+    """Epoch second of the first firing strictly after ``after``, or None if ``days`` is empty.
+
+    A time skipped by a DST change fires at the same wall-clock offset
+    past the change (02:30 becomes 03:30); a repeated one fires once, the
+    first time round.
+    """
+    if not days & EVERY_DAY:
+        return None
+    tz = zoneinfo.ZoneInfo(timezone)
+    hour, minute = (int(part) for part in time_of_day.split(':'))
+    at = datetime.time(hour, minute)
+    start = datetime.datetime.fromtimestamp(after, tz).date()
+    for offset in range(8):
+        day = start + datetime.timedelta(days=offset)
+        if not days & (1 << day.weekday()):
+            continue
+        moment = int(datetime.datetime.combine(day, at, tzinfo=tz).timestamp())
+        if moment > after:
+            return moment
+    return None
+
+
+def parse_days(value):
+    """Weekday bitmask (bit 0 is Monday) from a list like ``["mon", "fri"]``."""
+    if not isinstance(value, list) or not value:
+        raise ValueError(f'days must be a non-empty list of {", ".join(WEEKDAYS)}')
+    mask = 0
+    for day in value:
+        if not isinstance(day, str) or day.lower() not in WEEKDAYS:
+            raise ValueError(f'Invalid day: {day}')
+        mask |= 1 << WEEKDAYS.index(day.lower())
+    return mask
+
+
+def format_days(mask):
+    return [day for i, day in enumerate(WEEKDAYS) if mask & (1 << i)]
+
+
+def parse_timezone(value):
+    if not isinstance(value, str) or not value:
+        raise ValueError('timezone must be an IANA name such as Europe/Berlin')
+    try:
+        zoneinfo.ZoneInfo(value)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError, OSError):
+        raise ValueError(f'Unknown timezone: {value}') from None
+    return value
+
+
+def parse_reminder(data, existing=None):
+    """Validated columns from a request body, over ``existing`` ones for an update.
+
+    Raises ValueError for a missing or invalid field.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Expected a JSON object')
+    fields = dict(existing or {'kind': 'custom', 'body': '', 'timezone': 'UTC', 'days': EVERY_DAY, 'enabled': 1})
+    if 'title' in data or existing is None:
+        title = data.get('title')
+        if not isinstance(title, str) or not title.strip():
+            raise ValueError('title is required')
+        fields['title'] = title.strip()[:200]
+    if 'body' in data:
+        if not isinstance(data['body'], str):
+            raise ValueError('body must be a string')
+        fields['body'] = data['body'][:1000]
+    if 'kind' in data:
+        if data['kind'] not in KINDS:
+            raise ValueError(f'kind must be one of {", ".join(KINDS)}')
+        fields['kind'] = data['kind']
+    if 'time' in data or existing is None:
+        time_of_day = data.get('time')
+        if not isinstance(time_of_day, str) or not _TIME.match(time_of_day):
+            raise ValueError('time must be HH:MM')
+        fields['time_of_day'] = time_of_day
+    if 'timezone' in data:
+        fields['timezone'] = parse_timezone(data['timezone'])
+    if 'days' in data:
+        fields['days'] = parse_days(data['days'])
+    if 'enabled' in data:
+        if not isinstance(data['enabled'], bool):
+            raise ValueError('enabled must be true or false')
+        fields['enabled'] = int(data['enabled'])
+    return fields
+
+
+def _iso(moment):
+    if moment is None:
+        return None
+    return datetime.datetime.fromtimestamp(moment, datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+def to_dict(row):
+    (reminder_id, _, kind, title, body, time_of_day, timezone, days, enabled, next_fire_at, last_fired_at,
+     created_at, updated_at) = row
+    return {
+        'id': reminder_id,
+        'kind': kind,
+        'title': title,
+        'body': body,
+        'time': time_of_day,
+        'timezone': timezone,
+        'days': format_days(days),
+        'enabled': bool(enabled),
+        'next_fire_at': _iso(next_fire_at) if enabled else None,
+        'last_fired_at': _iso(last_fired_at),
+        'created_at': _iso(created_at),
+        'updated_at': _iso(updated_at),
+    }
+
+
+# ============== STORAGE ==============
+
+def list_reminders(c, user_id):
+    c.execute(f'SELECT {_COLUMNS} FROM reminders WHERE user_id = ? ORDER BY id', (user_id,))
+    return [to_dict(tuple(row)) for row in c.fetchall()]
+
+
+def _load(c, user_id, reminder_id):
+    c.execute(f'SELECT {_COLUMNS} FROM reminders WHERE id = ? AND user_id = ?', (reminder_id, user_id))
+    row = c.fetchone()
+    return tuple(row) if row is not None else None
+
+
+def create_reminder(c, user_id, data, now):
+    """Insert a reminder for ``user_id``. Caller commits, then passes the result to ``Scheduler.schedule``.
+
+    Returns ``(reminder, next_fire_at)``: the reminder as ``to_dict``
+    makes it and its next firing in epoch seconds (None if disabled).
+    """
+    fields = parse_reminder(data)
+    c.execute('SELECT COUNT(*) FROM reminders WHERE user_id = ?', (user_id,))
+    if c.fetchone()[0] >= MAX_PER_USER:
+        raise ValueError(f'At most {MAX_PER_USER} reminders per user')
+    now = int(now)
+    next_fire_at = next_fire(fields['time_of_day'], fields['timezone'], fields['days'], now)
+    c.execute('''
+        INSERT INTO reminders (user_id, kind, title, body, time_of_day, timezone, days, enabled, next_fire_at,
+                               created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (user_id, fields['kind'], fields['title'], fields['body'], fields['time_of_day'], fields['timezone'],
+          fields['days'], fields['enabled'], next_fire_at, now, now))
+    return to_dict(_load(c, user_id, c.lastrowid)), next_fire_at if fields['enabled'] else None
+
+
+def update_reminder(c, user_id, reminder_id, data, now):
+    """Change some fields of a user's reminder; returns what ``create_reminder`` does, or None if it doesn't exist."""
+    row = _load(c, user_id, reminder_id)
+    if row is None:
+        return None
+    existing = dict(zip(('kind', 'title', 'body', 'time_of_day', 'timezone', 'days', 'enabled'), row[2:9]))
+    fields = parse_reminder(data, existing)
+    now = int(now)
+    next_fire_at = next_fire(fields['time_of_day'], fields['timezone'], fields['days'], now)
+    c.execute('''
+        UPDATE reminders
+        SET kind = ?, title = ?, body = ?, time_of_day = ?, timezone = ?, days = ?, enabled = ?, next_fire_at = ?,
+            updated_at = ?
+        WHERE id = ? AND user_id = ?
+    ''', (fields['kind'], fields['title'], fields['body'], fields['time_of_day'], fields['timezone'],
+          fields['days'], fields['enabled'], next_fire_at, now, reminder_id, user_id))
+    return to_dict(_load(c, user_id, reminder_id)), next_fire_at if fields['enabled'] else None
+
+
+def delete_reminder(c, user_id, reminder_id):
+    """True if the reminder existed. Caller commits."""
+    c.execute('DELETE FROM reminders WHERE id = ? AND user_id = ?', (reminder_id, user_id))
+    return c.rowcount > 0
+
+
+# ============== SINKS ==============
+
+class LogSink:
+    """Prints each firing; the default until a real delivery channel is plugged in."""
+
+    def deliver(self, reminder):
+        print(f"🔔 Reminder {reminder['id']} for user {reminder['user_id']}: {reminder['title']}")
+
+
+class QueueSink:
+    """Collects firings in ``queue`` (a ``queue.Queue``), for tests."""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def deliver(self, reminder):
+        self.queue.put(reminder)
+
+
+def load_sink(spec=SINK):
+    """Sink named by ``CALMORA_REMINDER_SINK``: ``log``, ``queue`` or ``module:factory``."""
+    if spec == 'log':
+        return LogSink()
+    if spec == 'queue':
+        return QueueSink()
+    module, sep, name = spec.partition(':')
+    if not sep:
+        raise ValueError(f'Invalid CALMORA_REMINDER_SINK: {spec}')
+    return getattr(importlib.import_module(module), name)()
+
+
+# ============== SCHEDULER ==============
+
+class Scheduler:
+    """Fires due reminders from a heap of the next ``horizon`` seconds' firings.
+
+    ``connect`` opens the SQLite connection the scheduler thread uses.
+    Call ``schedule`` after a reminder is saved so a firing inside the
+    loaded window isn't left to the next scan.
+    """
+
+    def __init__(self, connect, sink=None, horizon=HORIZON, misfire_grace=MISFIRE_GRACE, clock=time.time):
+        self.connect = connect
+        self.sink = sink
+        self.horizon = horizon
+        self.misfire_grace = misfire_grace
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.heap = []  # (fire_at, reminder_id)
+        self.loaded_until = None
+        self.thread = None
+        self.thread_pid = None
+        self.fired = 0
+        self.skipped = 0
+        self.stale = 0
+        self.sink_errors = 0
+        self.scans = 0
+
+    def start(self):
+        """Start the thread in this process; a no-op if it is running."""
+        with self.lock:
+            # A thread started before fork (server.py --processes) doesn't run in the child
+            if self.thread is not None and self.thread_pid == os.getpid() and self.thread.is_alive():
+                return
+            if self.sink is None:
+                self.sink = load_sink()
+            self.heap = []
+            self.loaded_until = None
+            self.thread = threading.Thread(target=self._run, name='calmora-reminders', daemon=True)
+            self.thread_pid = os.getpid()
+            self.thread.start()
+
+    def schedule(self, reminder_id, next_fire_at):
+        """Call after a reminder is saved with ``next_fire_at`` (epoch seconds or None) and committed."""
+        if next_fire_at is None:
+            return
+        with self.lock:
+            if self.loaded_until is None or next_fire_at >= self.loaded_until:
+                return
+            heapq.heappush(self.heap, (next_fire_at, reminder_id))
+        self.wakeup.set()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'running': self.thread is not None and self.thread.is_alive(),
+                'pending': len(self.heap),
+                'fired': self.fired,
+                'skipped': self.skipped,
+                'stale': self.stale,
+                'sink_errors': self.sink_errors,
+                'scans': self.scans,
+            }
+
+    def _run(self):
+        conn = self.connect()
+        c = conn.cursor()
+        while True:
+            now = self.clock()
+            # Top the window up once half of it has passed
+            if self.loaded_until is None or self.loaded_until - now < self.horizon / 2:
+                self._load(c, now)
+            due = []
+            with self.lock:
+                while self.heap and self.heap[0][0] <= now:
+                    entry = heapq.heappop(self.heap)
+                    # The initial scan and schedule() may both have pushed a firing
+                    if not due or due[-1] != entry:
+                        due.append(entry)
+                wait = self.heap[0][0] - now if self.heap else MAX_SLEEP
+            for start in range(0, len(due), CHUNK):
+                self._fire(conn, c, due[start:start + CHUNK], now)
+            if due:
+                continue
+            self.wakeup.wait(max(0.0, min(wait, MAX_SLEEP, self.loaded_until - self.horizon / 2 - now)))
+            self.wakeup.clear()
+
+    def _load(self, c, now):
+        """Push firings up to ``now + horizon``: all overdue ones on the first scan, the next slice after."""
+        until = int(now + self.horizon)
+        if self.loaded_until is None:
+            c.execute('SELECT next_fire_at, id FROM reminders WHERE enabled = 1 AND next_fire_at < ?', (until,))
+        else:
+            c.execute('SELECT next_fire_at, id FROM reminders WHERE enabled = 1 AND next_fire_at >= ? '
+                      'AND next_fire_at < ?', (self.loaded_until, until))
+        rows = c.fetchall()
+        with self.lock:
+            for row in rows:
+                heapq.heappush(self.heap, tuple(row))
+            self.loaded_until = until
+            self.scans += 1
+
+    def _fire(self, conn, c, due, now):
+        placeholders = ', '.join('?' for _ in due)
+        c.execute(f'SELECT {_COLUMNS} FROM reminders WHERE id IN ({placeholders})', [i for _, i in due])
+        rows = {row[0]: tuple(row) for row in c.fetchall()}
+
+        deliveries = []
+        rescheduled = []
+        stale = 0
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            for fire_at, reminder_id in due:
+                row = rows.get(reminder_id)
+                # Deleted, disabled or rescheduled since it was loaded
+                if row is None or not row[8] or row[9] != fire_at:
+                    stale += 1
+                    continue
+                next_fire_at = next_fire(row[5], row[6], row[7], max(now, fire_at))
+                c.execute('UPDATE reminders SET next_fire_at = ?, last_fired_at = ? '
+                          'WHERE id = ? AND next_fire_at = ? AND enabled = 1',
+                          (next_fire_at, int(now), reminder_id, fire_at))
+                if not c.rowcount:
+                    stale += 1
+                    continue
+                rescheduled.append((reminder_id, next_fire_at))
+                if now - fire_at <= self.misfire_grace:
+                    deliveries.append((row, fire_at))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+        for reminder_id, next_fire_at in rescheduled:
+            self.schedule(reminder_id, next_fire_at)
+        sink_errors = 0
+        for row, fire_at in deliveries:
+            reminder = {**to_dict(row), 'user_id': row[1], 'scheduled_for': _iso(fire_at)}
+            try:
+                self.sink.deliver(reminder)
+            except Exception as e:
+                sink_errors += 1
+                print(f"⚠️  Reminder {row[0]} not delivered: {e}")
+        with self.lock:
+            self.fired += len(deliveries)
+            self.skipped += len(rescheduled) - len(deliveries)
+            self.stale += stale
+            self.sink_errors += sink_errors
@@ -0,0 +1,132 @@
+"""
+Calmora Backend - Route table and middleware for server.py
+
+Routes are declared with what they need instead of being found by
+if/elif chains that authenticate and open a read transaction for every
+request first::
+
+    @api.route('GET', '/api/moods', auth=True, db=True, page=True)
+    def get_moods(self): ...
+
+``Router.match`` finds a path's routes in a few dict lookups: exact paths
+in one dict, paths with parameters (``/api/data/<data_type>``,
+``/api/reminders/<int:reminder_id>``) in a tree of path segments where a
+literal segment always wins over a parameter. An unknown path is known
+to be one before any other work is done.
+
+Middleware is a function ``factory(route, call)`` returning ``call``
+wrapped for that route, or ``call`` itself for routes it has nothing to
+do for. ``Router.compile`` wraps every handler once, at start-up, so a
+public route without a body pays for no token check, body parsing or
+database connection. Wrapped handlers are called as
+``route.call(request, params)``.
+"""
+
+import re
+
+PARAMETER = re.compile(r'^<(?:(\w+):)?(\w+)>$')
+
+
+def _int(value):
+    # Longer numbers can't be SQLite integers, so can't be ids
+    return int(value) if value.isascii() and value.isdigit() and len(value) < 19 else None
+
+
+# Parameter value of a path segment, or None if the route doesn't match it
+CONVERTERS = {
+    'str': lambda value: value or None,
+    'int': _int,
+}
+
+
+class Route:
+    """A method and path pattern, its handler and the options middleware reads"""
+
+    def __init__(self, method, pattern, handler, options):
+        self.method = method
+        self.pattern = pattern
+        self.handler = handler
+        self.options = options
+        self.call = lambda request, params: handler(request, **params)
+
+
+class _Node:
+    __slots__ = ('children', 'parameter', 'methods')
+
+    def __init__(self):
+        self.children = {}
+        # (name, converter, node) of the parameter segment after this one
+        self.parameter = None
+        self.methods = {}
+
+
+class Router:
+    """Routes by method and path, each with its middleware applied once compiled"""
+
+    def __init__(self):
+        self.routes = []
+        # Exact path -> {method: Route}
+        self.exact = {}
+        self.tree = _Node()
+
+    def route(self, method, pattern, **options):
+        """Decorator registering a handler for ``method`` and ``pattern``"""
+        def register(handler):
+            self.add(method, pattern, handler, **options)
+            return handler
+        return register
+
+    def add(self, method, pattern, handler, **options):
+        segments = pattern[1:].split('/')
+        parameters = [PARAMETER.match(segment) for segment in segments]
+        if not any(parameters):
+            methods = self.exact.setdefault(pattern, {})
+        else:
+            node = self.tree
+            for segment, parameter in zip(segments, parameters):
+                if parameter is None:
+                    node = node.children.setdefault(segment, _Node())
+                    continue
+                name, convert = parameter.group(2), CONVERTERS[parameter.group(1) or 'str']
+                if node.parameter is None:
+                    node.parameter = (name, convert, _Node())
+                elif node.parameter[:2] != (name, convert):
+                    raise ValueError(f'{pattern} conflicts with another parameter at {segment}')
+                node = node.parameter[2]
+            methods = node.methods
+        if method in methods:
+            raise ValueError(f'Duplicate route {method} {pattern}')
+        route = Route(method, pattern, handler, options)
+        methods[method] = route
+        self.routes.append(route)
+        return route
+
+    def compile(self, middleware):
+        """Wrap every route's handler in ``middleware``, the first outermost"""
+        for route in self.routes:
+            call = route.call
+            for factory in reversed(middleware):
+                call = factory(route, call)
+            route.call = call
+
+    def match(self, path):
+        """``({method: Route}, params)`` for a path, or ``(None, None)`` if no route has it"""
+        methods = self.exact.get(path)
+        if methods is not None:
+            return methods, {}
+        node = self.tree
+        params = {}
+        for segment in path[1:].split('/'):
+            child = node.children.get(segment)
+            if child is None:
+                if node.parameter is None:
+                    return None, None
+                name, convert, child = node.parameter
+                value = convert(segment)
+                if value is None:
+                    return None, None
+                params[name] = value
+            node = child
+        if not node.methods:
+            return None, None
+        return node.methods, params
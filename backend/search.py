@@ -0,0 +1,177 @@
+"""
+Calmora Backend - Full-text search over journal entries
+
+Journal entries are stored one row each in ``user_entries`` (see
+entries.py). ``journal_fts`` is an FTS5 index of their content and tags,
+kept in sync by triggers on ``user_entries``, so every write path (both
+backends, document saves, single appends, migrations) updates it in the
+same transaction without extra code.
+
+Each indexed row also carries an ``owner`` token (``u<user_id>``), so a
+search is one FTS query that intersects the user's postings with the
+search terms, not a scan of every user's matches.
+"""
+
+import html
+import json
+import re
+
+import entries
+
+JOURNAL = 'journal'
+
+DEFAULT_LIMIT = 20
+
+# Column weights for bm25(): content, tags, owner
+RANK = 'bm25(10.0, 5.0, 0.0)'
+
+# Private-use characters mark highlights so the text can be HTML-escaped first
+_MARK_START = '\ue000'
+_MARK_END = '\ue001'
+
+_INDEXED = '''
+    json_extract({row}.data, '$.content'),
+    (SELECT group_concat(value, ' ') FROM json_each({row}.data, '$.tags')),
+    'u' || {row}.user_id
+'''
+
+_TRIGGERS = (
+    f'''
+    CREATE TRIGGER IF NOT EXISTS journal_fts_insert AFTER INSERT ON user_entries
+    WHEN new.data_type = '{JOURNAL}' BEGIN
+        INSERT INTO journal_fts (rowid, content, tags, owner) VALUES (new.id, {_INDEXED.format(row='new')});
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS journal_fts_delete AFTER DELETE ON user_entries
+    WHEN old.data_type = '{JOURNAL}' BEGIN
+        DELETE FROM journal_fts WHERE rowid = old.id;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS journal_fts_update AFTER UPDATE OF data ON user_entries
+    WHEN new.data_type = '{JOURNAL}' BEGIN
+        DELETE FROM journal_fts WHERE rowid = old.id;
+        INSERT INTO journal_fts (rowid, content, tags, owner) VALUES (new.id, {_INDEXED.format(row='new')});
+    END
+    ''',
+)
+
+
+# ============== SCHEMA ==============
+
+def create_schema(c):
+    """Create the index and its triggers. Returns True if the index is new."""
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'journal_fts'")
+    exists = c.fetchone() is not None
+    c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS journal_fts USING fts5(
+            content, tags, owner,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+    ''')
+    if not exists:
+        c.execute("INSERT INTO journal_fts (journal_fts, rank) VALUES ('rank', ?)", (RANK,))
+    for trigger in _TRIGGERS:
+        c.execute(trigger)
+    return not exists
+
+
+def rebuild(conn):
+    """Re-index every journal row from scratch. Returns the number of entries indexed."""
+    c = conn.cursor()
+    create_schema(c)
+    c.execute('DELETE FROM journal_fts')
+    c.execute(f'''
+        INSERT INTO journal_fts (rowid, content, tags, owner)
+        SELECT e.id, {_INDEXED.format(row='e')} FROM user_entries e WHERE e.data_type = ?
+    ''', (JOURNAL,))
+    count = c.rowcount
+    c.execute("INSERT INTO journal_fts (journal_fts) VALUES ('optimize')")
+    conn.commit()
+    return count
+
+
+def ensure_index(conn):
+    """Create the index, backfilling it if it did not exist yet. Returns entries indexed."""
+    created = create_schema(conn.cursor())
+    conn.commit()
+    return rebuild(conn) if created else 0
+
+
+# ============== QUERIES ==============
+
+def build_match(user_id, query):
+    """FTS5 MATCH expression for a user's plain-text query, or None if it has no terms.
+
+    Words are AND-ed, ``"quoted text"`` is a phrase and the last word also
+    matches as a prefix (search-as-you-type). FTS syntax in the query is
+    never interpreted.
+    """
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', query or ''):
+        tokens = re.findall(r'[^\W_]+', phrase or word)
+        if tokens:
+            terms.append('"' + ' '.join(tokens) + '"')
+    if not terms:
+        return None
+    if not query.rstrip().endswith('"'):
+        terms[-1] += '*'
+    return f'owner : "u{int(user_id)}" AND {{content tags}} : ({" AND ".join(terms[:32])})'
+
+
+def _snippet_html(text):
+    escaped = html.escape(text or '')
+    return escaped.replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+
+
+def search_journal(c, user_id, query, page):
+    """One page of a user's journal entries matching ``query``, best first.
+
+    ``page`` comes from ``entries.parse_page_args`` (or is None for the
+    first page); ``from``/``to`` restrict the entry dates. Paging is by
+    position like ``entries.paginate_list``: pass ``next_cursor`` or
+    ``prev_cursor`` back as ``cursor``.
+    """
+    match = build_match(user_id, query)
+    page = page or {'limit': None, 'before': None, 'after': None, 'from': None, 'to': None}
+    limit = page['limit'] or DEFAULT_LIMIT
+    if page['after']:
+        offset = page['after'][1] + 1
+    elif page['before']:
+        offset = max(0, page['before'][1] - limit)
+    else:
+        offset = 0
+    paging = {'limit': limit, 'next_cursor': None, 'prev_cursor': None}
+    if match is None:
+        return [], paging
+
+    clauses = ['journal_fts MATCH ?']
+    params = [match]
+    if page['from']:
+        clauses.append('e.created_at >= ?')
+        params.append(page['from'])
+    if page['to']:
+        clauses.append('e.created_at <= ?')
+        params.append(page['to'])
+    c.execute(f'''
+        SELECT e.data, snippet(journal_fts, 0, ?, ?, '…', 16), rank
+        FROM journal_fts JOIN user_entries e ON e.id = journal_fts.rowid
+        WHERE {" AND ".join(clauses)}
+        ORDER BY rank
+        LIMIT ? OFFSET ?
+    ''', [_MARK_START, _MARK_END] + params + [limit + 1, offset])
+    rows = c.fetchall()
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        paging['next_cursor'] = entries.encode_cursor('after', '', offset + limit - 1)
+    if offset > 0:
+        paging['prev_cursor'] = entries.encode_cursor('before', '', offset)
+    results = [{
+        'entry': json.loads(data),
+        'snippet': _snippet_html(snippet),
+        'score': round(-score, 4),
+    } for data, snippet, score in rows]
+    return results, paging
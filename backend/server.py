@@ -4,35 +4,81 @@ Calmora Backend - Simple Flask-like server using only Python standard library
 Features: User authentication, SQLite database, JWT-like tokens, Data sync
 """
 
+import argparse
+import asyncio
+import http.client
 import http.server
-import socketserver
+import io
 import json
 import sqlite3
 import hashlib
 import secrets
+import time
+import traceback
 import datetime
 import urllib.parse
 import os
 from http import HTTPStatus
 
+import analytics
+import batch
+import changefeed
+import compress
+import dbpool
+import doccache
+import entries
+import groupcommit
+import metrics
+import passwords
+import migrations
+import patches
+import petmodel
+import reminders
+import prefork
+import routing
+import search
+import serving
+import static
+import tokencache
+import transfer
+
 # Configuration
 PORT = 5000
-DB_PATH = 'calmora.db'
+DB_PATH = os.getenv('CALMORA_DB_PATH', 'calmora.db')
+STATIC_DIR = 'dist'
 SECRET_KEY = 'calmora-secret-key-change-in-production'
 
+# Concurrency (see serving.py); overridable with --mode/--workers/--queue-size
+SERVER_MODE = os.getenv('CALMORA_SERVER_MODE', 'single')
+WORKERS = int(os.getenv('CALMORA_WORKERS', 8))
+QUEUE_SIZE = int(os.getenv('CALMORA_QUEUE_SIZE', 64))
+PROCESSES = int(os.getenv('CALMORA_PROCESSES', 1))
+GROUP_COMMIT = os.getenv('CALMORA_GROUP_COMMIT') == '1'
+GROUP_COMMIT_WINDOW_MS = float(os.getenv('CALMORA_GROUP_COMMIT_MS', 2))
+
+# Persistent connections in threaded/asyncio mode; longer than a load balancer's
+# usual 60s idle timeout, so the balancer is the one to close them
+KEEPALIVE_TIMEOUT = float(os.getenv('CALMORA_KEEPALIVE_TIMEOUT', 75))
+KEEPALIVE_REQUESTS = int(os.getenv('CALMORA_KEEPALIVE_REQUESTS', 1000))
+
+# Unread request body a kept-alive connection discards rather than closing
+MAX_DRAIN = 64 * 1024
+
 # Simple token generation (not real JWT, but works for demo)
-def generate_token(user_id):
+def generate_token(user_id, token_version=0):
     payload = {
         'user_id': user_id,
-        'exp': (datetime.datetime.utcnow() + datetime.timedelta(days=7)).timestamp()
+        'tv': token_version,
+        'exp': (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=7)).timestamp()
     }
     data = json.dumps(payload)
     signature = hashlib.sha256((data + SECRET_KEY).encode()).hexdigest()
     return f"{data}.{signature}"
 
-def verify_token(token):
+def decode_token(token):
+    """(payload, signature) of a correctly signed, unexpired token, or None"""
     try:
-        parts = token.split('.')
+        parts = token.rsplit('.', 1)
         if len(parts) != 2:
             return None
         data, signature = parts
@@ -41,408 +87,1232 @@ def verify_token(token):
         expected_sig = hashlib.sha256((data + SECRET_KEY).encode()).hexdigest()
         if signature != expected_sig:
             return None
-        if payload.get('exp', 0) < datetime.datetime.utcnow().timestamp():
+        if payload.get('exp', 0) < datetime.datetime.now(datetime.timezone.utc).timestamp():
             return None
-        return payload.get('user_id')
+        return payload, signature
     except:
         return None
 
+# Verified tokens, so repeat requests skip the signature and revocation checks
+token_cache = tokencache.TokenCache()
+
+def verify_token(token, c=None):
+    """User id of a valid token, or None; ``c`` is the caller's cursor if it already has one"""
+    user_id = token_cache.get(token)
+    if user_id is not None:
+        return user_id
+    
+    decoded = decode_token(token)
+    if not decoded:
+        return None
+    payload, signature = decoded
+    user_id = payload.get('user_id')
+    # The signature doubles as the token's id in the logout denylist
+    # Borrowing the pooled connection again would roll back the caller's open transaction
+    if tokencache.is_revoked(c if c is not None else get_db().cursor(), signature, user_id, payload.get('tv', 0)):
+        return None
+    token_cache.put(token, user_id, payload['exp'])
+    return user_id
+
+# Conditional requests
+def make_etag(version):
+    return f'"{version}"'
+
+def etag_matches(header, version):
+    """True if an If-Match/If-None-Match header matches a document version"""
+    if not header or version is None:
+        return False
+    if header.strip() == '*':
+        return True
+    tags = [tag.strip() for tag in header.split(',')]
+    return make_etag(version) in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+class VersionConflict(Exception):
+    """If-Match named a version the document no longer has"""
+    def __init__(self, version):
+        super().__init__(f'Version conflict (current version {version})')
+        self.version = version
+
+def require_version(if_match, version):
+    if if_match and not etag_matches(if_match, version):
+        raise VersionConflict(version)
+
 # Database setup
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Users table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            profile_data TEXT DEFAULT '{}'
-        )
-    ''')
-    
-    # User data table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS user_data (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            data_type TEXT NOT NULL,
-            data TEXT DEFAULT '{}',
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            UNIQUE (user_id, data_type)
-        )
-    ''')
-    
-    conn.commit()
+    """Create or upgrade the schema (see migrations.py)"""
+    conn = dbpool.connect(DB_PATH)
+    for version, name, note in migrations.migrate(conn):
+        print(f"✅ Applied migration {version} {name}" + (f": {note}" if note else ""))
     conn.close()
     print("✅ Database initialized")
 
+# One WAL-mode connection per worker thread; conn.close() returns it to the pool
+db_pool = dbpool.ConnectionPool(DB_PATH, row_factory=sqlite3.Row)
+
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return db_pool.connection()
+
+# Parsed documents and encoded responses, keyed by document version (see doccache.py)
+doc_cache = doccache.DocumentCache()
+
+# Manifest of the frontend build, scanned once at start-up (see static.py)
+static_files = static.StaticFiles(STATIC_DIR)
+
+# Optional write batching (see groupcommit.py), started by run() when enabled
+group_committer = None
+
+# Pushes document changes to /api/changes/stream clients (see changefeed.py)
+change_feed = changefeed.ChangeFeed(lambda: dbpool.connect(DB_PATH))
+
+# Fires due reminders, one thread per worker process, started by run() (see reminders.py)
+reminder_scheduler = reminders.Scheduler(lambda: dbpool.connect(DB_PATH))
+
+def document_changed(user_id, data_type=None):
+    """Call after a write commits: drops stale cached responses and wakes change streams"""
+    doc_cache.invalidate(user_id, data_type)
+    change_feed.notify(user_id)
+
+def run_write(fn):
+    """Run fn(cursor) in one write transaction and return its result.
+    
+    With group commit enabled the transaction is shared with writes from
+    other requests; either way this returns only after the commit.
+    """
+    with metrics.stage('db'):
+        if group_committer is not None:
+            return group_committer.submit(fn)
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            c.execute('BEGIN IMMEDIATE')
+            result = fn(c)
+            conn.commit()
+            return result
+        except BaseException:
+            conn.rollback()
+            raise
+
+def route_label(path):
+    """Metrics label of a request no API route matched"""
+    if path == '/metrics':
+        return path
+    if not path.startswith('/api/'):
+        return 'static'
+    return metrics.UNMATCHED
+
+def save_if_match(c, user_id, data_type, doc, if_match):
+    require_version(if_match, entries.document_version(c, user_id, data_type))
+    return entries.save_document(c, user_id, data_type, doc)
+
+# API routes, declared on CalmoraHandler's methods and matched by path (see routing.py)
+api = routing.Router()
+
+# Middleware, outermost first; each only wraps the routes whose options ask for it
+
+def map_errors(route, call):
+    """Answer what a route raises with its status code; anything unexpected is a logged 500"""
+    def handler(request, params):
+        try:
+            call(request, params)
+        except Exception as e:
+            # Too late for an error response once one has started; handle_one_request closes the connection
+            if request.response_status is not None:
+                raise
+            if isinstance(e, VersionConflict):
+                request.send_conflict(e.version)
+            elif isinstance(e, passwords.Overloaded):
+                request.send_error_json(503, str(e), headers={'Retry-After': str(e.retry_after)})
+            elif isinstance(e, petmodel.PetActionError):
+                request.send_error_json(409, str(e))
+            elif isinstance(e, patches.PatchError):
+                request.send_error_json(422, str(e))
+            elif isinstance(e, ValueError):
+                request.send_error_json(400, str(e))
+            else:
+                traceback.print_exc()
+                request.send_error_json(500, 'Internal server error')
+    return handler
 
-# Password hashing
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+def require_auth(route, call):
+    """auth=True: 401 without a valid token; auth='optional': user_id may be None"""
+    auth = route.options.get('auth')
+    if not auth:
+        return call
+    def handler(request, params):
+        request.user_id = request.authenticate()
+        if request.user_id is None and auth != 'optional':
+            request.send_error_json(401, 'Unauthorized')
+            return
+        call(request, params)
+    return handler
 
-def check_password(password, hash):
-    return hash_password(password) == hash
+def limit_body(route, call):
+    """body='json': 413 for a declared Content-Length over the limit, before reading any of it"""
+    if route.options.get('body') != 'json':
+        return call
+    def handler(request, params):
+        if int(request.headers.get('Content-Length', 0)) > compress.MAX_REQUEST_BYTES:
+            request.send_error_json(413, 'Request body too large')
+            return
+        call(request, params)
+    return handler
+
+def decode_json(route, call):
+    """body='json': the decoded request body as request.data"""
+    if route.options.get('body') != 'json':
+        return call
+    def handler(request, params):
+        body = request.read_body()
+        if body is None:
+            return
+        try:
+            with metrics.stage('json'):
+                request.data = json.loads(body) if body else {}
+        except (ValueError, RecursionError):
+            request.send_error_json(400, 'Invalid JSON')
+            return
+        call(request, params)
+    return handler
+
+def parse_page(route, call):
+    """page=True: request.page from the pagination query parameters (see entries.py)"""
+    if not route.options.get('page'):
+        return call
+    def handler(request, params):
+        try:
+            request.page = entries.parse_page_args(request.query_params)
+        except ValueError:
+            request.send_error_json(400, 'Invalid pagination parameters')
+            return
+        call(request, params)
+    return handler
+
+def acquire_db(route, call):
+    """db=True: a pooled connection's cursor as request.cursor, returned to the pool after the route"""
+    if not route.options.get('db'):
+        return call
+    snapshot = route.method == 'GET'
+    def handler(request, params):
+        conn = get_db()
+        request.cursor = conn.cursor()
+        try:
+            if snapshot:
+                # One read snapshot, so a version and the data read after it always agree
+                request.cursor.execute('BEGIN')
+            call(request, params)
+        finally:
+            request.cursor = None
+            conn.close()
+    return handler
+
+MIDDLEWARE = [map_errors, require_auth, limit_body, decode_json, parse_page, acquire_db]
 
 class CalmoraHandler(http.server.SimpleHTTPRequestHandler):
+    # Persistent connections where the server allows them (see serving.py)
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; without this a reused connection
+    # waits on the client's delayed ACK before sending the body
+    disable_nagle_algorithm = True
+    
+    # Set while a /api/batch request runs its sub-requests
+    batch_user_id = None
+    
+    # The matched route, and what its middleware provides
+    route = None
+    user_id = None
+    data = None
+    page = None
+    cursor = None
+    
+    # Earlier requests on this connection
+    requests_served = 0
+    connection_header_sent = False
+
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, PATCH, DELETE, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Content-Encoding, Authorization, If-Match, If-None-Match, Last-Event-ID')
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
-    def do_GET(self):
+    def parse_request(self):
+        # Time from here rather than handle_one_request, which first waits for the request line
+        self.request_timer = metrics.registry.begin()
+        self.response_status = None
+        self.route = None
+        if not super().parse_request():
+            return False
+        return self.frame_body()
+
+    def frame_body(self):
+        """Limit rfile to this request's body, so the next request starts after it; False after an error"""
+        if self.headers.get('Transfer-Encoding', 'identity').strip().lower() != 'identity':
+            self.close_connection = True
+            self.send_error_json(411, 'Chunked request bodies are not supported, send Content-Length')
+            return False
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            self.send_error_json(400, 'Invalid Content-Length')
+            return False
+        self.connection_rfile = self.rfile
+        self.rfile = serving.RequestBody(self.rfile, length)
+        return True
+
+    def handle_one_request(self):
+        self.request_timer = None
+        self.connection_rfile = None
+        try:
+            super().handle_one_request()
+        except BaseException:
+            self.close_connection = True
+            raise
+        finally:
+            if self.connection_rfile is not None:
+                # Skip whatever body the route didn't read before the next request line
+                if not self.close_connection and not self.rfile.drain(MAX_DRAIN):
+                    self.close_connection = True
+                self.rfile = self.connection_rfile
+                self.connection_rfile = None
+            if self.request_timer is not None:
+                if self.route is not None:
+                    label = self.route.pattern
+                else:
+                    label = route_label(urllib.parse.urlparse(self.path).path)
+                metrics.registry.end(self.request_timer, self.command, label, self.response_status)
+                self.request_timer = None
+                self.requests_served += 1
+
+    def send_response(self, code, message=None):
+        self.response_status = code
+        self.connection_header_sent = False
+        super().send_response(code, message)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'connection':
+            self.connection_header_sent = True
+        super().send_header(keyword, value)
+
+    def keep_alive_allowed(self):
+        """True if the connection may stay open after this response (see serving.py)"""
+        if getattr(self.server, 'keepalive_timeout', 0) <= 0:
+            return False
+        if self.requests_served + 1 >= self.server.keepalive_requests:
+            return False
+        # A body too large to skip would have to be read just to find the next request
+        return not (isinstance(self.rfile, serving.RequestBody) and self.rfile.remaining > MAX_DRAIN)
+
+    def end_headers(self):
+        # response_status is unset for the interim 100 Continue; sub-requests share the batch's connection
+        if self.response_status is not None and self.batch_user_id is None:
+            if not self.close_connection and not self.keep_alive_allowed():
+                self.close_connection = True
+            if self.close_connection:
+                if not self.connection_header_sent:
+                    self.send_header('Connection', 'close')
+            else:
+                if self.request_version == 'HTTP/1.0':
+                    self.send_header('Connection', 'keep-alive')
+                self.send_header('Keep-Alive', f'timeout={int(self.server.keepalive_timeout)}, '
+                                               f'max={self.server.keepalive_requests - self.requests_served - 1}')
+        super().end_headers()
+
+    def parse_path(self):
+        """Path of the request URL; its query string goes to query_params"""
         parsed = urllib.parse.urlparse(self.path)
-        path = parsed.path
-        
+        self.query_params = dict(urllib.parse.parse_qsl(parsed.query))
+        return parsed.path
+
+    def do_GET(self):
+        path = self.parse_path()
+        if path == '/metrics':
+            self.send_metrics()
         # API routes
-        if path.startswith('/api/'):
-            self.handle_api_get(path)
+        elif path.startswith('/api/'):
+            self.handle_api(path)
         else:
             # Serve static files
             self.serve_static(path)
 
     def do_POST(self):
-        parsed = urllib.parse.urlparse(self.path)
-        path = parsed.path
-        
+        path = self.parse_path()
         if path.startswith('/api/'):
-            self.handle_api_post(path)
+            self.handle_api(path)
         else:
             self.send_error(404)
 
-    def do_PUT(self):
-        parsed = urllib.parse.urlparse(self.path)
-        path = parsed.path
-        
-        if path.startswith('/api/'):
-            self.handle_api_put(path)
-        else:
-            self.send_error(404)
+    do_PUT = do_PATCH = do_DELETE = do_POST
 
-    def handle_api_get(self, path):
-        token = self.headers.get('Authorization', '').replace('Bearer ', '')
-        user_id = verify_token(token) if token else None
+    def handle_api(self, path):
+        """Run the route for an /api/ request through its middleware (see routing.py)"""
+        methods, params = api.match(path)
+        if methods is None:
+            self.send_error_json(404, 'Endpoint not found')
+            return
+        route = methods.get(self.command)
+        if route is None:
+            self.send_error_json(405, 'Method not allowed', headers={'Allow': ', '.join(methods)})
+            return
+        self.route = route
+        route.call(self, params)
+
+    def bearer_token(self):
+        return self.headers.get('Authorization', '').replace('Bearer ', '')
+
+    def authenticate(self):
+        """User id of the request's bearer token, or None"""
+        if self.batch_user_id is not None:
+            return self.batch_user_id
+        with metrics.stage('auth'):
+            token = self.bearer_token()
+            return verify_token(token) if token else None
+
+    # Public routes
+
+    @api.route('GET', '/api/health')
+    def get_health(self):
+        health = {'status': 'ok', 'message': 'Calmora API is running'}
+        stats = getattr(self.server, 'stats', None)
+        if stats:
+            health['server'] = stats.snapshot()
+        if group_committer is not None:
+            health['group_commit'] = group_committer.snapshot()
+        health['cache'] = doc_cache.snapshot()
+        health['tokens'] = token_cache.snapshot()
+        health['changes'] = change_feed.snapshot()
+        health['static'] = static_files.snapshot()
+        health['passwords'] = passwords.hasher.snapshot()
+        health['reminders'] = reminder_scheduler.snapshot()
+        self.send_json(health)
+
+    @api.route('POST', '/api/auth/register', body='json', db=True)
+    def register(self):
+        c, data = self.cursor, self.data
+        # Check if user exists before spending a hash on it
+        c.execute('SELECT id FROM users WHERE username = ? OR email = ?',
+                 (data.get('username'), data.get('email')))
+        if c.fetchone():
+            self.send_error_json(409, 'Username or email already exists')
+            return
+        password_hash = passwords.hash_password(data.get('password', ''))
         
-        try:
-            conn = get_db()
-            c = conn.cursor()
+        def create_user(c):
+            # Check again: another request may have taken the name meanwhile
+            c.execute('SELECT id FROM users WHERE username = ? OR email = ?',
+                     (data.get('username'), data.get('email')))
+            if c.fetchone():
+                return None
             
-            # Public routes
-            if path == '/api/health':
-                self.send_json({'status': 'ok', 'message': 'Calmora API is running'})
-                return
-            
-            # Protected routes
-            if not user_id:
-                self.send_error_json(401, 'Unauthorized')
-                return
-            
-            if path == '/api/auth/me':
-                c.execute('SELECT id, username, email, created_at, profile_data FROM users WHERE id = ?', (user_id,))
-                user = c.fetchone()
-                if user:
-                    self.send_json({'user': dict(user)})
-                else:
-                    self.send_error_json(404, 'User not found')
-            
-            elif path == '/api/data/bulk':
-                c.execute('SELECT data_type, data FROM user_data WHERE user_id = ?', (user_id,))
-                rows = c.fetchall()
-                data = {row['data_type']: json.loads(row['data']) for row in rows}
-                self.send_json({'data': data})
-            
-            elif path == '/api/pet':
-                c.execute('SELECT data FROM user_data WHERE user_id = ? AND data_type = ?', (user_id, 'pet'))
-                row = c.fetchone()
-                self.send_json({'pet': json.loads(row['data']) if row else {}})
-            
-            elif path == '/api/habits':
-                c.execute('SELECT data FROM user_data WHERE user_id = ? AND data_type = ?', (user_id, 'habits'))
-                row = c.fetchone()
-                data = json.loads(row['data']) if row else {}
-                self.send_json({'habits': data.get('habits', [])})
+            # Create user
+            c.execute('INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
+                     (data.get('username'), data.get('email'), password_hash))
+            new_user_id = c.lastrowid
             
-            elif path == '/api/moods':
-                c.execute('SELECT data FROM user_data WHERE user_id = ? AND data_type = ?', (user_id, 'moods'))
-                row = c.fetchone()
-                data = json.loads(row['data']) if row else {}
-                self.send_json({'moods': data.get('moods', [])})
-            
-            else:
-                self.send_error_json(404, 'Endpoint not found')
-            
-            conn.close()
-        except Exception as e:
-            self.send_error_json(500, str(e))
-
-    def handle_api_post(self, path):
-        token = self.headers.get('Authorization', '').replace('Bearer ', '')
-        user_id = verify_token(token) if token else None
+            # Create initial data entries
+            for data_type in ['pet', 'habits', 'moods', 'journal', 'settings']:
+                initial_data = '{}' if data_type != 'habits' else '{"habits": []}'
+                if data_type == 'moods':
+                    initial_data = '{"moods": []}'
+                if data_type == 'journal':
+                    initial_data = '{"entries": []}'
+                if data_type == 'settings':
+                    initial_data = '{"theme": "light", "notifications": true}'
+                c.execute('INSERT INTO user_data (user_id, data_type, data) VALUES (?, ?, ?)',
+                         (new_user_id, data_type, initial_data))
+            return new_user_id
         
-        content_length = int(self.headers.get('Content-Length', 0))
-        body = self.rfile.read(content_length).decode()
-        try:
-            data = json.loads(body) if body else {}
-        except:
-            self.send_error_json(400, 'Invalid JSON')
+        user_id = run_write(create_user)
+        if user_id is None:
+            self.send_error_json(409, 'Username or email already exists')
             return
         
-        try:
-            conn = get_db()
-            c = conn.cursor()
-            
-            if path == '/api/auth/register':
-                # Check if user exists
-                c.execute('SELECT id FROM users WHERE username = ? OR email = ?', 
-                         (data.get('username'), data.get('email')))
-                if c.fetchone():
-                    self.send_error_json(409, 'Username or email already exists')
-                    conn.close()
-                    return
-                
-                # Create user
-                password_hash = hash_password(data.get('password', ''))
-                c.execute('INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
-                         (data.get('username'), data.get('email'), password_hash))
-                user_id = c.lastrowid
-                
-                # Create initial data entries
-                for data_type in ['pet', 'habits', 'moods', 'journal', 'settings']:
-                    initial_data = '{}' if data_type != 'habits' else '{"habits": []}'
-                    if data_type == 'moods':
-                        initial_data = '{"moods": []}'
-                    if data_type == 'journal':
-                        initial_data = '{"entries": []}'
-                    if data_type == 'settings':
-                        initial_data = '{"theme": "light", "notifications": true}'
-                    c.execute('INSERT INTO user_data (user_id, data_type, data) VALUES (?, ?, ?)',
-                             (user_id, data_type, initial_data))
-                
-                conn.commit()
-                
-                # Generate token
-                access_token = generate_token(user_id)
-                
-                c.execute('SELECT id, username, email, created_at, profile_data FROM users WHERE id = ?', (user_id,))
-                user = dict(c.fetchone())
-                
-                self.send_json({
-                    'message': 'User registered successfully',
-                    'user': user,
-                    'access_token': access_token
-                }, status=201)
-            
-            elif path == '/api/auth/login':
-                c.execute('SELECT id, password_hash FROM users WHERE username = ?', (data.get('username'),))
-                user = c.fetchone()
-                
-                if not user or not check_password(data.get('password', ''), user['password_hash']):
-                    self.send_error_json(401, 'Invalid username or password')
-                    conn.close()
-                    return
-                
-                access_token = generate_token(user['id'])
-                
-                c.execute('SELECT id, username, email, created_at, profile_data FROM users WHERE id = ?', (user['id'],))
-                user_data = dict(c.fetchone())
-                
-                self.send_json({
-                    'message': 'Login successful',
-                    'user': user_data,
-                    'access_token': access_token
-                })
-            
-            elif path == '/api/moods' and user_id:
-                # Add new mood
-                c.execute('SELECT data FROM user_data WHERE user_id = ? AND data_type = ?', (user_id, 'moods'))
-                row = c.fetchone()
-                
-                moods_data = json.loads(row['data']) if row else {'moods': []}
-                moods = moods_data.get('moods', [])
-                moods.insert(0, data)
-                moods_data['moods'] = moods
-                
-                c.execute('UPDATE user_data SET data = ? WHERE user_id = ? AND data_type = ?',
-                         (json.dumps(moods_data), user_id, 'moods'))
-                conn.commit()
-                
-                self.send_json({'mood': data, 'moods': moods}, status=201)
-            
-            else:
-                self.send_error_json(404, 'Endpoint not found')
-            
-            conn.close()
-        except Exception as e:
-            self.send_error_json(500, str(e))
+        # Generate token
+        access_token = generate_token(user_id)
+        
+        c.execute('SELECT id, username, email, created_at, profile_data FROM users WHERE id = ?', (user_id,))
+        user = dict(c.fetchone())
+        
+        self.send_json({
+            'message': 'User registered successfully',
+            'user': user,
+            'access_token': access_token
+        }, status=201)
 
-    def handle_api_put(self, path):
-        token = self.headers.get('Authorization', '').replace('Bearer ', '')
-        user_id = verify_token(token) if token else None
+    @api.route('POST', '/api/auth/login', body='json', db=True)
+    def login(self):
+        c, data = self.cursor, self.data
+        c.execute('SELECT id, password_hash, token_version FROM users WHERE username = ?', (data.get('username'),))
+        user = c.fetchone()
+        
+        if not user or not passwords.verify_password(data.get('password', ''), user['password_hash']):
+            self.send_error_json(401, 'Invalid username or password')
+            return
+        if passwords.needs_rehash(user['password_hash']):
+            self.upgrade_password_hash(user['id'], user['password_hash'], data.get('password', ''))
         
+        access_token = generate_token(user['id'], user['token_version'])
+        
+        c.execute('SELECT id, username, email, created_at, profile_data FROM users WHERE id = ?', (user['id'],))
+        user_data = dict(c.fetchone())
+        
+        self.send_json({
+            'message': 'Login successful',
+            'user': user_data,
+            'access_token': access_token
+        })
+
+    @api.route('GET', '/api/changes/stream', auth='optional', db=True)
+    def open_change_stream(self):
+        """Start an SSE stream of the user's document changes, then hand it to change_feed"""
+        user_id = self.user_id
+        if user_id is None:
+            # EventSource can't set headers, so the token may also come as ?access_token=
+            token = self.query_params.get('access_token')
+            user_id = verify_token(token, self.cursor) if token else None
         if not user_id:
             self.send_error_json(401, 'Unauthorized')
             return
+        if self.batch_user_id is not None:
+            # Detaching would hand the batch's own connection to change_feed
+            self.send_error_json(400, 'Change streams cannot be batched')
+            return
+        try:
+            last_version = changefeed.parse_last_event_id(
+                self.headers.get('Last-Event-ID') or self.query_params.get('last_event_id'))
+        except ValueError as e:
+            self.send_error_json(400, str(e))
+            return
+        if not change_feed.has_capacity():
+            self.send_error_json(503, 'Too many open change streams')
+            return
+        
+        version = entries.user_version(self.cursor, user_id)
+        # Keep the token out of the access log
+        self.requestline = self.requestline.split('?', 1)[0]
+        self.send_response(200)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in changefeed.EVENT_STREAM_HEADERS.items():
+            self.send_header(name, value)
+        # The stream runs until either side closes the connection
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(changefeed.ready_event(version, last_version is not None))
+        
+        sink = serving.detach(self, changefeed.MAX_PENDING)
+        change_feed.subscribe(user_id, version if last_version is None else min(last_version, version), sink)
+
+    # Account
+
+    @api.route('GET', '/api/auth/me', auth=True, db=True)
+    def get_me(self):
+        c = self.cursor
+        c.execute('SELECT id, username, email, created_at, profile_data FROM users WHERE id = ?', (self.user_id,))
+        user = c.fetchone()
+        if user:
+            self.send_json({'user': dict(user)})
+        else:
+            self.send_error_json(404, 'User not found')
+
+    @api.route('POST', '/api/auth/logout', auth=True)
+    def logout(self):
+        user_id = self.user_id
+        token = self.bearer_token()
+        # Accepted from token_cache, the token may have expired since
+        decoded = decode_token(token)
+        if not decoded:
+            self.send_error_json(401, 'Unauthorized')
+            return
+        payload, signature = decoded
+        run_write(lambda c: tokencache.revoke_token(c, signature, user_id, payload['exp']))
+        token_cache.forget(token)
+        self.send_json({'message': 'Logged out successfully'})
+
+    @api.route('PUT', '/api/auth/update-profile', auth=True, body='json', db=True)
+    def update_profile(self):
+        c, user_id, data = self.cursor, self.user_id, self.data
+        updates = []
+        values = []
+        if 'username' in data:
+            updates.append('username = ?')
+            values.append(data['username'])
+        if 'email' in data:
+            updates.append('email = ?')
+            values.append(data['email'])
+        if 'profile_data' in data:
+            updates.append('profile_data = ?')
+            values.append(json.dumps(data['profile_data']))
+        
+        if updates:
+            values.append(user_id)
+            run_write(lambda c: c.execute(f"UPDATE users SET {', '.join(updates)} WHERE id = ?", values))
+        
+        c.execute('SELECT id, username, email, created_at, profile_data FROM users WHERE id = ?', (user_id,))
+        self.send_json({'user': dict(c.fetchone())})
+
+    @api.route('PUT', '/api/auth/change-password', auth=True, body='json', db=True)
+    def change_password(self):
+        c, user_id, data = self.cursor, self.user_id, self.data
+        new_password = data.get('new_password', '')
+        if len(new_password) < 6:
+            self.send_error_json(400, 'Password must be at least 6 characters')
+            return
+        
+        # Hash outside the write transaction, which other writers wait on
+        c.execute('SELECT password_hash FROM users WHERE id = ?', (user_id,))
+        user = c.fetchone()
+        if not user or not passwords.verify_password(data.get('current_password', ''), user['password_hash']):
+            self.send_error_json(401, 'Current password is incorrect')
+            return
+        new_hash = passwords.hash_password(new_password)
         
+        def change_password(c):
+            # Unless the password changed again since it was checked
+            c.execute('UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?',
+                      (new_hash, user_id, user['password_hash']))
+            if not c.rowcount:
+                return None
+            # Every token issued before now stops working
+            return tokencache.revoke_user_tokens(c, user_id)
+        
+        token_version = run_write(change_password)
+        if token_version is None:
+            self.send_error_json(401, 'Current password is incorrect')
+            return
+        token_cache.forget_user(user_id)
+        self.send_json({
+            'message': 'Password changed successfully',
+            'access_token': generate_token(user_id, token_version)
+        })
+
+    # Documents
+
+    @api.route('GET', '/api/data/bulk', auth=True, db=True)
+    def get_bulk(self):
+        c, user_id = self.cursor, self.user_id
+        version = entries.user_version(c, user_id)
+        if self.check_not_modified(version):
+            return
+        since = self.query_params.get('since')
+        if since is not None and not since.isdigit():
+            self.send_error_json(400, 'Invalid since version')
+            return
+        if since:
+            data = entries.load_all_documents(c, user_id, int(since))
+            self.send_json({'data': data, 'version': version}, headers=self.etag_headers(version))
+        else:
+            self.send_cached(user_id, doccache.ALL_TYPES, version, 'bulk',
+                             lambda: {'data': entries.load_all_documents(c, user_id),
+                                      'version': version},
+                             headers=self.etag_headers(version))
+
+    @api.route('PUT', '/api/data/bulk', auth=True, body='json')
+    def put_bulk(self):
+        user_id, data = self.user_id, self.data
+        if_match = self.headers.get('If-Match')
+        
+        def save_all(c):
+            require_version(if_match, entries.user_version(c, user_id))
+            for data_type, type_data in data.items():
+                entries.save_document(c, user_id, data_type, type_data)
+            return entries.user_version(c, user_id)
+        
+        version = run_write(save_all)
+        document_changed(user_id)
+        self.send_json({'message': 'All data updated successfully', 'version': version},
+                       headers=self.etag_headers(version))
+
+    @api.route('GET', '/api/data/export', auth=True, db=True)
+    def export_data(self):
+        self.send_stream(transfer.export_chunks(self.cursor, self.user_id), transfer.NDJSON, {
+            'Content-Disposition': f'attachment; filename="{transfer.export_filename()}"',
+        })
+
+    @api.route('POST', '/api/data/import', auth=True)
+    def import_data(self):
+        """Write an NDJSON import a batch at a time, streaming progress back (see transfer.py)"""
+        user_id = self.user_id
+        
+        def write_batch(records):
+            touched = run_write(lambda c: transfer.apply_batch(c, user_id, records))
+            for data_type in touched:
+                document_changed(user_id, data_type)
+        
+        # Read straight from the socket instead of buffering the body first
         content_length = int(self.headers.get('Content-Length', 0))
-        body = self.rfile.read(content_length).decode()
         try:
-            data = json.loads(body) if body else {}
-        except:
-            self.send_error_json(400, 'Invalid JSON')
+            stream, length = compress.decode_stream(self.rfile, content_length, self.headers.get('Content-Encoding'))
+        except compress.UnsupportedEncoding as e:
+            self.send_error_json(415, str(e))
+            return
+        lines = transfer.read_lines(stream, length)
+        progress = transfer.import_records(lines, write_batch)
+        self.send_stream(transfer.progress_lines(progress), transfer.NDJSON)
+
+    @api.route('GET', '/api/data/<data_type>', auth=True, db=True, page=True)
+    def get_data(self, data_type):
+        c, user_id, page = self.cursor, self.user_id, self.page
+        version = entries.document_version(c, user_id, data_type)
+        if self.check_not_modified(version):
             return
+        if version is None:
+            self.send_error_json(404, 'Data type not found')
+        elif page and data_type in entries.ROW_BACKED_TYPES:
+            data, paging = entries.query_document(c, user_id, data_type, page)
+            self.send_json({'data': data, 'paging': paging}, headers=self.etag_headers(version))
+        else:
+            self.send_cached(user_id, data_type, version, 'data',
+                             lambda: {'data': entries.load_document(c, user_id, data_type)},
+                             headers=self.etag_headers(version))
+
+    @api.route('PUT', '/api/data/<data_type>', auth=True, body='json')
+    def put_data(self, data_type):
+        user_id, data = self.user_id, self.data
+        if_match = self.headers.get('If-Match')
+        version = run_write(lambda c: save_if_match(c, user_id, data_type, data, if_match))
+        document_changed(user_id, data_type)
+        self.send_json({'data': data, 'version': version}, headers=self.etag_headers(version))
+
+    @api.route('PATCH', '/api/data/<data_type>', auth=True, body='json')
+    def patch_data(self, data_type):
+        user_id, data = self.user_id, self.data
+        if_match = self.headers.get('If-Match')
+        content_type = self.headers.get('Content-Type')
+        
+        # Read, patch and write in one transaction so concurrent patches can't interleave
+        def apply(c):
+            version = entries.document_version(c, user_id, data_type)
+            require_version(if_match, version)
+            cached = doc_cache.get(user_id, data_type, version, 'data')
+            doc = cached[0]['data'] if cached else entries.load_document(c, user_id, data_type)
+            patched = patches.apply_patch(doc if doc is not None else {}, data, content_type)
+            return patched, entries.save_document(c, user_id, data_type, patched)
         
+        patched, version = run_write(apply)
+        document_changed(user_id, data_type)
+        
+        if entries.wants_minimal_response(self.headers, self.query_params):
+            self.send_json({'version': version}, headers=self.etag_headers(version))
+        else:
+            self.send_json({'data': patched, 'version': version}, headers=self.etag_headers(version))
+
+    @api.route('POST', '/api/batch', auth=True, body='json')
+    def handle_batch(self):
+        """Run sub-requests through the normal routes and collect their responses (see batch.py)"""
+        operations = batch.parse_batch(self.data)
+        
+        saved = (self.command, self.path, self.requestline, self.headers, self.rfile, self.wfile,
+                 self.close_connection, self.route)
+        # Sub-requests reuse this request's authentication instead of re-checking the token
+        self.batch_user_id = self.user_id
+        responses = []
         try:
-            conn = get_db()
-            c = conn.cursor()
-            
-            if path == '/api/auth/update-profile':
-                updates = []
-                values = []
-                if 'username' in data:
-                    updates.append('username = ?')
-                    values.append(data['username'])
-                if 'email' in data:
-                    updates.append('email = ?')
-                    values.append(data['email'])
-                if 'profile_data' in data:
-                    updates.append('profile_data = ?')
-                    values.append(json.dumps(data['profile_data']))
-                
-                if updates:
-                    values.append(user_id)
-                    c.execute(f"UPDATE users SET {', '.join(updates)} WHERE id = ?", values)
-                    conn.commit()
-                
-                c.execute('SELECT id, username, email, created_at, profile_data FROM users WHERE id = ?', (user_id,))
-                self.send_json({'user': dict(c.fetchone())})
-            
-            elif path == '/api/data/bulk':
-                for data_type, type_data in data.items():
-                    c.execute('SELECT id FROM user_data WHERE user_id = ? AND data_type = ?', (user_id, data_type))
-                    row = c.fetchone()
-                    if row:
-                        c.execute('UPDATE user_data SET data = ? WHERE user_id = ? AND data_type = ?',
-                                 (json.dumps(type_data), user_id, data_type))
-                    else:
-                        c.execute('INSERT INTO user_data (user_id, data_type, data) VALUES (?, ?, ?)',
-                                 (user_id, data_type, json.dumps(type_data)))
-                conn.commit()
-                self.send_json({'message': 'All data updated successfully'})
-            
-            elif path == '/api/pet':
-                c.execute('SELECT id FROM user_data WHERE user_id = ? AND data_type = ?', (user_id, 'pet'))
-                row = c.fetchone()
-                if row:
-                    c.execute('UPDATE user_data SET data = ? WHERE user_id = ? AND data_type = ?',
-                             (json.dumps(data), user_id, 'pet'))
-                else:
-                    c.execute('INSERT INTO user_data (user_id, data_type, data) VALUES (?, ?, ?)',
-                             (user_id, 'pet', json.dumps(data)))
-                conn.commit()
-                self.send_json({'pet': data})
-            
-            elif path == '/api/habits':
-                habits_data = {'habits': data}
-                c.execute('SELECT id FROM user_data WHERE user_id = ? AND data_type = ?', (user_id, 'habits'))
-                row = c.fetchone()
-                if row:
-                    c.execute('UPDATE user_data SET data = ? WHERE user_id = ? AND data_type = ?',
-                             (json.dumps(habits_data), user_id, 'habits'))
-                else:
-                    c.execute('INSERT INTO user_data (user_id, data_type, data) VALUES (?, ?, ?)',
-                             (user_id, 'habits', json.dumps(habits_data)))
-                conn.commit()
-                self.send_json({'habits': data})
-            
-            else:
-                self.send_error_json(404, 'Endpoint not found')
-            
-            conn.close()
-        except Exception as e:
-            self.send_error_json(500, str(e))
+            for op_id, method, path, headers, body in operations:
+                responses.append(self.run_subrequest(op_id, method, path, headers, body))
+        finally:
+            (self.command, self.path, self.requestline, self.headers, self.rfile, self.wfile,
+             self.close_connection, self.route) = saved
+            self.batch_user_id = None
+        self.send_json_body(batch.encode_batch(responses))
 
-    def serve_static(self, path):
-        if path == '/':
-            path = '/index.html'
+    def run_subrequest(self, op_id, method, path, headers, body):
+        """Dispatch one batched request on this handler, capturing its response"""
+        raw = json.dumps(body).encode() if body is not None else b''
+        sub_headers = http.client.HTTPMessage()
+        sub_headers['Authorization'] = self.headers.get('Authorization', '')
+        sub_headers['Content-Length'] = str(len(raw))
+        for name, value in headers.items():
+            sub_headers[name] = value
         
-        # Remove leading slash
-        path = path[1:]
+        self.command = method
+        self.path = path
+        self.requestline = f'{method} {path} (batch)'
+        self.headers = sub_headers
+        self.rfile = io.BytesIO(raw)
+        self.wfile = io.BytesIO()
+        self.response_status = None
+        getattr(self, 'do_' + method)()
         
-        # Check if file exists in dist
-        full_path = os.path.join('dist', path)
-        if os.path.exists(full_path) and os.path.isfile(full_path):
-            self.send_response(200)
-            self.send_header('Access-Control-Allow-Origin', '*')
-            
-            # Set content type
-            if path.endswith('.html'):
-                self.send_header('Content-Type', 'text/html')
-            elif path.endswith('.js'):
-                self.send_header('Content-Type', 'application/javascript')
-            elif path.endswith('.css'):
-                self.send_header('Content-Type', 'text/css')
-            elif path.endswith('.json'):
-                self.send_header('Content-Type', 'application/json')
-            else:
-                self.send_header('Content-Type', 'application/octet-stream')
-            
-            self.end_headers()
-            with open(full_path, 'rb') as f:
-                self.wfile.write(f.read())
+        head, _, payload = self.wfile.getvalue().partition(b'\r\n\r\n')
+        lines = head.decode('iso-8859-1').split('\r\n')
+        status = int(lines[0].split()[1])
+        response_headers = dict(line.split(': ', 1) for line in lines[1:] if ': ' in line)
+        return batch.encode_response(op_id, status, response_headers, payload)
+
+    # Pet, habits and moods
+
+    @api.route('GET', '/api/pet', auth=True, db=True)
+    def get_pet(self):
+        c, user_id = self.cursor, self.user_id
+        # Evaluated as of now (see petmodel.py), so never answered with 304
+        version = entries.document_version(c, user_id, 'pet')
+        pet = petmodel.evaluate(entries.load_document(c, user_id, 'pet'), time.time())
+        self.send_json({'pet': pet, 'version': version},
+                       headers={**self.etag_headers(version), 'Cache-Control': 'no-cache'})
+
+    @api.route('PUT', '/api/pet', auth=True, body='json')
+    def put_pet(self):
+        user_id, if_match = self.user_id, self.headers.get('If-Match')
+        # Decay restarts from the stats the client sent
+        data = petmodel.stamp(self.data, time.time()) if isinstance(self.data, dict) else self.data
+        version = run_write(lambda c: save_if_match(c, user_id, 'pet', data, if_match))
+        document_changed(user_id, 'pet')
+        self.send_json({'pet': data, 'version': version}, headers=self.etag_headers(version))
+
+    @api.route('POST', '/api/pet/actions', auth=True, body='json')
+    def pet_action(self):
+        user_id, data = self.user_id, self.data
+        action = data.get('action') if isinstance(data, dict) else None
+        
+        def act(c):
+            require_version(self.headers.get('If-Match'), entries.document_version(c, user_id, 'pet'))
+            pet, message = petmodel.apply_action(entries.load_document(c, user_id, 'pet'), action,
+                                                 time.time())
+            return pet, message, entries.save_document(c, user_id, 'pet', pet)
+        
+        pet, message, version = run_write(act)
+        document_changed(user_id, 'pet')
+        self.send_json({'pet': pet, 'message': message, 'version': version},
+                       headers=self.etag_headers(version))
+
+    @api.route('GET', '/api/habits', auth=True, db=True, page=True)
+    def get_habits(self):
+        c, user_id, page = self.cursor, self.user_id, self.page
+        version = entries.document_version(c, user_id, 'habits')
+        if self.check_not_modified(version):
+            return
+        if page:
+            data, paging = entries.query_document(c, user_id, 'habits', page)
+            habits = data.get('habits', []) if data else []
+            self.send_json({'habits': habits, 'paging': paging}, headers=self.etag_headers(version))
+        else:
+            self.send_cached(user_id, 'habits', version, 'habits',
+                             lambda: {'habits': (entries.load_document(c, user_id, 'habits') or {})
+                                      .get('habits', [])},
+                             headers=self.etag_headers(version))
+
+    @api.route('PUT', '/api/habits', auth=True, body='json')
+    def put_habits(self):
+        user_id, data, if_match = self.user_id, self.data, self.headers.get('If-Match')
+        version = run_write(lambda c: save_if_match(c, user_id, 'habits', {'habits': data}, if_match))
+        document_changed(user_id, 'habits')
+        self.send_json({'habits': data, 'version': version}, headers=self.etag_headers(version))
+
+    @api.route('GET', '/api/moods', auth=True, db=True, page=True)
+    def get_moods(self):
+        c, user_id, page = self.cursor, self.user_id, self.page
+        version = entries.document_version(c, user_id, 'moods')
+        if self.check_not_modified(version):
+            return
+        if page:
+            moods, paging = entries.query_entries(c, user_id, 'moods', page)
+            self.send_json({'moods': moods, 'paging': paging}, headers=self.etag_headers(version))
+        else:
+            self.send_cached(user_id, 'moods', version, 'moods',
+                             lambda: {'moods': entries.load_entries(c, user_id, 'moods')},
+                             headers=self.etag_headers(version))
+
+    @api.route('POST', '/api/moods', auth=True, body='json', db=True)
+    def add_mood(self):
+        c, user_id, data = self.cursor, self.user_id, self.data
+        version = run_write(lambda c: entries.append_entry(c, user_id, 'moods', data))
+        document_changed(user_id, 'moods')
+        
+        if entries.wants_minimal_response(self.headers, self.query_params):
+            self.send_json({'mood': data, 'version': version}, status=201,
+                           headers=self.etag_headers(version))
+        else:
+            moods = entries.load_entries(c, user_id, 'moods')
+            self.send_json({'mood': data, 'moods': moods, 'version': version}, status=201,
+                           headers=self.etag_headers(version))
+
+    # Search and analytics
+
+    @api.route('GET', '/api/journal/search', auth=True, db=True, page=True)
+    def search_journal(self):
+        c, user_id = self.cursor, self.user_id
+        query = self.query_params.get('q', '').strip()
+        if not query:
+            self.send_error_json(400, 'Missing search query')
+            return
+        version = entries.document_version(c, user_id, 'journal')
+        if self.check_not_modified(version):
+            return
+        results, paging = search.search_journal(c, user_id, query, self.page)
+        self.send_json({'results': results, 'paging': paging}, headers=self.etag_headers(version))
+
+    @api.route('GET', '/api/analytics/moods', auth=True, db=True)
+    def get_mood_trend(self):
+        c, user_id = self.cursor, self.user_id
+        granularity = analytics.parse_granularity(self.query_params)
+        version = entries.document_version(c, user_id, 'moods')
+        if self.check_not_modified(version):
+            return
+        buckets = analytics.mood_trend(c, user_id, granularity,
+                                       self.query_params.get('from'), self.query_params.get('to'))
+        self.send_json({'granularity': granularity, 'buckets': buckets}, headers=self.etag_headers(version))
+
+    @api.route('GET', '/api/analytics/habits/streaks', auth=True, db=True)
+    def get_habit_streaks(self):
+        c, user_id = self.cursor, self.user_id
+        today = self.query_params.get('today')
+        if today is not None and analytics.parse_day(today) is None:
+            self.send_error_json(400, 'Invalid today date')
+            return
+        habits = analytics.load_habits(c, user_id)
+        streaks = analytics.habit_streaks(c, user_id, habits, analytics.parse_day(today))
+        self.send_json({'habits': streaks})
+
+    # Reminders
+
+    @api.route('GET', '/api/reminders', auth=True, db=True)
+    def list_reminders(self):
+        self.send_json({'reminders': reminders.list_reminders(self.cursor, self.user_id)})
+
+    @api.route('POST', '/api/reminders', auth=True, body='json')
+    def create_reminder(self):
+        user_id, data = self.user_id, self.data
+        reminder, next_fire_at = run_write(lambda c: reminders.create_reminder(c, user_id, data, time.time()))
+        reminder_scheduler.schedule(reminder['id'], next_fire_at)
+        self.send_json({'reminder': reminder}, status=201)
+
+    @api.route('PUT', '/api/reminders/<int:reminder_id>', auth=True, body='json')
+    def update_reminder(self, reminder_id):
+        user_id, data = self.user_id, self.data
+        updated = run_write(lambda c: reminders.update_reminder(c, user_id, reminder_id, data, time.time()))
+        if updated is None:
+            self.send_error_json(404, 'Reminder not found')
+            return
+        reminder, next_fire_at = updated
+        reminder_scheduler.schedule(reminder['id'], next_fire_at)
+        self.send_json({'reminder': reminder})
+
+    @api.route('DELETE', '/api/reminders/<int:reminder_id>', auth=True)
+    def delete_reminder(self, reminder_id):
+        user_id = self.user_id
+        # The scheduler drops a deleted reminder when its firing comes up
+        if run_write(lambda c: reminders.delete_reminder(c, user_id, reminder_id)):
+            self.send_json({'message': 'Reminder deleted'})
+        else:
+            self.send_error_json(404, 'Reminder not found')
+
+    def do_HEAD(self):
+        path = urllib.parse.urlparse(self.path).path
+        if path.startswith('/api/'):
+            self.send_error(405)
         else:
-            # SPA fallback - serve index.html
-            self.serve_index()
+            self.serve_static(path, head=True)
 
-    def serve_index(self):
-        index_path = os.path.join('dist', 'index.html')
-        if os.path.exists(index_path):
+    def serve_static(self, path, head=False):
+        """Serve a file of the frontend build, or index.html for app routes (see static.py)"""
+        entry = static_files.lookup(urllib.parse.unquote(path))
+        if entry is None:
+            self.send_error_json(404, 'Frontend not found. Please build first.')
+            return
+        variant = entry.variant(self.headers.get('Accept-Encoding'))
+        try:
+            entry, variant, f = static_files.open(entry, variant)
+        except FileNotFoundError:
+            self.send_error_json(404, 'File not found')
+            return
+        
+        with f:
+            headers = entry.headers(variant)
+            if entry.not_modified(variant, self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since')):
+                self.send_response(304)
+                self.send_header('Access-Control-Allow-Origin', '*')
+                for name in static.NOT_MODIFIED_HEADERS:
+                    if name in headers:
+                        self.send_header(name, headers[name])
+                self.end_headers()
+                return
+            
             self.send_response(200)
             self.send_header('Access-Control-Allow-Origin', '*')
-            self.send_header('Content-Type', 'text/html')
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_queue_timing()
             self.end_headers()
-            with open(index_path, 'rb') as f:
-                self.wfile.write(f.read())
-        else:
-            self.send_error_json(404, 'Frontend not found. Please build first.')
+            if head:
+                return
+            with metrics.stage('write'):
+                if variant.size >= static.SENDFILE_MIN:
+                    serving.sendfile(self, f, variant.size)
+                else:
+                    self.wfile.write(f.read())
+
+    def send_json(self, data, status=200, headers=None):
+        with metrics.stage('json'):
+            body = json.dumps(data).encode()
+        self.send_json_body(body, status, headers)
 
-    def send_json(self, data, status=200):
+    def send_json_body(self, body, status=200, headers=None, encoding=None):
+        """Send encoded JSON, compressed if large enough and the client accepts it
+
+        A ``body`` already compressed with ``encoding`` is sent as is.
+        """
+        if encoding is None:
+            encoding = compress.negotiate(self.headers.get('Accept-Encoding'), len(body))
+            if encoding:
+                body = compress.compress(body, encoding)
         self.send_response(status)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Content-Type', 'application/json')
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_queue_timing()
+        with metrics.stage('write'):
+            self.end_headers()
+            self.wfile.write(body)
+
+    def send_stream(self, chunks, content_type, headers=None):
+        """Send a 200 response of unknown length as its chunks are produced
+        
+        Chunked when the connection can stay open, otherwise ended by closing it.
+        """
+        chunked = (self.request_version == 'HTTP/1.1' and self.batch_user_id is None
+                   and not self.close_connection and self.keep_alive_allowed())
+        self.send_response(200)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Content-Type', content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+        self.send_queue_timing()
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                with metrics.stage('write'):
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk)
+            if chunked:
+                self.wfile.write(b'0\r\n\r\n')
+        except BaseException:
+            # Only closing the connection tells the client the response was cut short
+            self.close_connection = True
+            raise
+
+    def cached_body(self, user_id, data_type, version, view, build):
+        """Encoded response for this document version, built and cached on a miss"""
+        cached = doc_cache.get(user_id, data_type, version, view)
+        if cached is not None:
+            return cached[1]
+        payload = build()
+        with metrics.stage('json'):
+            body = json.dumps(payload).encode()
+        doc_cache.put(user_id, data_type, version, view, payload, body)
+        return body
+
+    def send_cached(self, user_id, data_type, version, view, build, headers=None):
+        """Send a cached document response, compressing it at most once per version and encoding"""
+        body = self.cached_body(user_id, data_type, version, view, build)
+        encoding = compress.negotiate(self.headers.get('Accept-Encoding'), len(body))
+        if encoding:
+            encoded_view = f'{view}:{encoding}'
+            cached = doc_cache.get(user_id, data_type, version, encoded_view)
+            if cached is not None:
+                body = cached[1]
+            else:
+                body = compress.compress(body, encoding)
+                doc_cache.put(user_id, data_type, version, encoded_view, None, body)
+        self.send_json_body(body, headers=headers, encoding=encoding)
+
+    def read_body(self):
+        """Request body with its Content-Encoding removed; None after sending an error"""
+        content_length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(content_length)
+        try:
+            return compress.decode_body(body, self.headers.get('Content-Encoding')).decode()
+        except compress.UnsupportedEncoding as e:
+            self.send_error_json(415, str(e))
+        except compress.BodyTooLarge as e:
+            self.send_error_json(413, str(e))
+        except ValueError as e:
+            self.send_error_json(400, str(e))
+        return None
+
+    def upgrade_password_hash(self, user_id, old_hash, password):
+        """Replace a legacy hash now that the password is known; skipped when hashing is busy"""
+        try:
+            new_hash = passwords.hash_password(password)
+        except passwords.Overloaded:
+            return
+        run_write(lambda c: c.execute('UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?',
+                                      (new_hash, user_id, old_hash)))
+
+    def send_metrics(self):
+        """Prometheus metrics of this process (see metrics.py)"""
+        if not metrics.authorized(self.headers.get('Authorization')):
+            self.send_error_json(401, 'Unauthorized')
+            return
+        extra = metrics.snapshot_families('calmora_doc_cache', 'Document cache', doc_cache.snapshot())
+        extra += metrics.snapshot_families('calmora_token_cache', 'Token cache', token_cache.snapshot())
+        extra += metrics.snapshot_families('calmora_change_feed', 'Change feed', change_feed.snapshot())
+        stats = getattr(self.server, 'stats', None)
+        if stats:
+            extra += metrics.snapshot_families('calmora_server', 'Worker queue', stats.snapshot())
+        extra += metrics.snapshot_families('calmora_password_hashing', 'Password hashing', passwords.hasher.snapshot())
+        extra += metrics.snapshot_families('calmora_reminders', 'Reminders', reminder_scheduler.snapshot())
+        if group_committer is not None:
+            extra += metrics.snapshot_families('calmora_group_commit', 'Group commit', group_committer.snapshot())
+        body = metrics.registry.render(extra)
+        self.send_response(200)
+        self.send_header('Content-Type', metrics.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(body)
+
+    def send_queue_timing(self):
+        wait = serving.current_queue_wait()
+        if wait is not None:
+            self.send_header('Server-Timing', f'queue;dur={wait * 1000:.3f}')
+
+    def etag_headers(self, version):
+        if version is None:
+            return {}
+        return {'ETag': make_etag(version), 'Access-Control-Expose-Headers': 'ETag'}
 
-    def send_error_json(self, code, message):
+    def check_not_modified(self, version):
+        """Answer 304 if the client already has this version; True if it did"""
+        if not etag_matches(self.headers.get('If-None-Match'), version):
+            return False
+        self.send_response(304)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('ETag', make_etag(version))
+        self.end_headers()
+        return True
+
+    def send_conflict(self, version):
+        self.send_json({'error': 'Version conflict', 'version': version}, status=409,
+                       headers=self.etag_headers(version))
+
+    def send_error_json(self, code, message, headers=None):
+        body = json.dumps({'error': message}).encode()
         self.send_response(code)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Content-Type', 'application/json')
-        self.end_headers()
-        self.wfile.write(json.dumps({'error': message}).encode())
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_queue_timing()
+        with metrics.stage('write'):
+            self.end_headers()
+            self.wfile.write(body)
 
     def log_message(self, format, *args):
         print(f"[{datetime.datetime.now().strftime('%H:%M:%S')}] {args[0]}")
 
+api.compile(MIDDLEWARE)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Calmora backend server')
+    parser.add_argument('--port', type=int, default=int(os.getenv('PORT', PORT)))
+    parser.add_argument('--mode', choices=serving.MODES, default=SERVER_MODE,
+                        help='concurrency mode (env CALMORA_SERVER_MODE)')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='worker threads in threaded/asyncio mode (env CALMORA_WORKERS)')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+                        help='requests allowed to wait for a worker before answering 503 (env CALMORA_QUEUE_SIZE)')
+    parser.add_argument('--processes', type=int, default=PROCESSES,
+                        help='pre-forked worker processes, 0 for one per CPU (env CALMORA_PROCESSES)')
+    parser.add_argument('--reuse-port', action='store_true', default=os.getenv('CALMORA_REUSE_PORT') == '1',
+                        help='give each worker process its own SO_REUSEPORT socket (env CALMORA_REUSE_PORT=1)')
+    parser.add_argument('--keepalive-timeout', type=float, default=KEEPALIVE_TIMEOUT,
+                        help='seconds an idle connection stays open in threaded/asyncio mode, 0 to close after '
+                             'each response (env CALMORA_KEEPALIVE_TIMEOUT)')
+    parser.add_argument('--keepalive-requests', type=int, default=KEEPALIVE_REQUESTS,
+                        help='requests served on one connection before closing it (env CALMORA_KEEPALIVE_REQUESTS)')
+    parser.add_argument('--group-commit', action='store_true', default=GROUP_COMMIT,
+                        help='batch writes from concurrent requests into shared transactions (env CALMORA_GROUP_COMMIT=1)')
+    parser.add_argument('--rebuild-search-index', action='store_true',
+                        help='re-index all journal entries for /api/journal/search and exit')
+    parser.add_argument('--check-query-plans', action='store_true',
+                        help='exit non-zero if a hot query would scan a whole table (see migrations.py)')
+    parser.add_argument('--group-commit-ms', type=float, default=GROUP_COMMIT_WINDOW_MS,
+                        help='how long a batch waits for more writes (env CALMORA_GROUP_COMMIT_MS)')
+    args = parser.parse_args()
+    if args.processes < 1:
+        args.processes = os.cpu_count() or 1
+    return args
+
+def print_banner(args):
+    print(f"\n🚀 Calmora Backend Server")
+    print(f"📡 API: http://localhost:{args.port}/api")
+    print(f"🌐 Frontend: http://localhost:{args.port}")
+    print(f"💾 Database: {DB_PATH}")
+    if args.mode == 'single':
+        print(f"⚙️  Mode: single")
+    else:
+        print(f"⚙️  Mode: {args.mode} ({args.workers} workers, queue {args.queue_size})")
+        if args.keepalive_timeout > 0:
+            print(f"🔁 Keep-alive: {args.keepalive_timeout:g}s idle, {args.keepalive_requests} requests")
+    if args.processes > 1:
+        sharing = 'SO_REUSEPORT' if args.reuse_port and prefork.reuse_port_supported() else 'shared socket'
+        print(f"🧵 Processes: {args.processes} ({sharing})")
+    print(f"\nPress Ctrl+C to stop\n")
+
+def run(args, sock=None):
+    """Serve in the configured mode, on ``sock`` if given (pre-fork workers)"""
+    global group_committer
+    if args.group_commit:
+        group_committer = groupcommit.GroupCommitter(
+            lambda: dbpool.connect(DB_PATH, row_factory=sqlite3.Row),
+            max_delay=args.group_commit_ms / 1000)
+    if reminders.ENABLED:
+        reminder_scheduler.start()
+    
+    if args.mode == 'asyncio':
+        asyncio.run(serving.serve_asyncio('', args.port, CalmoraHandler, args.workers, args.queue_size, sock=sock,
+                                          keepalive_timeout=args.keepalive_timeout,
+                                          keepalive_requests=args.keepalive_requests))
+        return
+    
+    bind = sock is None
+    if args.mode == 'threaded':
+        httpd = serving.ThreadPoolServer(("", args.port), CalmoraHandler, args.workers, args.queue_size,
+                                         bind_and_activate=bind, keepalive_timeout=args.keepalive_timeout,
+                                         keepalive_requests=args.keepalive_requests)
+    else:
+        httpd = serving.TCPServer(("", args.port), CalmoraHandler, bind_and_activate=bind)
+    if sock is not None:
+        serving.adopt_socket(httpd, sock)
+    serving.serve_until_terminated(httpd)
+
 if __name__ == '__main__':
+    args = parse_args()
     init_db()
-    
-    with socketserver.TCPServer(("", PORT), CalmoraHandler) as httpd:
-        print(f"\n🚀 Calmora Backend Server")
-        print(f"📡 API: http://localhost:{PORT}/api")
-        print(f"🌐 Frontend: http://localhost:{PORT}")
-        print(f"💾 Database: {DB_PATH}")
-        print(f"\nPress Ctrl+C to stop\n")
-        try:
-            httpd.serve_forever()
-        except KeyboardInterrupt:
-            print("\n👋 Server stopped")
+    if args.rebuild_search_index:
+        conn = dbpool.connect(DB_PATH)
+        print(f"✅ Indexed {search.rebuild(conn)} journal entries")
+        conn.close()
+        raise SystemExit(0)
+    if args.check_query_plans:
+        conn = dbpool.connect(DB_PATH)
+        problems = migrations.check_query_plans(conn)
+        conn.close()
+        for name, detail in problems:
+            print(f"❌ {name}: {detail}")
+        print("✅ No full table scans" if not problems else f"❌ {len(problems)} full table scans")
+        raise SystemExit(1 if problems else 0)
+    print_banner(args)
+    try:
+        if args.processes > 1:
+            supervisor = prefork.Supervisor(lambda sock: run(args, sock), '', args.port, args.processes,
+                                            reuse_port=args.reuse_port)
+            supervisor.run()
+        else:
+            run(args)
+    except KeyboardInterrupt:
+        pass
+    print("\n👋 Server stopped")
@@ -0,0 +1,805 @@
+"""
+Calmora Backend - Concurrency modes for the standard-library server
+
+``single``   one request at a time (socketserver.TCPServer, the old behaviour)
+``threaded`` a fixed pool of worker threads fed by a bounded accept queue
+``asyncio``  an event loop reads requests and hands complete ones to a
+             bounded thread pool, so slow clients never hold a worker;
+             responses are buffered unless they outgrow ``STREAM_CHUNK``,
+             after which they are passed to the loop as they are written
+
+Both pooled modes answer 503 when the queue is full and record how long
+each request waited for a worker (exposed via ``/api/health`` and the
+``Server-Timing`` response header).
+
+In every mode a handler can ``detach`` its connection to keep writing to
+it from another thread after it returns, for long-lived responses such
+as event streams.
+
+The pooled modes keep HTTP/1.1 connections open between requests for up
+to ``keepalive_timeout`` seconds and ``keepalive_requests`` requests.
+An idle connection never holds a worker: threaded mode parks it in
+``IdleConnections``, one selector thread for all of them, and asyncio
+mode waits for it on the loop. Pipelined requests are answered in order.
+``single`` mode closes every connection after its response, since one
+idle client would stall everyone else.
+
+asyncio mode reads each whole request before handing it over, so it
+refuses a body declared over ``compress.MAX_REQUEST_BYTES`` (413) or an
+invalid ``Content-Length`` (400) on the loop, before reading the body.
+"""
+
+import asyncio
+import collections
+import io
+import json
+import queue
+import selectors
+import signal
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+import compress
+
+MODES = ('single', 'threaded', 'asyncio')
+
+MAX_HEADER_BYTES = 64 * 1024
+
+# Longest a client may take to send a request once it has started one
+REQUEST_TIMEOUT = 30
+
+# Largest response the asyncio mode buffers before streaming it
+STREAM_CHUNK = 64 * 1024
+
+_BUSY_BODY = b'{"error": "Server is overloaded"}'
+BUSY_RESPONSE = (
+    b'HTTP/1.1 503 Service Unavailable\r\n'
+    b'Content-Type: application/json\r\n'
+    b'Retry-After: 1\r\n'
+    b'Connection: close\r\n'
+    b'Content-Length: ' + str(len(_BUSY_BODY)).encode() + b'\r\n'
+    b'\r\n' + _BUSY_BODY
+)
+
+
+def error_response(status, message):
+    """A complete JSON error response that closes the connection, for requests refused on the loop."""
+    body = json.dumps({'error': message}).encode()
+    return (f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+            f'Content-Type: application/json\r\n'
+            f'Connection: close\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'\r\n').encode() + body
+
+
+class RequestRejected(ValueError):
+    """A request refused before its body was read; ``response`` answers it."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.response = error_response(status, message)
+
+
+# Queue wait of the request being handled on this thread
+_current = threading.local()
+
+
+def current_queue_wait():
+    """Seconds the current request waited for a worker, or None in single mode."""
+    return getattr(_current, 'queue_wait', None)
+
+
+class RequestBody:
+    """A request's body on a persistent connection: reads stop at its Content-Length.
+
+    Whatever the handler leaves unread is ``drain``-ed before the next
+    request is parsed, so it is never mistaken for one.
+    """
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return b''
+        data = self.rfile.read(size)
+        # A short read means the client hung up
+        self.remaining = self.remaining - len(data) if data else 0
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return b''
+        line = self.rfile.readline(size)
+        self.remaining = self.remaining - len(line) if line else 0
+        return line
+
+    def drain(self, limit):
+        """Discard the rest of the body; False (reading nothing) if more than ``limit`` bytes are left."""
+        if self.remaining > limit:
+            return False
+        while self.read(64 * 1024):
+            pass
+        return True
+
+
+class QueueStats:
+    """Thread-safe queue-wait statistics over a window of recent requests."""
+
+    def __init__(self, mode, workers, queue_size, window=1024):
+        self.mode = mode
+        self.workers = workers
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.samples = collections.deque(maxlen=window)
+        self.count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.rejected = 0
+        self.queued = 0
+
+    def record(self, wait):
+        with self.lock:
+            self.samples.append(wait)
+            self.count += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def reject(self):
+        with self.lock:
+            self.rejected += 1
+
+    def snapshot(self):
+        with self.lock:
+            recent = sorted(self.samples)
+            stats = {
+                'mode': self.mode,
+                'workers': self.workers,
+                'queue_size': self.queue_size,
+                'queued': self.queued,
+                'handled': self.count,
+                'rejected': self.rejected,
+                'queue_wait_avg_ms': round(1000 * self.total_wait / self.count, 3) if self.count else 0.0,
+                'queue_wait_max_ms': round(1000 * self.max_wait, 3),
+            }
+        for name, q in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99)):
+            value = recent[min(len(recent) - 1, int(q * len(recent)))] if recent else 0.0
+            stats[f'queue_wait_{name}_ms'] = round(1000 * value, 3)
+        return stats
+
+
+# ============== DETACHED CONNECTIONS ==============
+
+class TCPServer(socketserver.TCPServer):
+    """TCPServer that leaves detached connections open when their handler returns."""
+
+    # One request per connection (see the module docstring)
+    keepalive_timeout = 0
+    keepalive_requests = 1
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.detached = set()
+        self.detached_lock = threading.Lock()
+
+    def detach(self, request):
+        with self.detached_lock:
+            self.detached.add(request)
+
+    def shutdown_request(self, request):
+        with self.detached_lock:
+            detached = request in self.detached
+            self.detached.discard(request)
+        if detached:
+            # Only release this descriptor; the DetachedSocket holds a duplicate
+            self.close_request(request)
+        else:
+            super().shutdown_request(request)
+
+
+class DetachedSocket:
+    """A connection handed off by its handler (single/threaded mode).
+
+    ``send`` never blocks: bytes the socket won't take yet are kept, and
+    the connection is dropped once more than ``max_pending`` are waiting.
+    """
+
+    def __init__(self, sock, max_pending):
+        sock.setblocking(False)
+        self.sock = sock
+        self.max_pending = max_pending
+        self.pending = bytearray()
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def send(self, data):
+        """Queue ``data`` and write what the socket accepts; False once closed."""
+        with self.lock:
+            if self.closed:
+                return False
+            self.pending += data
+            try:
+                while self.pending:
+                    sent = self.sock.send(self.pending)
+                    del self.pending[:sent]
+            except BlockingIOError:
+                pass
+            except OSError:
+                self._close()
+                return False
+            if len(self.pending) > self.max_pending:
+                self._close()
+            return not self.closed
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class DetachedStream:
+    """A connection handed off by its handler in asyncio mode.
+
+    Writes are scheduled on the event loop; the connection is dropped once
+    more than ``max_pending`` bytes wait in the transport.
+    """
+
+    def __init__(self, loop, writer, max_pending):
+        self.loop = loop
+        self.writer = writer
+        self.max_pending = max_pending
+        self.closed = False
+
+    def send(self, data):
+        if self.closed:
+            return False
+        try:
+            self.loop.call_soon_threadsafe(self._write, data)
+        except RuntimeError:
+            # The loop has shut down
+            self.closed = True
+        return not self.closed
+
+    def _write(self, data):
+        if self.closed or self.writer.is_closing():
+            self.closed = True
+            return
+        self.writer.write(data)
+        if self.writer.transport.get_write_buffer_size() > self.max_pending:
+            self.close_now()
+
+    def close(self):
+        try:
+            self.loop.call_soon_threadsafe(self.close_now)
+        except RuntimeError:
+            self.closed = True
+
+    def close_now(self):
+        """close() for callers already on the loop thread."""
+        self.closed = True
+        self.writer.close()
+
+
+def detach(handler, max_pending):
+    """Keep a handler's connection open after the handler returns.
+
+    Whatever the handler has written so far is sent first. Returns a
+    DetachedSocket or DetachedStream any thread can ``send`` to without
+    blocking; the worker is free again as soon as the handler returns.
+    """
+    if isinstance(handler.wfile, _StreamingWriter):
+        stream = DetachedStream(handler.wfile.loop, handler.wfile.writer, max_pending)
+        stream.send(handler.wfile.getvalue())
+        handler.wfile.buffer.clear()
+        handler.detached = stream
+        return stream
+    handler.wfile.flush()
+    handler.close_connection = True
+    conn = DetachedSocket(handler.connection.dup(), max_pending)
+    handler.server.detach(handler.request)
+    return conn
+
+
+# ============== THREADED MODE ==============
+
+def _has_buffered_request(rfile, sock):
+    """True if the next request (or part of it) can be read without waiting."""
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        return bool(rfile.peek(1))
+    except OSError:
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+def _pooled_handler(handler_class):
+    """Handler subclass that serves what a connection has sent, then lets the server park it.
+
+    A parked connection comes back to a worker as ``_current.resumed``:
+    its reader (which may hold pipelined bytes already), its writer and
+    how many requests it has had.
+    """
+
+    class PooledHandler(handler_class):
+        timeout = REQUEST_TIMEOUT
+
+        def setup(self):
+            self.parked = None
+            resumed = getattr(_current, 'resumed', None)
+            if resumed is None:
+                super().setup()
+                return
+            self.connection = self.request
+            self.rfile, self.wfile, self.requests_served = resumed
+
+        def handle(self):
+            self.close_connection = True
+            self.handle_one_request()
+            while not self.close_connection and _has_buffered_request(self.rfile, self.connection):
+                self.handle_one_request()
+
+        def finish(self):
+            if self.close_connection:
+                super().finish()
+                return
+            self.wfile.flush()
+            self.parked = (self.rfile, self.wfile, self.requests_served)
+
+    PooledHandler.__name__ = handler_class.__name__
+    return PooledHandler
+
+
+class IdleConnections:
+    """Keep-alive connections between requests, watched by one selector thread.
+
+    ``on_ready(sock, state)`` is called once a parked connection has more
+    to read (or was closed by the client); ``on_expire(sock, state)``
+    once it has been idle for ``timeout`` seconds.
+    """
+
+    def __init__(self, timeout, on_ready, on_expire):
+        self.timeout = timeout
+        self.on_ready = on_ready
+        self.on_expire = on_expire
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.waiting = []  # (sock, state) parked since the thread last looked
+        self.idle = {}  # sock -> (state, deadline)
+        self.deadlines = collections.deque()  # (deadline, sock), oldest first
+        self.closed = False
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.thread = threading.Thread(target=self._run, name='calmora-keepalive', daemon=True)
+        self.thread.start()
+
+    def park(self, sock, state):
+        with self.lock:
+            if self.closed:
+                self.on_expire(sock, state)
+                return
+            self.waiting.append((sock, state))
+        self.wake_w.send(b'\0')
+
+    def __len__(self):
+        with self.lock:
+            return len(self.idle) + len(self.waiting)
+
+    def close(self):
+        """Close every idle connection; connections parked later are closed straight away."""
+        with self.lock:
+            self.closed = True
+        self.wake_w.send(b'\0')
+        self.thread.join()
+
+    def _run(self):
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+        while True:
+            with self.lock:
+                waiting, self.waiting = self.waiting, []
+                closed = self.closed
+            now = time.monotonic()
+            for sock, state in waiting:
+                try:
+                    self.selector.register(sock, selectors.EVENT_READ)
+                except (ValueError, OSError):
+                    self.on_expire(sock, state)
+                    continue
+                deadline = now + self.timeout
+                self.idle[sock] = (state, deadline)
+                self.deadlines.append((deadline, sock))
+            if closed:
+                for sock, (state, _) in self.idle.items():
+                    self.selector.unregister(sock)
+                    self.on_expire(sock, state)
+                self.idle.clear()
+                self.selector.close()
+                return
+
+            wait = max(0.0, self.deadlines[0][0] - now) if self.deadlines else None
+            for key, _ in self.selector.select(wait):
+                if key.fileobj is self.wake_r:
+                    try:
+                        while self.wake_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                state, _ = self.idle.pop(key.fileobj)
+                self.selector.unregister(key.fileobj)
+                self.on_ready(key.fileobj, state)
+
+            now = time.monotonic()
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, sock = self.deadlines.popleft()
+                # Skip connections that woke up (and maybe were parked again) since
+                if sock in self.idle and self.idle[sock][1] == deadline:
+                    state, _ = self.idle.pop(sock)
+                    self.selector.unregister(sock)
+                    self.on_expire(sock, state)
+
+
+class ThreadPoolServer(TCPServer):
+    """TCPServer that hands accepted connections to a fixed pool of threads."""
+
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, workers=8, queue_size=64, bind_and_activate=True,
+                 keepalive_timeout=0, keepalive_requests=100):
+        super().__init__(server_address, _pooled_handler(handler_class), bind_and_activate)
+        self.stats = QueueStats('threaded', workers, queue_size)
+        self.keepalive_timeout = keepalive_timeout
+        self.keepalive_requests = keepalive_requests
+        self.idle = IdleConnections(keepalive_timeout, self._resume, self._expire) if keepalive_timeout > 0 else None
+        self.requests = queue.Queue(maxsize=queue_size)
+        self.threads = [threading.Thread(target=self._worker, name=f'calmora-worker-{i}', daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def process_request(self, request, client_address):
+        self._enqueue(request, client_address, None)
+
+    def _enqueue(self, request, client_address, resumed):
+        try:
+            self.requests.put_nowait((request, client_address, time.perf_counter(), resumed))
+            self.stats.queued = self.requests.qsize()
+        except queue.Full:
+            self.stats.reject()
+            try:
+                request.sendall(BUSY_RESPONSE)
+            except OSError:
+                pass
+            self._close(request, resumed)
+
+    def _resume(self, request, state):
+        client_address, resumed = state
+        self._enqueue(request, client_address, resumed)
+
+    def _expire(self, request, state):
+        self._close(request, state[1])
+
+    def _close(self, request, resumed):
+        if resumed is not None:
+            rfile, wfile, _ = resumed
+            wfile.close()
+            rfile.close()
+        self.shutdown_request(request)
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def _worker(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, client_address, enqueued_at, resumed = item
+            wait = time.perf_counter() - enqueued_at
+            self.stats.record(wait)
+            _current.queue_wait = wait
+            _current.resumed = resumed
+            handler = None
+            try:
+                handler = self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                _current.queue_wait = None
+                _current.resumed = None
+            if handler is not None and handler.parked is not None and self.idle is not None:
+                self.idle.park(request, (client_address, handler.parked))
+            else:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        """Stop listening, then let the workers finish everything already queued."""
+        super().server_close()
+        # Responses from here on close their connections
+        self.keepalive_timeout = 0
+        if self.idle is not None:
+            self.idle.close()
+        for _ in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def serve_until_terminated(httpd):
+    """``serve_forever()`` that drains gracefully on SIGTERM.
+
+    The listener stops accepting; requests already accepted (and, in
+    threaded mode, already queued) still complete before returning.
+    """
+    def on_sigterm(signum, frame):
+        # shutdown() blocks until serve_forever() exits, so it can't run on this thread
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+    with httpd:
+        httpd.serve_forever()
+
+
+def adopt_socket(httpd, sock):
+    """Make a socketserver created with ``bind_and_activate=False`` use ``sock``."""
+    httpd.socket.close()
+    httpd.socket = sock
+    httpd.server_address = sock.getsockname()
+
+
+# ============== ASYNCIO MODE ==============
+
+class _BufferedServer:
+    """Stand-in for the socketserver the handler expects in asyncio mode."""
+
+    def __init__(self, stats, loop, keepalive_timeout, keepalive_requests):
+        self.stats = stats
+        self.loop = loop
+        self.keepalive_timeout = keepalive_timeout
+        self.keepalive_requests = keepalive_requests
+
+
+async def _write(writer, data):
+    writer.write(data)
+    await writer.drain()
+
+
+async def _sendfile(loop, writer, data, f, count):
+    if data:
+        await _write(writer, data)
+    await loop.sendfile(writer.transport, f, 0, count)
+
+
+class _StreamingWriter:
+    """Response stream of a handler running in the pool.
+
+    Writes collect in a buffer that the loop sends once the handler
+    returns. Past ``STREAM_CHUNK`` the buffer is handed to the loop
+    straight away and the worker waits until the client has taken it, so
+    a long streamed response never sits in memory all at once.
+    """
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= STREAM_CHUNK:
+            chunk = bytes(self.buffer)
+            self.buffer.clear()
+            asyncio.run_coroutine_threadsafe(_write(self.writer, chunk), self.loop).result()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def sendfile(self, f, count):
+        """Send what is buffered, then ``count`` bytes of ``f`` via the loop's sendfile."""
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        asyncio.run_coroutine_threadsafe(_sendfile(self.loop, self.writer, data, f, count), self.loop).result()
+
+    def getvalue(self):
+        return bytes(self.buffer)
+
+
+def sendfile(handler, f, count):
+    """Write ``count`` bytes of file ``f`` to a handler's client without reading them into Python.
+
+    Works in every mode: threaded handlers own a blocking socket, and in
+    asyncio mode the loop sends the file once the headers are flushed.
+    """
+    if isinstance(handler.wfile, _StreamingWriter):
+        handler.wfile.sendfile(f, count)
+    else:
+        handler.wfile.flush()
+        handler.connection.sendfile(f, 0, count)
+
+
+def _buffered_handler(handler_class):
+    """Handler subclass that reads a pre-read request and writes through _StreamingWriter."""
+
+    class BufferedHandler(handler_class):
+        def setup(self):
+            raw, writer, self.requests_served = self.request
+            self.connection = None
+            self.rfile = io.BytesIO(raw)
+            self.wfile = _StreamingWriter(self.server.loop, writer)
+
+        def handle(self):
+            # Only this request was read; the loop reads the next one
+            self.close_connection = True
+            self.handle_one_request()
+
+        def handle_expect_100(self):
+            # The loop has read the body already
+            return True
+
+        def finish(self):
+            self.response_bytes = self.wfile.getvalue()
+
+    BufferedHandler.__name__ = handler_class.__name__
+    return BufferedHandler
+
+
+async def _read_request(reader):
+    """Read one HTTP request (head plus Content-Length body) without blocking a thread."""
+    head = await reader.readuntil(b'\r\n\r\n')
+    if len(head) > MAX_HEADER_BYTES:
+        raise ValueError('Request head too large')
+    length = 0
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            try:
+                length = int(value.strip() or 0)
+            except ValueError:
+                length = -1
+            if length < 0:
+                raise RequestRejected(HTTPStatus.BAD_REQUEST, 'Invalid Content-Length')
+            # Checked before reading, so a huge declared body is never buffered on the loop
+            if length > compress.MAX_REQUEST_BYTES:
+                raise RequestRejected(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'Request body too large')
+    body = await reader.readexactly(length) if length else b''
+    return head + body
+
+
+def run_handler(handler_class, raw, client_address, server, enqueued_at):
+    wait = time.perf_counter() - enqueued_at
+    server.stats.record(wait)
+    _current.queue_wait = wait
+    try:
+        handler = handler_class(raw, client_address, server)
+        return handler.response_bytes, getattr(handler, 'detached', None), not handler.close_connection
+    finally:
+        _current.queue_wait = None
+
+
+async def serve_asyncio(host, port, handler_class, workers=8, queue_size=64, sock=None, drain_timeout=30,
+                        keepalive_timeout=0, keepalive_requests=100):
+    """Serve until SIGTERM. Requests are parsed on the loop, handled in a pool.
+
+    On SIGTERM the listener closes, idle connections are closed and busy
+    ones get up to ``drain_timeout`` seconds to finish their request.
+    """
+    stats = QueueStats('asyncio', workers, queue_size)
+    loop = asyncio.get_running_loop()
+    server_stub = _BufferedServer(stats, loop, keepalive_timeout, keepalive_requests)
+    handler = _buffered_handler(handler_class)
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='calmora-worker')
+    # Requests running or waiting for a worker, and open connections;
+    # only touched on the loop thread
+    in_flight = 0
+    connections = 0
+    detached = set()
+    # Connections waiting for their next request, closed straight away on SIGTERM
+    idle = set()
+
+    async def next_request(reader, writer, served):
+        if not served:
+            return await asyncio.wait_for(_read_request(reader), timeout=REQUEST_TIMEOUT)
+        # Idle until the first byte, then the usual time to send the rest
+        idle.add(writer)
+        try:
+            first = await asyncio.wait_for(reader.read(1), timeout=keepalive_timeout)
+        finally:
+            idle.discard(writer)
+        if not first:
+            raise asyncio.IncompleteReadError(b'', None)
+        return first + await asyncio.wait_for(_read_request(reader), timeout=REQUEST_TIMEOUT)
+
+    async def on_connection(reader, writer):
+        nonlocal in_flight, connections
+        client_address = writer.get_extra_info('peername')
+        connections += 1
+        try:
+            served = 0
+            while True:
+                try:
+                    raw = await next_request(reader, writer, served)
+                except RequestRejected as e:
+                    writer.write(e.response)
+                    await writer.drain()
+                    return
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        asyncio.TimeoutError, ValueError):
+                    return
+
+                if in_flight >= workers + queue_size:
+                    stats.reject()
+                    writer.write(BUSY_RESPONSE)
+                    await writer.drain()
+                    return
+
+                in_flight += 1
+                stats.queued = max(0, in_flight - workers)
+                try:
+                    response, stream, keep_alive = await loop.run_in_executor(
+                        executor, run_handler, handler, (raw, writer, served), client_address, server_stub,
+                        time.perf_counter())
+                finally:
+                    in_flight -= 1
+                writer.write(response)
+                await writer.drain()
+                served += 1
+                if stream is not None:
+                    # Detached: stay open, without a worker, until either side closes
+                    detached.add(stream)
+                    try:
+                        while not stream.closed and await reader.read(4096):
+                            pass
+                    finally:
+                        detached.discard(stream)
+                        stream.close_now()
+                    return
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            connections -= 1
+            writer.close()
+
+    stopping = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    if sock is not None:
+        server = await asyncio.start_server(on_connection, sock=sock, limit=MAX_HEADER_BYTES)
+    else:
+        server = await asyncio.start_server(on_connection, host, port, limit=MAX_HEADER_BYTES)
+    try:
+        async with server:
+            await stopping.wait()
+            server.close()
+            # Responses from here on close their connections; newer Pythons wait for
+            # every connection to close before leaving this block
+            server_stub.keepalive_timeout = 0
+            for stream in list(detached):
+                stream.close_now()
+            for writer in list(idle):
+                writer.close()
+        deadline = loop.time() + drain_timeout
+        while connections and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+    finally:
+        executor.shutdown(wait=False)
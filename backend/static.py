@@ -0,0 +1,217 @@
+"""
+Calmora Backend - Static files of the built frontend
+
+``StaticFiles`` scans ``dist/`` once at start-up into a manifest of every
+file's size, mtime, content hash and MIME type, so serving one needs no
+``stat`` or hashing per request. With it both backends:
+
+* answer ``If-None-Match`` / ``If-Modified-Since`` with 304,
+* send a ``.br`` or ``.gz`` sibling built next to a file (e.g. by a Vite
+  compression plugin) to clients that accept it, never compressing
+  anything per request,
+* mark content-hashed Vite assets (``assets/index-4f2a9c1b.js``) as
+  cacheable forever, and everything else (``index.html``) as needing
+  revalidation, which the ETag makes cheap,
+* hand files of ``SENDFILE_MIN`` bytes or more to ``sendfile`` instead of
+  reading them into Python.
+
+A rebuild while the server runs is picked up file by file: a changed
+file is noticed when it is opened, and a path missing from the manifest
+is looked up on disk before falling back to ``index.html``.
+"""
+
+import email.utils
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+import threading
+
+import compress
+
+SENDFILE_MIN = int(os.getenv('CALMORA_SENDFILE_MIN', 64 * 1024))
+
+INDEX = 'index.html'
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+# Headers a 304 repeats from the full response
+NOT_MODIFIED_HEADERS = ('ETag', 'Last-Modified', 'Cache-Control', 'Vary')
+
+# Precompressed siblings, in order of preference
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+
+# Vite's default output name for bundled assets: assets/[name]-[hash].[ext]
+HASHED_ASSET = re.compile(r'^assets/.+-[A-Za-z0-9_-]{8,}\.[A-Za-z0-9]+$')
+
+CONTENT_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.js': 'application/javascript; charset=utf-8',
+    '.mjs': 'application/javascript; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+    '.json': 'application/json',
+    '.map': 'application/json',
+    '.svg': 'image/svg+xml',
+    '.webmanifest': 'application/manifest+json',
+    '.wasm': 'application/wasm',
+}
+
+
+def content_type(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in CONTENT_TYPES:
+        return CONTENT_TYPES[ext]
+    return mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()[:20]
+
+
+class Variant:
+    """One file on disk: the original or a precompressed sibling."""
+
+    def __init__(self, path, size, etag, encoding=None):
+        self.path = path
+        self.size = size
+        self.etag = etag
+        self.encoding = encoding
+
+
+class StaticFile:
+    def __init__(self, name, path):
+        st = os.stat(path)
+        digest = _file_hash(path)
+        self.name = name
+        self.mtime = int(st.st_mtime)
+        self.content_type = content_type(name)
+        self.cache_control = IMMUTABLE if HASHED_ASSET.match(name) else REVALIDATE
+        self.last_modified = email.utils.formatdate(self.mtime, usegmt=True)
+        self.identity = Variant(path, st.st_size, f'"{digest}"')
+        self.variants = {}
+        for encoding, suffix in PRECOMPRESSED:
+            if os.path.isfile(path + suffix):
+                self.variants[encoding] = Variant(path + suffix, os.path.getsize(path + suffix),
+                                                  f'"{digest}-{encoding}"', encoding)
+
+    def variant(self, accept_encoding):
+        """Best file to send for this Accept-Encoding header."""
+        if self.variants:
+            encoding = compress.preferred_encoding(accept_encoding, list(self.variants))
+            if encoding:
+                return self.variants[encoding]
+        return self.identity
+
+    def not_modified(self, variant, if_none_match, if_modified_since):
+        """True if the client's copy (by ETag, else by date) is current."""
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or variant.etag in tags or f'W/{variant.etag}' in tags
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            return since is not None and self.mtime <= since.timestamp()
+        return False
+
+    def headers(self, variant):
+        headers = {
+            'Content-Type': self.content_type,
+            'Content-Length': str(variant.size),
+            'ETag': variant.etag,
+            'Last-Modified': self.last_modified,
+            'Cache-Control': self.cache_control,
+        }
+        if variant.encoding:
+            headers['Content-Encoding'] = variant.encoding
+        if self.variants:
+            headers['Vary'] = 'Accept-Encoding'
+        return headers
+
+
+class StaticFiles:
+    """Manifest of the files under ``root``, keyed by URL path without the leading slash."""
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.files = {}
+        self.scan()
+
+    def scan(self):
+        files = {}
+        if os.path.isdir(self.root):
+            for dirpath, _, filenames in os.walk(self.root):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    name = os.path.relpath(path, self.root).replace(os.sep, '/')
+                    if self._is_sibling(path):
+                        continue
+                    files[name] = StaticFile(name, path)
+        with self.lock:
+            self.files = files
+
+    def _is_sibling(self, path):
+        return any(path.endswith(suffix) and os.path.isfile(path[:-len(suffix)])
+                   for _, suffix in PRECOMPRESSED)
+
+    def lookup(self, url_path):
+        """File for a request path, ``index.html`` for app routes, or None without a build."""
+        name = posixpath.normpath('/' + url_path).lstrip('/')
+        if name in ('', '.'):
+            name = INDEX
+        with self.lock:
+            entry = self.files.get(name)
+        if entry is None and '.' in posixpath.basename(name):
+            entry = self._add(name)
+        if entry is None:
+            with self.lock:
+                entry = self.files.get(INDEX)
+        return entry
+
+    def open(self, entry, variant):
+        """Open a variant for reading; returns ``(entry, variant, file)``.
+
+        If the file changed on disk since it was indexed, it is indexed
+        again and the fresh entry and variant are returned.
+        """
+        try:
+            f = open(variant.path, 'rb')
+        except FileNotFoundError:
+            with self.lock:
+                self.files.pop(entry.name, None)
+            raise
+        st = os.fstat(f.fileno())
+        changed = st.st_size != variant.size or (variant.encoding is None and int(st.st_mtime) != entry.mtime)
+        if not changed:
+            return entry, variant, f
+        f.close()
+        fresh = self._add(entry.name)
+        if fresh is None:
+            raise FileNotFoundError(variant.path)
+        variant = fresh.variants.get(variant.encoding) or fresh.identity
+        return fresh, variant, open(variant.path, 'rb')
+
+    def _add(self, name):
+        path = os.path.join(self.root, *name.split('/'))
+        if not os.path.isfile(path) or self._is_sibling(path):
+            return None
+        entry = StaticFile(name, path)
+        with self.lock:
+            self.files[name] = entry
+        return entry
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'files': len(self.files),
+                'bytes': sum(entry.identity.size for entry in self.files.values()),
+                'precompressed': sum(len(entry.variants) for entry in self.files.values()),
+            }
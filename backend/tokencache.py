@@ -0,0 +1,127 @@
+"""
+Calmora Backend - Verified-token cache and token revocation
+
+Checking a token means recomputing its signature, parsing its payload
+and asking the database whether it was revoked. ``TokenCache`` remembers
+the outcome so later requests with the same token cost one dictionary
+lookup. An entry is dropped once the token expires, and is re-checked
+against the database every ``revalidate_after`` seconds.
+
+Tokens are revoked in two ways:
+
+* logout denylists one token by id in ``revoked_tokens``
+* a password change bumps ``users.token_version``, which is embedded in
+  every token (as ``tv``), so all of the user's earlier tokens stop
+  matching
+
+Both also drop the affected entries from this process's cache right
+away. Other worker processes notice within ``revalidate_after`` seconds.
+"""
+
+import collections
+import os
+import threading
+import time
+
+MAX_ENTRIES = int(os.getenv('CALMORA_TOKEN_CACHE_SIZE', 10000))
+REVALIDATE_AFTER = float(os.getenv('CALMORA_TOKEN_REVALIDATE', 30))
+
+
+class TokenCache:
+    """Thread-safe, bounded LRU of verified token id -> user id."""
+
+    def __init__(self, max_entries=MAX_ENTRIES, revalidate_after=REVALIDATE_AFTER):
+        self.max_entries = max_entries
+        self.revalidate_after = revalidate_after
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # token id -> (user_id, valid_until)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token_id):
+        """User id of a still-valid cached token, or None."""
+        with self.lock:
+            entry = self.entries.get(token_id)
+            if entry is None or entry[1] < time.time():
+                if entry is not None:
+                    del self.entries[token_id]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(token_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token_id, user_id, expires_at):
+        if self.max_entries <= 0:
+            return
+        valid_until = min(expires_at, time.time() + self.revalidate_after)
+        with self.lock:
+            self.entries[token_id] = (user_id, valid_until)
+            self.entries.move_to_end(token_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def forget(self, token_id):
+        with self.lock:
+            self.entries.pop(token_id, None)
+
+    def forget_user(self, user_id):
+        with self.lock:
+            for token_id in [t for t, (uid, _) in self.entries.items() if uid == user_id]:
+                del self.entries[token_id]
+
+    def snapshot(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+# ============== SQLITE ACCESS ==============
+
+def create_schema(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS revoked_tokens (
+            jti TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+
+
+def add_token_version_column(conn):
+    """Add ``users.token_version`` to databases created before it existed."""
+    c = conn.cursor()
+    c.execute('PRAGMA table_info(users)')
+    if 'token_version' not in [row[1] for row in c.fetchall()]:
+        c.execute('ALTER TABLE users ADD COLUMN token_version INTEGER NOT NULL DEFAULT 0')
+        conn.commit()
+
+
+def is_revoked(c, jti, user_id, token_version):
+    """True if the token was logged out, predates a password change, or its user is gone."""
+    c.execute('SELECT token_version FROM users WHERE id = ?', (user_id,))
+    row = c.fetchone()
+    if row is None or row[0] != token_version:
+        return True
+    c.execute('SELECT 1 FROM revoked_tokens WHERE jti = ?', (jti,))
+    return c.fetchone() is not None
+
+
+def revoke_token(c, jti, user_id, expires_at):
+    # Denylist rows are only needed until the token would have expired anyway
+    c.execute('DELETE FROM revoked_tokens WHERE expires_at < ?', (time.time(),))
+    c.execute('INSERT OR IGNORE INTO revoked_tokens (jti, user_id, expires_at) VALUES (?, ?, ?)',
+              (jti, user_id, expires_at))
+
+
+def revoke_user_tokens(c, user_id):
+    """Invalidate every token issued to a user so far; returns the new token version."""
+    c.execute('UPDATE users SET token_version = token_version + 1 WHERE id = ?', (user_id,))
+    c.execute('SELECT token_version FROM users WHERE id = ?', (user_id,))
+    return c.fetchone()[0]
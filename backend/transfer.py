@@ -0,0 +1,219 @@
+"""
+Calmora Backend - Streaming NDJSON export and import of user data
+
+An export is one JSON record per line:
+
+* ``{"type": "header", "format": "calmora-export", "version": 1, ...}``
+* ``{"type": "document", "data_type": ..., "data": {...}}`` for the part
+  of each document kept in ``user_data`` (for moods, journal and habits
+  that is everything except the entries themselves)
+* ``{"type": "entry", "data_type": ..., "data": {...}}`` for each mood,
+  journal entry and habit check-in (``{"habit_id": ..., "date": ...}``)
+* ``{"type": "end", "documents": n, "entries": m}``
+
+Entry rows are read with ``fetchmany`` and sent in chunks as they are
+produced, so memory use does not grow with the size of the history.
+
+An import reads the same format line by line and writes it in
+transactions of ``BATCH_SIZE`` records, reporting progress after each
+one. Documents replace the stored base document; entries are upserted by
+id (check-ins by habit and date), so re-importing a file does not
+duplicate anything. A document record may also carry its entries inline,
+as returned by ``GET /api/data/<type>``.
+"""
+
+import datetime
+import json
+import os
+
+import entries
+
+FORMAT = 'calmora-export'
+FORMAT_VERSION = 1
+
+NDJSON = 'application/x-ndjson'
+
+BATCH_SIZE = int(os.getenv('CALMORA_IMPORT_BATCH', 500))
+CHUNK_SIZE = 64 * 1024
+FETCH_SIZE = 500
+MAX_LINE = 16 * 1024 * 1024
+
+
+def _line(record):
+    return json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+# ============== EXPORT ==============
+
+def export_records(c, user_id):
+    """Yield a user's data as export records, streaming entry rows from ``c``."""
+    yield {
+        'type': 'header',
+        'format': FORMAT,
+        'version': FORMAT_VERSION,
+        'exported_at': entries.utc_now_iso(),
+    }
+
+    c.execute('SELECT data_type, data FROM user_data WHERE user_id = ? ORDER BY data_type', (user_id,))
+    documents = c.fetchall()
+    for data_type, raw in documents:
+        yield {'type': 'document', 'data_type': data_type, 'data': json.loads(raw) if raw else {}}
+
+    count = 0
+    c.execute('SELECT data_type, data FROM user_entries WHERE user_id = ? ORDER BY data_type, created_at, id',
+              (user_id,))
+    while True:
+        rows = c.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        for stored_type, raw in rows:
+            data_type = entries.HABITS if stored_type == entries.HABIT_CHECKINS else stored_type
+            count += 1
+            yield {'type': 'entry', 'data_type': data_type, 'data': json.loads(raw)}
+
+    yield {'type': 'end', 'documents': len(documents), 'entries': count}
+
+
+def export_chunks(c, user_id, chunk_size=CHUNK_SIZE):
+    """NDJSON export as byte chunks of roughly ``chunk_size``."""
+    chunk = bytearray()
+    for record in export_records(c, user_id):
+        chunk += _line(record)
+        if len(chunk) >= chunk_size:
+            yield bytes(chunk)
+            chunk.clear()
+    if chunk:
+        yield bytes(chunk)
+
+
+def export_filename():
+    return f'calmora-export-{datetime.date.today().isoformat()}.ndjson'
+
+
+# ============== IMPORT ==============
+
+def read_lines(stream, length=None, max_line=MAX_LINE):
+    """Yield lines from a binary stream, reading at most ``length`` bytes if given."""
+    remaining = length
+    while remaining is None or remaining > 0:
+        limit = max_line + 1 if remaining is None else min(remaining, max_line + 1)
+        line = stream.readline(limit)
+        if not line:
+            break
+        if remaining is not None:
+            remaining -= len(line)
+        if len(line) > max_line:
+            raise ValueError(f'Line longer than {max_line} bytes')
+        yield line
+
+
+def parse_record(line):
+    """Validate one import line; returns the record, or None for a blank line."""
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        record = json.loads(line)
+    except (UnicodeDecodeError, ValueError):
+        raise ValueError('Invalid JSON')
+    if not isinstance(record, dict):
+        raise ValueError('Record must be an object')
+
+    kind = record.get('type')
+    if kind == 'header':
+        if record.get('format') != FORMAT or record.get('version') != FORMAT_VERSION:
+            raise ValueError('Unsupported export format')
+        return record
+    if kind == 'end':
+        return record
+    if kind not in ('document', 'entry'):
+        raise ValueError('Unknown record type')
+    if not isinstance(record.get('data_type'), str) or not record['data_type']:
+        raise ValueError('Missing data_type')
+    if kind == 'document' and 'data' not in record:
+        raise ValueError('Missing data')
+    if kind == 'entry':
+        if record['data_type'] not in entries.ROW_BACKED_TYPES:
+            raise ValueError(f"{record['data_type']} has no entries")
+        if not isinstance(record.get('data'), dict):
+            raise ValueError('Entry data must be an object')
+    return record
+
+
+def _entry_row(data_type, entry):
+    if data_type == entries.HABITS:
+        habit_id = entry.get('habit_id')
+        return (str(habit_id) if habit_id is not None else None, entry.get('date'), entry)
+    return (entries.entry_key(entry), entries.entry_created_at(data_type, entry), entry)
+
+
+def apply_batch(c, user_id, records):
+    """Write a batch of document/entry records; returns the data types touched."""
+    bases = {}
+    rows = {}
+    for record in records:
+        data_type = record['data_type']
+        if record['type'] == 'document':
+            base, inline = entries.split_document(data_type, record['data'])
+            bases[data_type] = base
+            rows.setdefault(data_type, []).extend(inline)
+        else:
+            rows.setdefault(data_type, []).append(_entry_row(data_type, record['data']))
+
+    for data_type, base in bases.items():
+        entries.store_base(c, user_id, data_type, base)
+    for data_type, batch in rows.items():
+        entries.ensure_document(c, user_id, data_type)
+        entries.upsert_entries(c, user_id, data_type, batch)
+    touched = set(bases) | set(rows)
+    for data_type in sorted(touched):
+        entries.bump_version(c, user_id, data_type)
+    return touched
+
+
+def import_records(lines, write_batch, batch_size=BATCH_SIZE):
+    """Parse and write import lines, yielding progress records.
+
+    ``write_batch(records)`` must write the records with ``apply_batch``
+    in its own transaction. A progress record follows every committed
+    batch; the last record is ``{"type": "done", ...}``, or
+    ``{"type": "error", ...}`` naming the failing line. Batches committed
+    before an error stay committed; ``line`` in each record is the last
+    input line written, so a client can resume after it.
+    """
+    progress = {'records': 0, 'documents': 0, 'entries': 0, 'line': 0}
+    batch = []
+    line_no = 0
+
+    def flush():
+        try:
+            write_batch(batch)
+        except Exception as e:
+            raise ValueError('Could not save records') from e
+        for record in batch:
+            progress['documents' if record['type'] == 'document' else 'entries'] += 1
+        progress['records'] += len(batch)
+        progress['line'] = line_no
+        batch.clear()
+        return {'type': 'progress', **progress}
+
+    try:
+        for line_no, line in enumerate(lines, 1):
+            record = parse_record(line)
+            if record is None or record['type'] in ('header', 'end'):
+                continue
+            batch.append(record)
+            if len(batch) >= batch_size:
+                yield flush()
+        if batch:
+            yield flush()
+    except ValueError as e:
+        yield {'type': 'error', 'error': str(e), 'failed_line': line_no, **progress}
+        return
+    yield {'type': 'done', **progress}
+
+
+def progress_lines(progress):
+    """Encode ``import_records`` output as NDJSON lines."""
+    for record in progress:
+        yield _line(record)
@@ -113,6 +113,19 @@ export const petAPI = {
       body: JSON.stringify(petData)
     })
     return res.json()
+  },
+
+  // feed, play, rest, train or bath; the server works out the pet's current stats
+  action: async (token, action) => {
+    const res = await fetch(`${API_BASE_URL}/pet/actions`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        'Authorization': `Bearer ${token}`
+      },
+      body: JSON.stringify({ action })
+    })
+    return res.json()
   }
 }
 
@@ -160,6 +173,49 @@ export const moodsAPI = {
   }
 }
 
+// Reminders API: fired by the server at a local time, even with no tab open
+export const remindersAPI = {
+  list: async (token) => {
+    const res = await fetch(`${API_BASE_URL}/reminders`, {
+      headers: { 'Authorization': `Bearer ${token}` }
+    })
+    return res.json()
+  },
+
+  // { title, time: 'HH:MM', body?, kind?, timezone?, days?: ['mon', ...], enabled? }
+  create: async (token, reminder) => {
+    const res = await fetch(`${API_BASE_URL}/reminders`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        'Authorization': `Bearer ${token}`
+      },
+      body: JSON.stringify({ timezone: Intl.DateTimeFormat().resolvedOptions().timeZone, ...reminder })
+    })
+    return res.json()
+  },
+
+  update: async (token, id, changes) => {
+    const res = await fetch(`${API_BASE_URL}/reminders/${id}`, {
+      method: 'PUT',
+      headers: {
+        'Content-Type': 'application/json',
+        'Authorization': `Bearer ${token}`
+      },
+      body: JSON.stringify(changes)
+    })
+    return res.json()
+  },
+
+  remove: async (token, id) => {
+    const res = await fetch(`${API_BASE_URL}/reminders/${id}`, {
+      method: 'DELETE',
+      headers: { 'Authorization': `Bearer ${token}` }
+    })
+    return res.json()
+  }
+}
+
 // Storage helper for token
 export const storage = {
   getToken: () => localStorage.getItem('auth_token'),
@@ -15,8 +15,15 @@ echo "📦 Installing Python dependencies..."
 pip3 install -r backend/requirements.txt
 
 # Start backend server
-echo "🔧 Starting backend server on port 5000..."
-python3 backend/app.py &
+# CALMORA_BACKEND=server runs the standard-library server pre-forked across
+# CALMORA_PROCESSES workers (default: one per CPU) instead of the Flask app
+if [ "$CALMORA_BACKEND" = "server" ]; then
+    echo "🔧 Starting backend server on port 5000 (${CALMORA_PROCESSES:-one per CPU} processes)..."
+    python3 backend/server.py --processes "${CALMORA_PROCESSES:-0}" --mode "${CALMORA_SERVER_MODE:-threaded}" &
+else
+    echo "🔧 Starting backend server on port 5000..."
+    python3 backend/app.py &
+fi
 BACKEND_PID=$!
 
 # Wait for backend to start